@@ -4,85 +4,41 @@ from __future__ import annotations
 import logging
 from typing import Any
 
+import voluptuous as vol
+
 from homeassistant.components import persistent_notification, websocket_api
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.const import EVENT_STATE_CHANGED, Platform
 from homeassistant.core import HomeAssistant, callback
-from homeassistant.helpers import (
-    area_registry as ar,
-    device_registry as dr,
-    entity_registry as er,
-)
 from homeassistant.helpers.event import async_track_state_change_event
 from homeassistant.helpers.storage import Store
 
 from .const import (
     CONF_AREAS,
+    CONF_ATTRIBUTE_RULES,
     CONF_DEVICES,
     CONF_ENTITIES,
+    CONF_MATCH_RULES,
+    CONF_PROFILES,
+    CONF_THROTTLE_RULES,
+    DEFAULT_PROFILE,
     DOMAIN,
     STORAGE_KEY,
     STORAGE_VERSION,
 )
-from .storage import async_load_entities, async_save_entities
-
-
-def _resolve_filter(
-    hass: HomeAssistant,
-    *,
-    areas: list[str],
-    devices: list[str],
-    entities: list[str],
-) -> set[str]:
-    """Resolve area / device / entity selections to a flat entity-id set.
-
-    For each picked area, every entity assigned to that area (directly
-    or via its device's area) is included. For each picked device,
-    every entity registered to that device is included. Explicit
-    entity ids are added as-is. Result is unioned and deduplicated.
-
-    The set is rebuilt at setup time and on options-flow save. If a
-    user later assigns a *new* entity to an already-picked area, the
-    integration needs a reload (or restart) to see it — same trade-off
-    most HA filtering integrations make.
-    """
-    if not (areas or devices or entities):
-        return set()
-
-    ent_reg = er.async_get(hass)
-    dev_reg = dr.async_get(hass)
-
-    area_set = set(areas or [])
-    device_set = set(devices or [])
-    resolved: set[str] = set(entities or [])
-
-    if area_set or device_set:
-        # Pre-compute the device→area map so we can resolve entities
-        # whose `area_id` is unset but whose device sits in a picked
-        # area. Otherwise picking "Heimkino" would miss any entity
-        # that inherits its area from its device.
-        device_area = {dev.id: dev.area_id for dev in dev_reg.devices.values()}
-
-        for entry in ent_reg.entities.values():
-            if entry.disabled:
-                continue
-            # Direct device pick.
-            if entry.device_id and entry.device_id in device_set:
-                resolved.add(entry.entity_id)
-                continue
-            # Area pick: entity's own area, or its device's area.
-            entity_area = entry.area_id or (
-                device_area.get(entry.device_id) if entry.device_id else None
-            )
-            if entity_area and entity_area in area_set:
-                resolved.add(entry.entity_id)
-
-    return resolved
+from .storage import CouchControlStore, async_load_entities, async_schedule_save
+from .filter_index import FilterIndex
+from .patch import PatchConflict, async_patch_entities
 from .websocket_api import async_setup_websocket_api
 from .api import async_setup_api
+from .hub import async_get_hub, async_set_allowed_entities
+from .images import ImageCache
 
 _LOGGER = logging.getLogger(__name__)
 
+# Diagnostic metric sensors, disabled by default.
+PLATFORMS = [Platform.SENSOR]
+
 
 async def async_setup(hass: HomeAssistant, config: dict[str, Any]) -> bool:
     """Set up the Couch Control component."""
@@ -93,6 +49,10 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up Couch Control from a config entry."""
     try:
         hass.data.setdefault(DOMAIN, {})
+        # One Store for the entry's lifetime; edits schedule coalesced
+        # saves on it instead of each rewriting the file.
+        hass.data[DOMAIN]["store"] = CouchControlStore(hass)
+        hass.data[DOMAIN]["images"] = ImageCache(hass)
 
         # Load stored selections (areas, devices, individual entities).
         # Older installs only stored `entities` — `.get(..., [])` keeps
@@ -102,27 +62,73 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
             stored_areas = list(stored.get(CONF_AREAS, []))
             stored_devices = list(stored.get(CONF_DEVICES, []))
             stored_entities = list(stored.get(CONF_ENTITIES, []))
+            stored_match_rules = list(stored.get(CONF_MATCH_RULES) or [])
+            stored_rules = stored.get(CONF_ATTRIBUTE_RULES)
+            stored_throttle = stored.get(CONF_THROTTLE_RULES)
+            stored_profiles = dict(stored.get(CONF_PROFILES) or {})
         except Exception:
             _LOGGER.exception("Error loading stored selections, using config data")
             stored_areas = list(entry.data.get(CONF_AREAS, []))
             stored_devices = list(entry.data.get(CONF_DEVICES, []))
             stored_entities = list(entry.data.get(CONF_ENTITIES, []))
+            stored_match_rules = []
+            stored_rules = None
+            stored_throttle = None
+            stored_profiles = {}
 
         # Resolve area + device picks down to a flat entity-id set,
         # unioned with any explicitly-selected entities. The runtime
         # filter (WebSocket / REST / state-change handlers) only needs
-        # the resolved set; areas / devices are kept around so the
-        # options flow can re-display the user's actual picks.
-        resolved = _resolve_filter(
+        # the resolved set; the index keeps the actual picks so the
+        # options flow and services can edit them. Registry changes
+        # (e.g. a new entity assigned to a picked area) re-publish the
+        # resolved set without a reload.
+        # Named profiles resolve through the same index and publish
+        # their own allow-lists to the same hub.
+        @callback
+        def _async_filter_changed(profile: str) -> None:
+            if profile == DEFAULT_PROFILE or profile in index.profiles:
+                async_set_allowed_entities(
+                    hass, index.profile_resolved(profile), profile
+                )
+            else:
+                async_get_hub(hass).async_remove_profile(profile)
+
+        index = FilterIndex(
             hass,
             areas=stored_areas,
             devices=stored_devices,
             entities=stored_entities,
+            match_rules=stored_match_rules,
+            profiles=stored_profiles,
+            on_change=_async_filter_changed,
         )
-        hass.data[DOMAIN]["entities"] = list(resolved)
-        hass.data[DOMAIN]["areas"] = stored_areas
-        hass.data[DOMAIN]["devices"] = stored_devices
+        index.async_start()
+        hass.data[DOMAIN]["index"] = index
         hass.data[DOMAIN]["entry"] = entry
+        # One shared state tracker for every filtered subscription; it
+        # is re-pointed whenever the allow-list is published.
+        hub = hass.data[DOMAIN]["hub"] = async_get_hub(hass)
+        # Attribute rules trim payloads at serialization time and
+        # throttle rules hold back chatty sensors; a broken rule set
+        # must not take the whole integration down.
+        try:
+            hub.async_set_attribute_rules(stored_rules)
+        except vol.Invalid:
+            _LOGGER.exception("Ignoring invalid stored attribute rules")
+            hub.async_set_attribute_rules(None)
+        try:
+            hub.async_set_throttle_rules(stored_throttle)
+        except vol.Invalid:
+            _LOGGER.exception("Ignoring invalid stored throttle rules")
+            hub.async_set_throttle_rules(None)
+        async_set_allowed_entities(hass, index.resolved)
+        for profile in index.profiles:
+            async_set_allowed_entities(hass, index.profile_resolved(profile), profile)
+        # Profiles deleted while the entry was unloaded.
+        for profile in [name for name in hub.filters if name != DEFAULT_PROFILE]:
+            if profile not in index.profiles:
+                hub.async_remove_profile(profile)
         
         # Set up WebSocket API
         try:
@@ -145,6 +151,8 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
             _LOGGER.exception("Error setting up services")
             return False
         
+        await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+
         # Add update listener
         entry.async_on_unload(entry.add_update_listener(async_reload_entry))
         
@@ -159,15 +167,34 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
     try:
+        if not await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
+            return False
+
         # Remove services (with error handling)
         try:
             hass.services.async_remove(DOMAIN, "add_entity")
             hass.services.async_remove(DOMAIN, "remove_entity")
             hass.services.async_remove(DOMAIN, "set_entities")
+            hass.services.async_remove(DOMAIN, "patch_entities")
             hass.services.async_remove(DOMAIN, "uninstall")
         except Exception as ex:
             _LOGGER.warning("Error removing services during unload: %s", ex)
 
+        # Stop the shared tracker but keep the hub itself: clients
+        # stay subscribed across a reload and resume receiving events
+        # once setup publishes the allow-list again.
+        index = hass.data.get(DOMAIN, {}).get("index")
+        if index is not None:
+            index.async_stop()
+        hub = hass.data.get(DOMAIN, {}).get("hub")
+        if hub is not None:
+            hub.async_stop()
+
+        # Write out edits still waiting in the save delay.
+        store = hass.data.get(DOMAIN, {}).get("store")
+        if store is not None:
+            await store.async_flush()
+
         # Pop the domain entirely instead of `clear()` so no empty
         # container is left behind for handlers that test
         # `if DOMAIN in hass.data`. Note that WebSocket commands and
@@ -210,39 +237,76 @@ async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
 
 async def _async_setup_services(hass: HomeAssistant) -> None:
     """Set up services for Couch Control."""
-    
+    metrics = async_get_hub(hass).metrics
+
     @callback
     def add_entity(call):
         """Add an entity to the filter list."""
+        metrics.count("service_calls")
         entity_id = call.data.get("entity_id")
-        if entity_id and entity_id not in hass.data[DOMAIN]["entities"]:
-            hass.data[DOMAIN]["entities"].append(entity_id)
-            hass.async_create_task(
-                async_save_entities(hass, {"entities": hass.data[DOMAIN]["entities"]})
-            )
+        index: FilterIndex = hass.data[DOMAIN]["index"]
+        if entity_id and entity_id not in hass.data[DOMAIN]["filter"]:
+            index.async_set_selection(entities=[*index.entities, entity_id])
+            async_schedule_save(hass)
             _LOGGER.info("Added %s to Couch Control filter", entity_id)
     
     @callback
     def remove_entity(call):
         """Remove an entity from the filter list."""
+        metrics.count("service_calls")
         entity_id = call.data.get("entity_id")
-        if entity_id in hass.data[DOMAIN]["entities"]:
-            hass.data[DOMAIN]["entities"].remove(entity_id)
-            hass.async_create_task(
-                async_save_entities(hass, {"entities": hass.data[DOMAIN]["entities"]})
-            )
+        index: FilterIndex = hass.data[DOMAIN]["index"]
+        if entity_id in hass.data[DOMAIN]["filter"]:
+            if entity_id in index.entities:
+                index.async_set_selection(
+                    entities=[eid for eid in index.entities if eid != entity_id]
+                )
+            if entity_id in hass.data[DOMAIN]["filter"]:
+                # Still pulled in by an area / device pick or a match
+                # rule. Flatten the picks to explicit entities so the
+                # removal sticks — the same outcome this service always
+                # had.
+                index.async_set_selection(
+                    areas=[],
+                    devices=[],
+                    match_rules=[],
+                    entities=[
+                        eid for eid in index.resolved if eid != entity_id
+                    ],
+                )
+                _LOGGER.info(
+                    "%s was selected via an area, device or match rule; "
+                    "those picks were replaced by their individual entities",
+                    entity_id,
+                )
+            async_schedule_save(hass)
             _LOGGER.info("Removed %s from Couch Control filter", entity_id)
     
     @callback
     def set_entities(call):
         """Set the complete entity filter list."""
+        metrics.count("service_calls")
         entities = call.data.get("entities", [])
-        hass.data[DOMAIN]["entities"] = entities
-        hass.async_create_task(
-            async_save_entities(hass, {"entities": entities})
+        index: FilterIndex = hass.data[DOMAIN]["index"]
+        index.async_set_selection(
+            areas=[], devices=[], match_rules=[], entities=entities
         )
+        async_schedule_save(hass)
         _LOGGER.info("Updated Couch Control filter with %d entities", len(entities))
 
+    @callback
+    def patch_entities(call):
+        """Add and remove many entities with one update and one save."""
+        metrics.count("service_calls")
+        try:
+            async_patch_entities(
+                hass,
+                add=call.data.get("add", []),
+                remove=call.data.get("remove", []),
+            )
+        except PatchConflict as err:
+            raise vol.Invalid(str(err)) from err
+
     async def uninstall(call):
         """Clean uninstall: remove the config entry while the
         integration code is still loaded.
@@ -290,4 +354,5 @@ async def _async_setup_services(hass: HomeAssistant) -> None:
     hass.services.async_register(DOMAIN, "add_entity", add_entity)
     hass.services.async_register(DOMAIN, "remove_entity", remove_entity)
     hass.services.async_register(DOMAIN, "set_entities", set_entities)
+    hass.services.async_register(DOMAIN, "patch_entities", patch_entities)
     hass.services.async_register(DOMAIN, "uninstall", uninstall)
\ No newline at end of file
@@ -1,19 +1,45 @@
 """REST API for Couch Control Entity Filter."""
 from __future__ import annotations
 
+from collections.abc import Iterator
 import logging
+import time
 from typing import Any
 
-from aiohttp import web
+from aiohttp import hdrs, web
 import voluptuous as vol
 
 from homeassistant.components.http import HomeAssistantView
+from homeassistant.const import CONTENT_TYPE_JSON
 from homeassistant.core import HomeAssistant
-from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 
-from .const import DOMAIN
-from .storage import async_save_entities
+from .const import (
+    COMPRESS_MIN_SIZE,
+    DEFAULT_HISTORY_BUCKETS,
+    DEFAULT_HISTORY_HOURS,
+    DEFAULT_PROFILE,
+    DOMAIN,
+    IMAGE_BROWSER_CACHE_SECONDS,
+    LISTING_CHUNK_SIZE,
+    MAX_HISTORY_BUCKETS,
+    MAX_HISTORY_ENTITIES,
+    MAX_HISTORY_HOURS,
+    MAX_IMAGE_SIZE,
+    MAX_PAGE_SIZE,
+)
+from .history import RecorderUnavailable, async_get_history
+from .hub import async_get_hub
+from .images import ImageCache, ImageUnavailable, image_key
+from .listing import (
+    InvalidCursor,
+    invalid_fields,
+    listing_chunks,
+    listing_version,
+)
+from .metrics import Metrics
+from .patch import PATCH_SCHEMA, PatchConflict, async_patch_entities
+from .storage import async_get_store, async_schedule_save
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -25,8 +51,21 @@ class CouchControlEntitiesView(HomeAssistantView):
     name = "api:couch_control:entities"
     requires_auth = True
 
-    async def get(self, request: web.Request) -> web.Response:
-        """Get filtered entities list."""
+    async def get(self, request: web.Request) -> web.StreamResponse:
+        """Get filtered entities list.
+
+        Optional query parameters:
+          fields=entity_id,name,state,icon  only these record keys
+          attributes=brightness,rgb_color   only these attributes
+          limit=50                          page size
+          cursor=...                        `next_cursor` of the previous page
+          profile=kids_room                 a named profile's list
+
+        Bodies over `COMPRESS_MIN_SIZE` are gzip / deflate compressed
+        when the client accepts it. Unpaged listings of more than
+        `LISTING_CHUNK_SIZE` entities are streamed with chunked
+        encoding, so the full document never sits in memory at once.
+        """
         hass = request.app["hass"]
         
         if DOMAIN not in hass.data:
@@ -34,40 +73,90 @@ class CouchControlEntitiesView(HomeAssistantView):
                 {"error": "Couch Control not configured"}, status=400
             )
         
-        entities = hass.data[DOMAIN].get("entities", [])
-        
-        # Get detailed entity information
-        ent_reg = er.async_get(hass)
-        detailed_entities = []
-        
-        for entity_id in entities:
-            state = hass.states.get(entity_id)
-            entry = ent_reg.async_get(entity_id)
-            
-            entity_data = {
-                "entity_id": entity_id,
-                "state": state.state if state else None,
-                "attributes": dict(state.attributes) if state else {},
-                "last_changed": state.last_changed.isoformat() if state else None,
-                "last_updated": state.last_updated.isoformat() if state else None,
-            }
-            
-            if entry:
-                entity_data.update({
-                    "name": entry.name or entry.original_name,
-                    "icon": entry.icon or entry.original_icon,
-                    "device_class": entry.device_class,
-                    "unit_of_measurement": entry.unit_of_measurement,
-                    "area_id": entry.area_id,
-                    "device_id": entry.device_id,
-                })
-            
-            detailed_entities.append(entity_data)
+        hub = async_get_hub(hass)
+        profile = request.query.get("profile", DEFAULT_PROFILE)
+        if (allowed := hub.filters.get(profile)) is None:
+            return web.json_response(
+                {"error": f"No profile named {profile}"}, status=400
+            )
+        hub.metrics.count("rest_listings")
+
+        query = request.query
+        fields = _split_param(query.get("fields"))
+        if fields is not None and (unknown := invalid_fields(fields)):
+            return web.json_response(
+                {"error": f"Unknown fields: {', '.join(unknown)}"}, status=400
+            )
+        limit = None
+        if "limit" in query:
+            try:
+                limit = int(query["limit"])
+            except ValueError:
+                limit = 0
+            if not 1 <= limit <= MAX_PAGE_SIZE:
+                return web.json_response(
+                    {"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"},
+                    status=400,
+                )
+        attributes = _split_param(query.get("attributes"))
+        cursor = query.get("cursor")
+
+        # Clients poll this on wake from standby; most of the time
+        # nothing changed and a 304 saves building and sending the list.
+        version = listing_version(
+            hub,
+            allowed,
+            fields=fields,
+            attributes=attributes,
+            limit=limit,
+            cursor=cursor,
+        )
+        etag = f'"{version}"'
+        headers = {hdrs.ETAG: etag, hdrs.VARY: hdrs.ACCEPT_ENCODING}
+        if _etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), etag):
+            hub.metrics.count("rest_listings_not_modified")
+            return web.Response(status=304, headers=headers)
         
-        return web.json_response({
-            "entities": detailed_entities,
-            "count": len(entities)
-        })
+        # Get detailed entity information, assembled from the
+        # encoded-state cache so unchanged entities aren't re-serialized.
+        start = time.perf_counter()
+        try:
+            chunks = listing_chunks(
+                hass,
+                hub,
+                allowed,
+                fields=fields,
+                attributes=attributes,
+                limit=limit,
+                cursor=cursor,
+            )
+        except InvalidCursor as err:
+            return web.json_response({"error": str(err)}, status=400)
+
+        if limit is None and len(allowed) > LISTING_CHUNK_SIZE:
+            response = await _async_stream_response(
+                request, chunks, headers, hub.metrics
+            )
+            # Kept apart from `listing_ms`: it includes waiting on the
+            # client's reads.
+            hub.metrics.observe(
+                "listing_stream_ms", (time.perf_counter() - start) * 1000
+            )
+            return response
+
+        body = "".join(chunks)
+        hub.metrics.observe("listing_ms", (time.perf_counter() - start) * 1000)
+        # Uncompressed size; gzip happens later in aiohttp.
+        hub.metrics.count("bytes_sent", len(body))
+        response = web.Response(
+            text=body,
+            content_type=CONTENT_TYPE_JSON,
+            headers=headers,
+            zlib_executor_size=32768,
+        )
+        if response.content_length >= COMPRESS_MIN_SIZE:
+            response.enable_compression()
+        return response
 
     async def post(self, request: web.Request) -> web.Response:
         """Update filtered entities list."""
@@ -77,6 +166,8 @@ class CouchControlEntitiesView(HomeAssistantView):
             return web.json_response(
                 {"error": "Couch Control not configured"}, status=400
             )
+        if (error := _reject_profile(request)) is not None:
+            return error
         
         try:
             data = await request.json()
@@ -109,14 +200,19 @@ class CouchControlEntitiesView(HomeAssistantView):
             else:
                 invalid_entities.append(entity_id)
         
-        # Update storage
-        hass.data[DOMAIN]["entities"] = valid_entities
-        await async_save_entities(hass, {"entities": valid_entities})
+        # Update storage; replaces any area / device picks and match
+        # rules with the explicit list, same as the `set_entities` service.
+        index = hass.data[DOMAIN]["index"]
+        index.async_set_selection(
+            areas=[], devices=[], match_rules=[], entities=valid_entities
+        )
+        async_schedule_save(hass)
         
         response_data = {
             "success": True,
             "entities": valid_entities,
             "count": len(valid_entities),
+            "generation": hass.data[DOMAIN]["filter"].generation,
         }
         
         if invalid_entities:
@@ -127,6 +223,42 @@ class CouchControlEntitiesView(HomeAssistantView):
         
         return web.json_response(response_data)
 
+    async def patch(self, request: web.Request) -> web.Response:
+        """Add and remove entities in one request.
+
+        Body: `{"add": [entity_ids], "remove": [entity_ids]}`. Responds
+        with the entities that actually joined / left the allow-list.
+        """
+        hass = request.app["hass"]
+
+        if DOMAIN not in hass.data:
+            return web.json_response(
+                {"error": "Couch Control not configured"}, status=400
+            )
+        if (error := _reject_profile(request)) is not None:
+            return error
+
+        try:
+            data = await request.json()
+        except Exception:
+            return web.json_response(
+                {"error": "Invalid JSON"}, status=400
+            )
+
+        try:
+            validated_data = vol.Schema(PATCH_SCHEMA)(data)
+            delta = async_patch_entities(
+                hass, add=validated_data["add"], remove=validated_data["remove"]
+            )
+        except vol.Invalid as err:
+            return web.json_response(
+                {"error": f"Invalid data: {err}"}, status=400
+            )
+        except PatchConflict as err:
+            return web.json_response({"error": str(err)}, status=400)
+
+        return web.json_response({"success": True, **delta})
+
 
 class CouchControlInfoView(HomeAssistantView):
     """View to provide Couch Control integration info."""
@@ -144,21 +276,279 @@ class CouchControlInfoView(HomeAssistantView):
                 {"error": "Couch Control not configured"}, status=400
             )
         
-        entity_count = len(hass.data[DOMAIN].get("entities", []))
+        allowed = hass.data[DOMAIN]["filter"]
+        hub = async_get_hub(hass)
         
         return web.json_response({
             "integration": "Couch Control Entity Filter",
             "version": "1.0.0",
             "domain": DOMAIN,
-            "filtered_entities_count": entity_count,
+            "filtered_entities_count": len(allowed),
+            "filter_generation": allowed.generation,
+            "profiles": {
+                name: len(snapshot)
+                for name, snapshot in hub.filters.items()
+                if name != DEFAULT_PROFILE
+            },
+            "storage": async_get_store(hass).stats,
+            "throttle": hub.throttle.stats,
             "websocket_endpoint": f"{DOMAIN}/subscribe_filtered",
             "status": "active"
         })
 
 
+class CouchControlMetricsView(HomeAssistantView):
+    """View to expose Couch Control runtime metrics."""
+
+    url = "/api/couch_control/metrics"
+    name = "api:couch_control:metrics"
+    requires_auth = True
+
+    async def get(self, request: web.Request) -> web.Response:
+        """Get counters and latency histograms.
+
+        Counters carry a running `total` and the `last_minute`;
+        histograms are in milliseconds with cumulative `le` buckets.
+        They live on the hub, so they survive entry reloads.
+        """
+        hass = request.app["hass"]
+
+        if DOMAIN not in hass.data:
+            return web.json_response(
+                {"error": "Couch Control not configured"}, status=400
+            )
+
+        hub = async_get_hub(hass)
+        return web.json_response({
+            **hub.metrics.as_dict(),
+            "subscribers": hub.subscriber_count,
+            "filtered_entities_count": len(hass.data[DOMAIN]["filter"]),
+            "state_cache_size": len(hub.state_cache),
+            "storage": async_get_store(hass).stats,
+            "throttle": hub.throttle.stats,
+            "history_cache": hub.history.stats,
+            "image_cache": hass.data[DOMAIN]["images"].stats,
+        })
+
+
+class CouchControlHistoryView(HomeAssistantView):
+    """View to serve downsampled history for sparklines."""
+
+    url = "/api/couch_control/history"
+    name = "api:couch_control:history"
+    requires_auth = True
+
+    async def get(self, request: web.Request) -> web.Response:
+        """Get min / max / mean buckets for some allowed entities.
+
+        Query parameters:
+          entity_ids=sensor.a,sensor.b  required, allowed entities only
+          hours=24                      window ending now
+          buckets=96                    number of equal slices
+          profile=kids_room             a named profile's list
+        """
+        hass = request.app["hass"]
+
+        if DOMAIN not in hass.data:
+            return web.json_response(
+                {"error": "Couch Control not configured"}, status=400
+            )
+
+        hub = async_get_hub(hass)
+        query = request.query
+        profile = query.get("profile", DEFAULT_PROFILE)
+        if (allowed := hub.filters.get(profile)) is None:
+            return web.json_response(
+                {"error": f"No profile named {profile}"}, status=400
+            )
+        entity_ids = _split_param(query.get("entity_ids")) or []
+        if not 1 <= len(entity_ids) <= MAX_HISTORY_ENTITIES:
+            return web.json_response(
+                {
+                    "error": "entity_ids must list between 1 and "
+                    f"{MAX_HISTORY_ENTITIES} entities"
+                },
+                status=400,
+            )
+        try:
+            hours = int(query.get("hours", DEFAULT_HISTORY_HOURS))
+            buckets = int(query.get("buckets", DEFAULT_HISTORY_BUCKETS))
+        except ValueError:
+            hours = buckets = 0
+        if not (
+            1 <= hours <= MAX_HISTORY_HOURS and 1 <= buckets <= MAX_HISTORY_BUCKETS
+        ):
+            return web.json_response(
+                {
+                    "error": f"hours must be between 1 and {MAX_HISTORY_HOURS}, "
+                    f"buckets between 1 and {MAX_HISTORY_BUCKETS}"
+                },
+                status=400,
+            )
+
+        try:
+            result = await async_get_history(
+                hass, hub, allowed, entity_ids, hours=hours, buckets=buckets
+            )
+        except RecorderUnavailable as err:
+            return web.json_response({"error": str(err)}, status=400)
+        response = web.json_response(result)
+        if response.content_length and response.content_length >= COMPRESS_MIN_SIZE:
+            response.enable_compression()
+        return response
+
+
+class CouchControlImageView(HomeAssistantView):
+    """View to serve an entity's picture resized for the client."""
+
+    url = "/api/couch_control/image/{entity_id}"
+    name = "api:couch_control:image"
+    requires_auth = True
+
+    async def get(self, request: web.Request, entity_id: str) -> web.Response:
+        """Get the `entity_picture` of an allowed entity, fitted into a box.
+
+        Query parameters (at least one of width / height):
+          width=400           largest width in pixels
+          height=400          largest height in pixels
+          profile=kids_room   a named profile's list
+        """
+        hass = request.app["hass"]
+
+        if DOMAIN not in hass.data:
+            return web.json_response(
+                {"error": "Couch Control not configured"}, status=400
+            )
+
+        hub = async_get_hub(hass)
+        query = request.query
+        profile = query.get("profile", DEFAULT_PROFILE)
+        if (allowed := hub.filters.get(profile)) is None:
+            return web.json_response(
+                {"error": f"No profile named {profile}"}, status=400
+            )
+        if entity_id not in allowed:
+            return web.json_response(
+                {"error": f"Entity {entity_id} not allowed"}, status=400
+            )
+        try:
+            width = int(query["width"]) if "width" in query else None
+            height = int(query["height"]) if "height" in query else None
+        except ValueError:
+            width = height = 0
+        if (width is None and height is None) or not all(
+            1 <= size <= MAX_IMAGE_SIZE for size in (width, height) if size is not None
+        ):
+            return web.json_response(
+                {
+                    "error": "width and/or height must be given, between 1 "
+                    f"and {MAX_IMAGE_SIZE}"
+                },
+                status=400,
+            )
+        state = hub.visible_state(entity_id)
+        if state is None or not (url := state.attributes.get("entity_picture")):
+            return web.json_response(
+                {"error": f"Entity {entity_id} has no picture"}, status=404
+            )
+
+        # The key covers the source URL, so a new picture is a new ETag.
+        etag = f'"{image_key(url, width, height)}"'
+        headers = {
+            hdrs.ETAG: etag,
+            hdrs.CACHE_CONTROL: f"private, max-age={IMAGE_BROWSER_CACHE_SECONDS}",
+        }
+        if _etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), etag):
+            hub.metrics.count("image_not_modified")
+            return web.Response(status=304, headers=headers)
+
+        images: ImageCache = hass.data[DOMAIN]["images"]
+        start = time.perf_counter()
+        try:
+            image = await images.async_get(url, width, height)
+        except ImageUnavailable as err:
+            hub.metrics.count("image_errors")
+            return web.json_response({"error": str(err)}, status=502)
+        hub.metrics.count("image_requests")
+        hub.metrics.observe("image_ms", (time.perf_counter() - start) * 1000)
+        hub.metrics.count("bytes_sent", len(image.data))
+        return web.Response(
+            body=image.data, content_type=image.content_type, headers=headers
+        )
+
+
+async def _async_stream_response(
+    request: web.Request,
+    chunks: Iterator[str],
+    headers: dict[str, str],
+    metrics: Metrics,
+) -> web.StreamResponse:
+    """Write a listing chunk by chunk with chunked transfer encoding.
+
+    Each write awaits the transport, so a slow client throttles
+    encoding instead of the whole body piling up in memory.
+    """
+    response = web.StreamResponse(headers=headers)
+    response.content_type = CONTENT_TYPE_JSON
+    response.enable_chunked_encoding()
+    response.enable_compression()
+    await response.prepare(request)
+    for chunk in chunks:
+        data = chunk.encode()
+        metrics.count("bytes_sent", len(data))
+        await response.write(data)
+    await response.write_eof()
+    return response
+
+
+def _reject_profile(request: web.Request) -> web.Response | None:
+    """Refuse a write aimed at a named profile.
+
+    Writes only edit the default list; profiles are edited in the
+    options flow. Without this, `?profile=` would be ignored and the
+    default list replaced instead.
+    """
+    profile = request.query.get("profile", DEFAULT_PROFILE)
+    if profile == DEFAULT_PROFILE:
+        return None
+    return web.json_response(
+        {
+            "error": f"Profile {profile} can only be edited in the options "
+            "flow; omit profile to edit the default list"
+        },
+        status=400,
+    )
+
+
+def _split_param(value: str | None) -> list[str] | None:
+    """Split a comma-separated query parameter; None when absent."""
+    if value is None:
+        return None
+    return [part for part in (item.strip() for item in value.split(",")) if part]
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Evaluate an If-None-Match header against our ETag.
+
+    Uses the weak comparison RFC 9110 prescribes for If-None-Match, so
+    a `W/` prefix added by a proxy still matches.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+
 async def async_setup_api(hass: HomeAssistant) -> None:
     """Set up the REST API."""
     hass.http.register_view(CouchControlEntitiesView())
     hass.http.register_view(CouchControlInfoView())
+    hass.http.register_view(CouchControlMetricsView())
+    hass.http.register_view(CouchControlHistoryView())
+    hass.http.register_view(CouchControlImageView())
     
     _LOGGER.info("Couch Control REST API endpoints registered")
\ No newline at end of file
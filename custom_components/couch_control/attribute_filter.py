@@ -0,0 +1,104 @@
+"""Per-domain / per-entity attribute projection for outgoing payloads.
+
+Widgets read a handful of attributes, but states carry everything the
+integration knows: album art URLs, full `source_list`s, multi-day
+weather forecasts. Rules configured in the options flow trim those
+before serialization, so every snapshot, event and listing shrinks.
+
+Rules look like::
+
+    domains:
+      media_player:
+        exclude: [source_list, sound_mode_list]
+      weather:
+        exclude: [forecast]
+    entities:
+      light.living_room:
+        include: [brightness, color_mode, friendly_name]
+
+`include` keeps only the listed attributes, `exclude` drops the listed
+ones. An entity rule replaces its domain's rule.
+"""
+from __future__ import annotations
+
+from collections.abc import Mapping
+from typing import Any
+
+import voluptuous as vol
+
+from homeassistant.core import State, split_entity_id
+
+CONF_INCLUDE = "include"
+CONF_EXCLUDE = "exclude"
+CONF_DOMAINS = "domains"
+CONF_RULE_ENTITIES = "entities"
+
+_RULE_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_INCLUDE): [str],
+        vol.Optional(CONF_EXCLUDE): [str],
+    }
+)
+
+ATTRIBUTE_RULES_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_DOMAINS, default={}): {str: _RULE_SCHEMA},
+        vol.Optional(CONF_RULE_ENTITIES, default={}): {str: _RULE_SCHEMA},
+    }
+)
+
+# (include, exclude): include is None when every attribute is allowed.
+_Rule = tuple[frozenset[str] | None, frozenset[str]]
+
+
+def _compile_rule(rule: Mapping[str, Any]) -> _Rule:
+    """Turn one validated rule into lookup sets."""
+    include = rule.get(CONF_INCLUDE)
+    return (
+        frozenset(include) if include is not None else None,
+        frozenset(rule.get(CONF_EXCLUDE, ())),
+    )
+
+
+class AttributeFilter:
+    """Compiled attribute rules; call it with a state to get its attributes."""
+
+    def __init__(self, rules: Mapping[str, Any] | None = None) -> None:
+        """Compile validated rules (see `ATTRIBUTE_RULES_SCHEMA`)."""
+        self.rules: dict[str, Any] = ATTRIBUTE_RULES_SCHEMA(dict(rules or {}))
+        self._domains = {
+            domain: _compile_rule(rule)
+            for domain, rule in self.rules[CONF_DOMAINS].items()
+        }
+        self._entities = {
+            entity_id: _compile_rule(rule)
+            for entity_id, rule in self.rules[CONF_RULE_ENTITIES].items()
+        }
+        # entity_id -> rule (or None), so the domain split and two dict
+        # lookups happen once per entity rather than once per state.
+        self._resolved: dict[str, _Rule | None] = {}
+
+    def __bool__(self) -> bool:
+        """Return True if any rule is configured."""
+        return bool(self._domains or self._entities)
+
+    def __call__(self, state: State) -> Mapping[str, Any]:
+        """Return the attributes of `state` that may be sent to clients."""
+        entity_id = state.entity_id
+        try:
+            rule = self._resolved[entity_id]
+        except KeyError:
+            rule = self._entities.get(entity_id)
+            if rule is None:
+                rule = self._domains.get(split_entity_id(entity_id)[0])
+            self._resolved[entity_id] = rule
+
+        attributes = state.attributes
+        if rule is None:
+            return attributes
+        include, exclude = rule
+        return {
+            key: value
+            for key, value in attributes.items()
+            if (include is None or key in include) and key not in exclude
+        }
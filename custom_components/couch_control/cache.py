@@ -0,0 +1,161 @@
+"""Cache of pre-encoded per-entity payloads.
+
+Snapshots, listings and events all serialize the same handful of
+`State` objects over and over: every subscribe re-encodes every
+allowed entity, and each state change's `new_state` is encoded again
+as the next change's `old_state`. The cache keeps the JSON fragments
+for the latest state of each entity and hands them out until the
+entity's `last_updated` or context changes. Responses are then glued
+together from fragments instead of being re-serialized.
+
+The cache also owns the active `AttributeFilter`: fragments are stored
+already trimmed, so changing the rules clears it.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Iterable
+from datetime import datetime
+
+from homeassistant.core import State, callback
+from homeassistant.helpers.entity_registry import RegistryEntry
+from homeassistant.helpers.json import JSON_DUMP
+
+from .attribute_filter import AttributeFilter
+from .const import DEFAULT_STATE_CACHE_SIZE
+from .serialization import entity_listing, state_to_compressed, state_to_dict
+
+
+class _CacheEntry:
+    """Encoded fragments for one state of one entity."""
+
+    __slots__ = (
+        "last_updated",
+        "context_id",
+        "id_json",
+        "state_json",
+        "compressed_json",
+        "compressed_item_json",
+        "listing_json",
+        "listing_entry",
+    )
+
+    def __init__(self, state: State) -> None:
+        """Initialize an empty entry for `state`."""
+        self.last_updated: datetime = state.last_updated
+        self.context_id: str = state.context.id
+        self.id_json: str = JSON_DUMP(state.entity_id)
+        self.state_json: str | None = None
+        self.compressed_json: str | None = None
+        self.compressed_item_json: str | None = None
+        self.listing_json: str | None = None
+        # Registry entries are immutable and replaced on update, so the
+        # identity of the entry a listing was built from is enough to
+        # tell whether name / icon / area are still current.
+        self.listing_entry: RegistryEntry | None = None
+
+
+class StateCache:
+    """Bounded LRU of encoded state fragments, keyed by entity id."""
+
+    def __init__(self, max_entries: int = DEFAULT_STATE_CACHE_SIZE) -> None:
+        """Initialize the cache."""
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.attribute_filter: AttributeFilter | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached entities."""
+        return len(self._entries)
+
+    def _entry(self, state: State) -> _CacheEntry:
+        """Return the entry for `state`, replacing a stale one."""
+        entity_id = state.entity_id
+        entry = self._entries.get(entity_id)
+        if (
+            entry is not None
+            and entry.last_updated == state.last_updated
+            and entry.context_id == state.context.id
+        ):
+            self._entries.move_to_end(entity_id)
+            return entry
+
+        entry = self._entries[entity_id] = _CacheEntry(state)
+        self._entries.move_to_end(entity_id)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def state_json(self, state: State) -> str:
+        """Return `state_to_dict(state)` as JSON."""
+        entry = self._entry(state)
+        if entry.state_json is None:
+            self.misses += 1
+            entry.state_json = JSON_DUMP(state_to_dict(state, self.attribute_filter))
+        else:
+            self.hits += 1
+        return entry.state_json
+
+    def compressed_json(self, state: State) -> str:
+        """Return `state_to_compressed(state)` as JSON."""
+        entry = self._entry(state)
+        if entry.compressed_json is None:
+            self.misses += 1
+            entry.compressed_json = JSON_DUMP(
+                state_to_compressed(state, self.attribute_filter)
+            )
+        else:
+            self.hits += 1
+        return entry.compressed_json
+
+    def compressed_item_json(self, state: State) -> str:
+        """Return `"entity_id":{compressed state}` for a compact `a` map."""
+        entry = self._entry(state)
+        if entry.compressed_item_json is None:
+            entry.compressed_item_json = (
+                f"{entry.id_json}:{self.compressed_json(state)}"
+            )
+        else:
+            self.hits += 1
+        return entry.compressed_item_json
+
+    def listing_json(
+        self, entity_id: str, state: State | None, registry_entry: RegistryEntry | None
+    ) -> str:
+        """Return the detailed listing record for an entity as JSON."""
+        if state is None:
+            # Nothing to key on; these are rare (entity configured but
+            # not loaded) and cheap to encode.
+            return JSON_DUMP(entity_listing(entity_id, None, registry_entry))
+        entry = self._entry(state)
+        if entry.listing_json is None or entry.listing_entry is not registry_entry:
+            self.misses += 1
+            entry.listing_json = JSON_DUMP(
+                entity_listing(entity_id, state, registry_entry, self.attribute_filter)
+            )
+            entry.listing_entry = registry_entry
+        else:
+            self.hits += 1
+        return entry.listing_json
+
+    @callback
+    def async_set_attribute_filter(
+        self, attribute_filter: AttributeFilter | None
+    ) -> None:
+        """Switch attribute rules; every cached fragment is now wrong."""
+        self.attribute_filter = attribute_filter or None
+        self._entries.clear()
+
+    @callback
+    def async_retain(self, entity_ids: Iterable[str]) -> None:
+        """Evict every entity that is no longer in the allow-list."""
+        keep = entity_ids if isinstance(entity_ids, (set, frozenset)) else set(entity_ids)
+        for entity_id in [eid for eid in self._entries if eid not in keep]:
+            del self._entries[entity_id]
+
+    @callback
+    def async_clear(self) -> None:
+        """Drop every cached fragment."""
+        self._entries.clear()
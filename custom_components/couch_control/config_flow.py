@@ -7,10 +7,15 @@ The form exposes three independent selectors:
   • Entities — explicit individual entity ids
 
 The runtime filter is the union of all three resolved against the
-current entity / device / area registries (see `_resolve_filter` in
-`__init__.py`). Picking a whole area is a one-tap shortcut for
+current entity / device / area registries (see `FilterIndex` in
+`filter_index.py`). Picking a whole area is a one-tap shortcut for
 "include everything in this room"; the entities field stays available
 for additions/exceptions that aren't covered by an area or device.
+
+The options flow additionally edits the attribute rules (see
+`attribute_filter.py`) that trim what each entity sends, and named
+profiles: extra selections with the same three pickers that clients
+ask for by name (`profile`), e.g. one per TV.
 """
 from __future__ import annotations
 
@@ -30,11 +35,41 @@ from homeassistant.helpers.selector import (
     DeviceSelectorConfig,
     EntitySelector,
     EntitySelectorConfig,
+    ObjectSelector,
+    SelectSelector,
+    SelectSelectorConfig,
+    SelectSelectorMode,
 )
 
-from .const import CONF_AREAS, CONF_DEVICES, CONF_ENTITIES, DOMAIN
+from .attribute_filter import ATTRIBUTE_RULES_SCHEMA
+from .matcher import MATCH_RULES_SCHEMA
+from .throttle import THROTTLE_RULES_SCHEMA
+from .const import (
+    CONF_AREAS,
+    CONF_ATTRIBUTE_RULES,
+    CONF_DEVICES,
+    CONF_ENTITIES,
+    CONF_MATCH_RULES,
+    CONF_PROFILE,
+    CONF_PROFILES,
+    CONF_THROTTLE_RULES,
+    DEFAULT_PROFILE,
+    DOMAIN,
+)
 from .storage import async_load_entities, async_save_entities
 
+# Options-only JSON fields: schema and the error shown when invalid.
+_RULE_FIELDS = {
+    CONF_ATTRIBUTE_RULES: (ATTRIBUTE_RULES_SCHEMA, "invalid_attribute_rules"),
+    CONF_THROTTLE_RULES: (THROTTLE_RULES_SCHEMA, "invalid_throttle_rules"),
+}
+
+# Profile names are what clients send as `profile`; "default" is the
+# top-level selection.
+PROFILE_NAME_SCHEMA = vol.All(
+    str, vol.Strip, vol.Length(min=1, max=64), vol.NotIn([DEFAULT_PROFILE])
+)
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -48,7 +83,22 @@ def _selector_schema(
     default_entities: list[str],
     default_areas: list[str],
     default_devices: list[str],
+    default_match_rules: list[dict[str, Any]] | None = None,
+    default_rules: dict[str, dict[str, Any]] | None = None,
 ) -> vol.Schema:
+    # Match rules and attribute / throttle rules are options-only
+    # fields: the initial flow passes None and doesn't show them.
+    rules_fields = {
+        vol.Optional(key, default=default): ObjectSelector()
+        for key, default in (default_rules or {}).items()
+    }
+    if default_match_rules is not None:
+        rules_fields = {
+            vol.Optional(
+                CONF_MATCH_RULES, default=default_match_rules
+            ): ObjectSelector(),
+            **rules_fields,
+        }
     return vol.Schema(
         {
             vol.Optional(CONF_AREAS, default=default_areas): AreaSelector(
@@ -60,6 +110,7 @@ def _selector_schema(
             vol.Optional(CONF_ENTITIES, default=default_entities): EntitySelector(
                 EntitySelectorConfig(multiple=True)
             ),
+            **rules_fields,
         }
     )
 
@@ -186,65 +237,214 @@ class CouchControlOptionsFlow(config_entries.OptionsFlow):
         self._entities: list[str] = []
         self._areas: list[str] = []
         self._devices: list[str] = []
+        self._match_rules: list[dict[str, Any]] = []
+        self._rules: dict[str, dict[str, Any]] = {}
+        self._profile = ""
 
     async def async_step_init(
         self, user_input: dict[str, Any] | None = None
     ) -> FlowResult:
-        """Manage the options."""
+        """Choose between the default selection and the named profiles."""
+        current = await async_load_entities(self.hass)
+        menu_options = ["selection", "profile"]
+        if current.get(CONF_PROFILES):
+            menu_options.append("delete_profile")
+        return self.async_show_menu(step_id="init", menu_options=menu_options)
+
+    async def async_step_selection(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Edit the default selection and the rules."""
         errors: dict[str, str] = {}
 
         if user_input is not None:
+            self._entities = _filter_existing_entities(
+                self.hass, user_input.get(CONF_ENTITIES, [])
+            )
+            self._areas = list(user_input.get(CONF_AREAS, []))
+            self._devices = list(user_input.get(CONF_DEVICES, []))
             try:
-                self._entities = _filter_existing_entities(
-                    self.hass, user_input.get(CONF_ENTITIES, [])
-                )
-                self._areas = list(user_input.get(CONF_AREAS, []))
-                self._devices = list(user_input.get(CONF_DEVICES, []))
-
-                await async_save_entities(
-                    self.hass,
-                    {
-                        CONF_ENTITIES: self._entities,
-                        CONF_AREAS: self._areas,
-                        CONF_DEVICES: self._devices,
-                    },
+                self._match_rules = MATCH_RULES_SCHEMA(
+                    user_input.get(CONF_MATCH_RULES) or []
                 )
+            except vol.Invalid:
+                errors["base"] = "invalid_match_rules"
+            for key, (schema, error) in _RULE_FIELDS.items():
+                try:
+                    self._rules[key] = schema(user_input.get(key) or {})
+                except vol.Invalid:
+                    errors["base"] = error
 
-                # Re-publish into hass.data so the runtime resolution
-                # picks up changes without a restart. The actual entity
-                # set is rebuilt in `async_setup_entry` /
-                # `async_reload_entry`; we rebuild it here too so
-                # WebSocket subscribers see the new filter immediately.
-                if DOMAIN in self.hass.data:
-                    from . import _resolve_filter  # local import: avoid cycle
-                    resolved = _resolve_filter(
+            if not errors:
+                try:
+                    current = await async_load_entities(self.hass)
+                    await async_save_entities(
                         self.hass,
-                        areas=self._areas,
-                        devices=self._devices,
-                        entities=self._entities,
+                        {
+                            CONF_ENTITIES: self._entities,
+                            CONF_AREAS: self._areas,
+                            CONF_DEVICES: self._devices,
+                            CONF_MATCH_RULES: self._match_rules,
+                            CONF_PROFILES: current.get(CONF_PROFILES, {}),
+                            **self._rules,
+                        },
                     )
-                    self.hass.data[DOMAIN]["entities"] = list(resolved)
-                    self.hass.data[DOMAIN]["areas"] = self._areas
-                    self.hass.data[DOMAIN]["devices"] = self._devices
 
-                return await self.async_step_success()
-            except Exception:
-                _LOGGER.exception("Error in options flow")
-                errors["base"] = "unknown"
+                    # Re-publish into hass.data so the runtime resolution
+                    # picks up changes without a restart. The index resolves
+                    # the new picks from its registry indexes and pushes the
+                    # delta to connected WebSocket subscribers immediately.
+                    if DOMAIN in self.hass.data:
+                        self.hass.data[DOMAIN]["index"].async_set_selection(
+                            areas=self._areas,
+                            devices=self._devices,
+                            entities=self._entities,
+                            match_rules=self._match_rules,
+                        )
+                        hub = self.hass.data[DOMAIN]["hub"]
+                        hub.async_set_attribute_rules(self._rules[CONF_ATTRIBUTE_RULES])
+                        hub.async_set_throttle_rules(self._rules[CONF_THROTTLE_RULES])
+
+                    return await self.async_step_success()
+                except Exception:
+                    _LOGGER.exception("Error in options flow")
+                    errors["base"] = "unknown"
 
         # Load currently-stored selections so the form pre-fills with
         # what the user picked last time.
         current = await async_load_entities(self.hass)
         return self.async_show_form(
-            step_id="init",
+            step_id="selection",
             data_schema=_selector_schema(
                 default_entities=list(current.get(CONF_ENTITIES, [])),
                 default_areas=list(current.get(CONF_AREAS, [])),
                 default_devices=list(current.get(CONF_DEVICES, [])),
+                default_match_rules=list(current.get(CONF_MATCH_RULES) or []),
+                default_rules={
+                    key: dict(current.get(key) or {}) for key in _RULE_FIELDS
+                },
+            ),
+            errors=errors,
+        )
+
+    async def async_step_profile(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Pick a profile to edit, or name a new one."""
+        errors: dict[str, str] = {}
+        current = await async_load_entities(self.hass)
+        profiles = sorted(current.get(CONF_PROFILES) or {})
+
+        if user_input is not None:
+            try:
+                self._profile = PROFILE_NAME_SCHEMA(user_input[CONF_PROFILE])
+            except vol.Invalid:
+                errors["base"] = "invalid_profile_name"
+            else:
+                return await self.async_step_profile_selection()
+
+        return self.async_show_form(
+            step_id="profile",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(CONF_PROFILE): SelectSelector(
+                        SelectSelectorConfig(
+                            options=profiles,
+                            custom_value=True,
+                            mode=SelectSelectorMode.DROPDOWN,
+                        )
+                    ),
+                }
+            ),
+            errors=errors,
+        )
+
+    async def async_step_profile_selection(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Edit one profile's areas, devices and entities."""
+        errors: dict[str, str] = {}
+        current = await async_load_entities(self.hass)
+        profiles = dict(current.get(CONF_PROFILES) or {})
+
+        if user_input is not None:
+            try:
+                match_rules = MATCH_RULES_SCHEMA(
+                    user_input.get(CONF_MATCH_RULES) or []
+                )
+            except vol.Invalid:
+                errors["base"] = "invalid_match_rules"
+
+            if not errors:
+                try:
+                    picks = {
+                        CONF_ENTITIES: _filter_existing_entities(
+                            self.hass, user_input.get(CONF_ENTITIES, [])
+                        ),
+                        CONF_AREAS: list(user_input.get(CONF_AREAS, [])),
+                        CONF_DEVICES: list(user_input.get(CONF_DEVICES, [])),
+                        CONF_MATCH_RULES: match_rules,
+                    }
+                    profiles[self._profile] = picks
+                    await async_save_entities(
+                        self.hass, {**current, CONF_PROFILES: profiles}
+                    )
+                    # Applied live: the index resolves the profile and its
+                    # subscribers get the delta right away.
+                    if DOMAIN in self.hass.data:
+                        self.hass.data[DOMAIN]["index"].async_set_selection(
+                            profile=self._profile, **picks
+                        )
+                    return self.async_create_entry(
+                        title="", data=dict(self.config_entry.options)
+                    )
+                except Exception:
+                    _LOGGER.exception("Error saving profile %s", self._profile)
+                    errors["base"] = "unknown"
+
+        picks = profiles.get(self._profile) or {}
+        return self.async_show_form(
+            step_id="profile_selection",
+            data_schema=_selector_schema(
+                default_entities=list(picks.get(CONF_ENTITIES, [])),
+                default_areas=list(picks.get(CONF_AREAS, [])),
+                default_devices=list(picks.get(CONF_DEVICES, [])),
+                default_match_rules=list(picks.get(CONF_MATCH_RULES) or []),
             ),
+            description_placeholders={"profile": self._profile},
             errors=errors,
         )
 
+    async def async_step_delete_profile(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Delete named profiles; their clients see every entity leave."""
+        current = await async_load_entities(self.hass)
+        profiles = dict(current.get(CONF_PROFILES) or {})
+
+        if user_input is not None:
+            doomed = user_input.get(CONF_PROFILES, [])
+            for name in doomed:
+                profiles.pop(name, None)
+            await async_save_entities(self.hass, {**current, CONF_PROFILES: profiles})
+            if DOMAIN in self.hass.data:
+                for name in doomed:
+                    self.hass.data[DOMAIN]["index"].async_remove_profile(name)
+            return self.async_create_entry(
+                title="", data=dict(self.config_entry.options)
+            )
+
+        return self.async_show_form(
+            step_id="delete_profile",
+            data_schema=vol.Schema(
+                {
+                    vol.Optional(CONF_PROFILES, default=[]): SelectSelector(
+                        SelectSelectorConfig(options=sorted(profiles), multiple=True)
+                    ),
+                }
+            ),
+        )
+
     async def async_step_success(
         self, user_input: dict[str, Any] | None = None
     ) -> FlowResult:
@@ -3,15 +3,147 @@
 DOMAIN = "couch_control"
 STORAGE_KEY = "couch_control"
 STORAGE_VERSION = 1
+# Seconds of quiet after the last edit before the selections are
+# written; bursts of edits collapse into one write.
+SAVE_DELAY = 10
+
+# hass.data key for the subscription hub. Kept outside hass.data[DOMAIN]
+# so subscriptions survive an entry reload.
+DATA_HUB = f"{DOMAIN}_hub"
 
 CONF_ENTITIES = "entities"
 CONF_AREAS = "areas"
 CONF_DEVICES = "devices"
 CONF_FILTER_MODE = "filter_mode"
+CONF_ATTRIBUTE_RULES = "attribute_rules"
+CONF_THROTTLE_RULES = "throttle_rules"
+CONF_MATCH_RULES = "match_rules"
+CONF_PROFILES = "profiles"
+CONF_PROFILE = "profile"
+
+# Name of the top-level selection, the one clients get when they don't
+# ask for a profile.
+DEFAULT_PROFILE = "default"
 
 FILTER_MODE_INCLUDE = "include"
 FILTER_MODE_EXCLUDE = "exclude"
 
 WS_TYPE_SUBSCRIBE_FILTERED = f"{DOMAIN}/subscribe_filtered"
 WS_TYPE_GET_ENTITIES = f"{DOMAIN}/get_entities"
-WS_TYPE_UPDATE_ENTITIES = f"{DOMAIN}/update_entities"
\ No newline at end of file
+WS_TYPE_UPDATE_ENTITIES = f"{DOMAIN}/update_entities"
+WS_TYPE_PATCH_ENTITIES = f"{DOMAIN}/patch_entities"
+WS_TYPE_GET_HISTORY = f"{DOMAIN}/get_history"
+# Compact ("diff") subscription format. Key names mirror HA core's
+# `subscribe_entities` so clients that already speak that protocol can
+# reuse their decoder.
+ENTITY_EVENT_ADD = "a"
+ENTITY_EVENT_REMOVE = "r"
+ENTITY_EVENT_CHANGE = "c"
+
+COMPRESSED_STATE_STATE = "s"
+COMPRESSED_STATE_ATTRIBUTES = "a"
+COMPRESSED_STATE_CONTEXT = "c"
+COMPRESSED_STATE_LAST_CHANGED = "lc"
+COMPRESSED_STATE_LAST_UPDATED = "lu"
+
+STATE_DIFF_ADDITIONS = "+"
+STATE_DIFF_REMOVALS = "-"
+
+# Per-subscription coalescing window (`coalesce_ms`) and the batch size
+# that forces an early flush.
+MAX_COALESCE_MS = 1000
+DEFAULT_MAX_BATCH = 100
+
+# With `telemetry_ms`, changes of these domains skip the telemetry batch
+# so a button press on the remote shows up right away. Clients can pass
+# their own list (domains and entity ids) as `interactive`.
+INTERACTIVE_DOMAINS = frozenset(
+    {
+        "alarm_control_panel",
+        "button",
+        "climate",
+        "cover",
+        "fan",
+        "humidifier",
+        "input_boolean",
+        "input_button",
+        "input_number",
+        "input_select",
+        "light",
+        "lock",
+        "media_player",
+        "number",
+        "remote",
+        "scene",
+        "script",
+        "select",
+        "siren",
+        "switch",
+        "vacuum",
+        "valve",
+        "water_heater",
+    }
+)
+MAX_TELEMETRY_MS = 10000
+
+# Backpressure: once this many messages wait in a connection's outgoing
+# queue, its subscriptions stop sending and keep only the latest state
+# per entity. HA drops clients that stay above 1024 for 5 s (or hit
+# 4096), so this sits well below. The held states go out once the
+# queue is back under the low-water mark, checked every poll interval.
+BACKPRESSURE_HIGH_WATER = 256
+BACKPRESSURE_LOW_WATER = 32
+BACKPRESSURE_POLL_INTERVAL = 0.25
+
+# Largest `chunk_size` a chunked `subscribe_filtered` snapshot accepts.
+# Small chunks are the point; the cap keeps a client from asking for
+# chunks so large that one WebSocket message again carries thousands of
+# states and blocks the event loop while it is encoded.
+MAX_SNAPSHOT_CHUNK = 500
+
+# Upper bound on entities held in the encoded-state cache. Sized for a
+# generous allow-list; least recently used entities fall out first.
+DEFAULT_STATE_CACHE_SIZE = 5000
+
+# Downsampled history: request defaults and limits, and how many
+# entities' raw points the cache keeps (least recently asked for fall
+# out first).
+DEFAULT_HISTORY_HOURS = 24
+MAX_HISTORY_HOURS = 168
+DEFAULT_HISTORY_BUCKETS = 96
+MAX_HISTORY_BUCKETS = 500
+MAX_HISTORY_ENTITIES = 50
+HISTORY_CACHE_SIZE = 200
+
+# Resized `entity_picture` images: largest edge a client may ask for,
+# JPEG quality, and the byte budgets of the memory and disk caches
+# (least recently used images go first). The disk cache lives in this
+# folder of the config directory.
+MAX_IMAGE_SIZE = 2048
+IMAGE_JPEG_QUALITY = 80
+IMAGE_MEMORY_CACHE_BYTES = 16 * 1024 * 1024
+IMAGE_DISK_CACHE_BYTES = 128 * 1024 * 1024
+IMAGE_CACHE_DIR = "couch_control_images"
+# How long clients may reuse a response before revalidating its ETag.
+IMAGE_BROWSER_CACHE_SECONDS = 300
+# Source downloads: seconds before giving up, and the largest accepted.
+IMAGE_FETCH_TIMEOUT = 10
+IMAGE_MAX_SOURCE_BYTES = 20 * 1024 * 1024
+
+# Largest page the entity listings hand out per request.
+MAX_PAGE_SIZE = 1000
+
+# REST responses below this many bytes are sent uncompressed; gzip
+# framing and CPU cost outweigh the savings on tiny bodies.
+COMPRESS_MIN_SIZE = 1024
+# Unpaged REST listings with more entities than this are streamed,
+# this many records per write.
+LISTING_CHUNK_SIZE = 250
+
+# Recent changes kept for `subscribe_filtered` resume. One record per
+# entity touched; a client further behind than this gets a snapshot.
+REPLAY_BUFFER_SIZE = 2048
+
+# Seconds after which a change held back by a deadband (with no
+# `min_interval`) is delivered anyway as the trailing update.
+THROTTLE_TRAILING_DELAY = 30
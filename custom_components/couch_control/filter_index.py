@@ -0,0 +1,527 @@
+"""Incremental area / device / entity filter resolution.
+
+The user's picks (areas, devices, explicit entity ids and match rules,
+see `matcher.py`) are resolved to a flat entity-id set. Instead of
+re-scanning the whole entity and device registry every time,
+`FilterIndex` keeps reverse indexes (area -> entities, device ->
+entities, device -> area, domain -> entities) built once at setup and
+then patched from registry update events. A registry change only
+re-evaluates the entities it touches, and entities newly assigned to a
+picked area, or newly matching a rule, show up without a reload.
+
+Besides the default selection the index holds any number of named
+profiles (one per TV or room), each with its own picks. They all
+resolve against the same registry indexes, so a registry change is
+indexed once and then only re-checked per profile.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from dataclasses import dataclass, field
+import logging
+from typing import Any
+
+from homeassistant.core import CALLBACK_TYPE, Event, HomeAssistant, callback
+from homeassistant.helpers import (
+    area_registry as ar,
+    device_registry as dr,
+    entity_registry as er,
+)
+
+import voluptuous as vol
+
+from .const import (
+    CONF_AREAS,
+    CONF_DEVICES,
+    CONF_ENTITIES,
+    CONF_MATCH_RULES,
+    CONF_PROFILES,
+    DEFAULT_PROFILE,
+)
+from .matcher import CompiledRules
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FilterSnapshot:
+    """One published version of the resolved allow-list.
+
+    Never mutated: every change builds a new snapshot with a higher
+    `generation` and swaps it into `hass.data[DOMAIN]["filter"]` in one
+    assignment, so a handler that grabbed it sees one consistent view
+    (ordered ids for responses, a frozenset for O(1) membership).
+    """
+
+    entities: tuple[str, ...]
+    generation: int
+    entity_set: frozenset[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        """Derive the lookup set from the ordered ids."""
+        object.__setattr__(self, "entity_set", frozenset(self.entities))
+
+    def __contains__(self, entity_id: object) -> bool:
+        """O(1) membership test."""
+        return entity_id in self.entity_set
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate entity ids in published order."""
+        return iter(self.entities)
+
+    def __len__(self) -> int:
+        """Return the number of allowed entities."""
+        return len(self.entities)
+
+
+class _Selection:
+    """One profile's picks and the entity ids they resolve to."""
+
+    __slots__ = (
+        "areas",
+        "devices",
+        "entities",
+        "area_set",
+        "device_set",
+        "explicit_set",
+        "match_rules",
+        "resolved",
+    )
+
+    def __init__(
+        self,
+        areas: Iterable[str],
+        devices: Iterable[str],
+        entities: Iterable[str],
+        match_rules: Iterable[Mapping[str, Any]] = (),
+    ) -> None:
+        """Initialize from picks; `resolved` is filled by the index."""
+        self.areas: list[str] = []
+        self.devices: list[str] = []
+        self.entities: list[str] = []
+        self.area_set: set[str] = set()
+        self.device_set: set[str] = set()
+        self.explicit_set: set[str] = set()
+        self.match_rules = CompiledRules()
+        self.update(areas, devices, entities, match_rules)
+        # A dict so the published list keeps a stable order (explicit
+        # picks first, then registry order).
+        self.resolved: dict[str, None] = {}
+
+    def update(
+        self,
+        areas: Iterable[str] | None,
+        devices: Iterable[str] | None,
+        entities: Iterable[str] | None,
+        match_rules: Iterable[Mapping[str, Any]] | None = None,
+    ) -> None:
+        """Replace the given picks; invalid match rules raise `vol.Invalid`."""
+        if match_rules is not None:
+            self.match_rules = CompiledRules(match_rules)
+        if areas is not None:
+            self.areas = list(areas)
+            self.area_set = set(self.areas)
+        if devices is not None:
+            self.devices = list(devices)
+            self.device_set = set(self.devices)
+        if entities is not None:
+            self.entities = list(entities)
+            self.explicit_set = set(self.entities)
+
+    def as_storage_data(self) -> dict[str, Any]:
+        """Return the picks in storage shape."""
+        return {
+            CONF_ENTITIES: list(self.entities),
+            CONF_AREAS: list(self.areas),
+            CONF_DEVICES: list(self.devices),
+            CONF_MATCH_RULES: list(self.match_rules.rules),
+        }
+
+
+class FilterIndex:
+    """Resolve filter picks to entity ids and keep the result current."""
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        *,
+        areas: Iterable[str],
+        devices: Iterable[str],
+        entities: Iterable[str],
+        match_rules: Iterable[Mapping[str, Any]] = (),
+        profiles: Mapping[str, Mapping[str, Any]] | None = None,
+        on_change: Callable[[str], None] | None = None,
+    ) -> None:
+        """Initialize the index; call `async_start` to populate it.
+
+        `profiles` maps profile names to storage-shaped picks;
+        `on_change` is called with the name of every profile whose
+        resolved set changed (`DEFAULT_PROFILE` for the default one).
+        """
+        self._hass = hass
+        self._on_change = on_change
+        self._selections: dict[str, _Selection] = {
+            DEFAULT_PROFILE: self._load_selection(
+                DEFAULT_PROFILE,
+                {
+                    CONF_AREAS: areas,
+                    CONF_DEVICES: devices,
+                    CONF_ENTITIES: entities,
+                    CONF_MATCH_RULES: match_rules,
+                },
+            )
+        }
+        for name, picks in (profiles or {}).items():
+            self._selections[name] = self._load_selection(name, picks)
+
+        # Registry-derived indexes.
+        self._entity_device: dict[str, str | None] = {}
+        self._entity_own_area: dict[str, str | None] = {}
+        self._entity_area: dict[str, str | None] = {}
+        self._disabled: set[str] = set()
+        self._device_area: dict[str, str | None] = {}
+        # Buckets are dicts, not sets, so picked devices and areas
+        # resolve in registry order and the published list (and the
+        # cursors paging through it) is stable across restarts.
+        self._device_entities: dict[str, dict[str, None]] = {}
+        self._area_entities: dict[str, dict[str, None]] = {}
+        # What match rules look at. Domain buckets are dicts for the
+        # same reason (by domain, then registry order).
+        self._entity_device_class: dict[str, str | None] = {}
+        self._entity_labels: dict[str, frozenset[str]] = {}
+        self._domain_entities: dict[str, dict[str, None]] = {}
+
+        self._unsubs: list[CALLBACK_TYPE] = []
+
+    @staticmethod
+    def _load_selection(name: str, picks: Mapping[str, Any]) -> _Selection:
+        """Build a stored selection, dropping match rules that don't validate."""
+        try:
+            return _Selection(
+                picks.get(CONF_AREAS, []),
+                picks.get(CONF_DEVICES, []),
+                picks.get(CONF_ENTITIES, []),
+                picks.get(CONF_MATCH_RULES) or [],
+            )
+        except vol.Invalid:
+            _LOGGER.exception("Ignoring invalid stored match rules of %s", name)
+            return _Selection(
+                picks.get(CONF_AREAS, []),
+                picks.get(CONF_DEVICES, []),
+                picks.get(CONF_ENTITIES, []),
+            )
+
+    @property
+    def areas(self) -> list[str]:
+        """Area picks of the default selection."""
+        return self._selections[DEFAULT_PROFILE].areas
+
+    @property
+    def devices(self) -> list[str]:
+        """Device picks of the default selection."""
+        return self._selections[DEFAULT_PROFILE].devices
+
+    @property
+    def entities(self) -> list[str]:
+        """Explicit entity picks of the default selection."""
+        return self._selections[DEFAULT_PROFILE].entities
+
+    @property
+    def match_rules(self) -> list[dict[str, list[str]]]:
+        """Match rules of the default selection."""
+        return self._selections[DEFAULT_PROFILE].match_rules.rules
+
+    @property
+    def resolved(self) -> list[str]:
+        """Current resolved entity ids of the default selection."""
+        return list(self._selections[DEFAULT_PROFILE].resolved)
+
+    @property
+    def profiles(self) -> list[str]:
+        """Names of the named profiles (not the default selection)."""
+        return [name for name in self._selections if name != DEFAULT_PROFILE]
+
+    def profile_resolved(self, profile: str) -> list[str]:
+        """Current resolved entity ids of a profile; empty if unknown."""
+        if (selection := self._selections.get(profile)) is None:
+            return []
+        return list(selection.resolved)
+
+    def profile_picks(self, profile: str) -> dict[str, Any] | None:
+        """A profile's picks in storage shape, or None if unknown."""
+        if (selection := self._selections.get(profile)) is None:
+            return None
+        return selection.as_storage_data()
+
+    def as_storage_data(self) -> dict[str, Any]:
+        """Return the picks in the shape persisted by `storage.py`."""
+        data: dict[str, Any] = self._selections[DEFAULT_PROFILE].as_storage_data()
+        data[CONF_PROFILES] = {
+            name: selection.as_storage_data()
+            for name, selection in self._selections.items()
+            if name != DEFAULT_PROFILE
+        }
+        return data
+
+    @callback
+    def async_start(self) -> None:
+        """Build the indexes with one registry pass and start listening."""
+        ent_reg = er.async_get(self._hass)
+        dev_reg = dr.async_get(self._hass)
+
+        for device in dev_reg.devices.values():
+            self._device_area[device.id] = device.area_id
+        for entry in ent_reg.entities.values():
+            self._index_entity(entry)
+
+        for selection in self._selections.values():
+            selection.resolved = self._compute_resolved(selection)
+
+        bus = self._hass.bus
+        self._unsubs = [
+            bus.async_listen(
+                er.EVENT_ENTITY_REGISTRY_UPDATED, self._async_entity_registry_updated
+            ),
+            bus.async_listen(
+                dr.EVENT_DEVICE_REGISTRY_UPDATED, self._async_device_registry_updated
+            ),
+            bus.async_listen(
+                ar.EVENT_AREA_REGISTRY_UPDATED, self._async_area_registry_updated
+            ),
+        ]
+
+    @callback
+    def async_stop(self) -> None:
+        """Stop following registry changes."""
+        for unsub in self._unsubs:
+            unsub()
+        self._unsubs = []
+
+    @callback
+    def async_set_selection(
+        self,
+        *,
+        areas: Iterable[str] | None = None,
+        devices: Iterable[str] | None = None,
+        entities: Iterable[str] | None = None,
+        match_rules: Iterable[Mapping[str, Any]] | None = None,
+        profile: str = DEFAULT_PROFILE,
+    ) -> None:
+        """Replace some or all of a profile's picks and re-resolve it.
+
+        An unknown profile is created; invalid match rules raise
+        `vol.Invalid` before anything changes. Cost is proportional to
+        the entities in the picked areas and devices and in the
+        domains the rules name, not to the size of the registry.
+        """
+        if match_rules is not None:
+            match_rules = CompiledRules(match_rules).rules
+        if (selection := self._selections.get(profile)) is None:
+            selection = self._selections[profile] = _Selection((), (), ())
+        selection.update(areas, devices, entities, match_rules)
+
+        resolved = self._compute_resolved(selection)
+        if resolved.keys() != selection.resolved.keys():
+            selection.resolved = resolved
+            self._async_notify([profile])
+        else:
+            selection.resolved = resolved
+
+    @callback
+    def async_remove_profile(self, profile: str) -> None:
+        """Delete a named profile; the owner sees it resolve to nothing."""
+        if profile == DEFAULT_PROFILE or self._selections.pop(profile, None) is None:
+            return
+        self._async_notify([profile])
+
+    def _compute_resolved(self, selection: _Selection) -> dict[str, None]:
+        """Union the explicit picks with the picked area / device buckets."""
+        resolved = dict.fromkeys(selection.entities)
+        for device_id in selection.devices:
+            for entity_id in self._device_entities.get(device_id, ()):
+                if entity_id not in self._disabled:
+                    resolved[entity_id] = None
+        for area_id in selection.areas:
+            for entity_id in self._area_entities.get(area_id, ()):
+                if entity_id not in self._disabled:
+                    resolved[entity_id] = None
+        if rules := selection.match_rules:
+            # Rules that pin their domains only scan those buckets.
+            if (domains := rules.domains) is None:
+                candidates: Iterable[str] = self._entity_device
+            else:
+                candidates = (
+                    entity_id
+                    for domain in sorted(domains)
+                    for entity_id in self._domain_entities.get(domain, ())
+                )
+            for entity_id in candidates:
+                if entity_id not in self._disabled and self._matches(
+                    rules, entity_id
+                ):
+                    resolved[entity_id] = None
+        return resolved
+
+    def _matches(self, rules: CompiledRules, entity_id: str) -> bool:
+        """Check one indexed entity against a selection's match rules."""
+        return rules.matches(
+            entity_id,
+            self._entity_device_class.get(entity_id),
+            self._entity_labels.get(entity_id, frozenset()),
+        )
+
+    def _index_entity(self, entry: er.RegistryEntry) -> None:
+        """Add one registry entry to the indexes."""
+        entity_id = entry.entity_id
+        device_id = entry.device_id
+        self._entity_device[entity_id] = device_id
+        self._entity_own_area[entity_id] = entry.area_id
+        if entry.disabled:
+            self._disabled.add(entity_id)
+        self._entity_device_class[entity_id] = (
+            entry.device_class or entry.original_device_class
+        )
+        # Labels arrived in HA 2024.4.
+        self._entity_labels[entity_id] = frozenset(getattr(entry, "labels", ()))
+        self._domain_entities.setdefault(entry.domain, {})[entity_id] = None
+        if device_id:
+            self._device_entities.setdefault(device_id, {})[entity_id] = None
+        self._set_entity_area(entity_id)
+
+    def _unindex_entity(self, entity_id: str) -> None:
+        """Remove one entity from the indexes."""
+        device_id = self._entity_device.pop(entity_id, None)
+        self._entity_own_area.pop(entity_id, None)
+        self._disabled.discard(entity_id)
+        self._entity_device_class.pop(entity_id, None)
+        self._entity_labels.pop(entity_id, None)
+        domain = entity_id.partition(".")[0]
+        if (domain_bucket := self._domain_entities.get(domain)) is not None:
+            domain_bucket.pop(entity_id, None)
+            if not domain_bucket:
+                del self._domain_entities[domain]
+        if device_id and (bucket := self._device_entities.get(device_id)):
+            bucket.pop(entity_id, None)
+            if not bucket:
+                del self._device_entities[device_id]
+        area_id = self._entity_area.pop(entity_id, None)
+        if area_id and (bucket := self._area_entities.get(area_id)):
+            bucket.pop(entity_id, None)
+            if not bucket:
+                del self._area_entities[area_id]
+
+    def _set_entity_area(self, entity_id: str) -> None:
+        """(Re)compute an entity's effective area: its own, or its device's."""
+        device_id = self._entity_device.get(entity_id)
+        area_id = self._entity_own_area.get(entity_id) or (
+            self._device_area.get(device_id) if device_id else None
+        )
+        old_area = self._entity_area.get(entity_id)
+        if old_area == area_id and entity_id in self._entity_area:
+            return
+        if old_area and (bucket := self._area_entities.get(old_area)):
+            bucket.pop(entity_id, None)
+            if not bucket:
+                del self._area_entities[old_area]
+        self._entity_area[entity_id] = area_id
+        if area_id:
+            self._area_entities.setdefault(area_id, {})[entity_id] = None
+
+    def selected_by_pick(
+        self, entity_id: str, profile: str = DEFAULT_PROFILE
+    ) -> bool:
+        """Whether a pick or match rule (not an explicit id) includes it."""
+        if entity_id not in self._entity_device or entity_id in self._disabled:
+            return False
+        selection = self._selections[profile]
+        device_id = self._entity_device[entity_id]
+        if device_id and device_id in selection.device_set:
+            return True
+        area_id = self._entity_area.get(entity_id)
+        if area_id and area_id in selection.area_set:
+            return True
+        return bool(selection.match_rules) and self._matches(
+            selection.match_rules, entity_id
+        )
+
+    def _update_membership(self, entity_ids: Iterable[str]) -> list[str]:
+        """Re-evaluate only the given entities; return the profiles that moved."""
+        entity_ids = list(entity_ids)
+        changed = []
+        for profile, selection in self._selections.items():
+            moved = False
+            for entity_id in entity_ids:
+                selected = entity_id in selection.explicit_set or self.selected_by_pick(
+                    entity_id, profile
+                )
+                if selected and entity_id not in selection.resolved:
+                    selection.resolved[entity_id] = None
+                    moved = True
+                elif not selected and entity_id in selection.resolved:
+                    del selection.resolved[entity_id]
+                    moved = True
+            if moved:
+                changed.append(profile)
+        return changed
+
+    @callback
+    def _async_notify(self, profiles: Iterable[str]) -> None:
+        """Tell the owner which profiles' resolved sets changed."""
+        if self._on_change is not None:
+            for profile in profiles:
+                self._on_change(profile)
+
+    @callback
+    def _async_entity_registry_updated(self, event: Event) -> None:
+        """Re-index the single entity that was created, updated or removed."""
+        entity_id = event.data["entity_id"]
+        touched = [entity_id]
+        if old_entity_id := event.data.get("old_entity_id"):
+            self._unindex_entity(old_entity_id)
+            touched.append(old_entity_id)
+
+        self._unindex_entity(entity_id)
+        if event.data["action"] != "remove":
+            entry = er.async_get(self._hass).async_get(entity_id)
+            if entry is not None:
+                self._index_entity(entry)
+
+        if changed := self._update_membership(touched):
+            self._async_notify(changed)
+
+    @callback
+    def _async_device_registry_updated(self, event: Event) -> None:
+        """Track device area moves and re-evaluate that device's entities."""
+        device_id = event.data["device_id"]
+        if event.data["action"] == "remove":
+            self._device_area.pop(device_id, None)
+            return
+
+        device = dr.async_get(self._hass).async_get(device_id)
+        area_id = device.area_id if device else None
+        if self._device_area.get(device_id) == area_id and device_id in self._device_area:
+            return
+        self._device_area[device_id] = area_id
+
+        entity_ids = self._device_entities.get(device_id, {})
+        for entity_id in entity_ids:
+            self._set_entity_area(entity_id)
+        if changed := self._update_membership(entity_ids):
+            self._async_notify(changed)
+
+    @callback
+    def _async_area_registry_updated(self, event: Event) -> None:
+        """Drop the bucket of a deleted area.
+
+        HA also clears `area_id` on the area's devices and entities,
+        which arrives as separate registry events; this just makes sure
+        a picked-but-deleted area can't keep stale members around.
+        """
+        if event.data["action"] != "remove":
+            return
+        area_id = event.data["area_id"]
+        entity_ids = self._area_entities.pop(area_id, {})
+        for entity_id in entity_ids:
+            self._entity_area[entity_id] = None
+        if changed := self._update_membership(entity_ids):
+            self._async_notify(changed)
@@ -0,0 +1,330 @@
+"""Downsampled state history for widget sparklines.
+
+Clients drawing a 24-hour sparkline used to pull HA's generic history
+for every sensor: thousands of raw points per entity, fetched again on
+every refresh. `couch_control/get_history` and
+`GET /api/couch_control/history` answer for many entities in one call
+with fixed-width buckets of min / max / time-weighted mean, ready to
+draw.
+
+Raw points come from the recorder once per entity and then live in the
+hub's `HistoryCache`, an LRU of `HISTORY_CACHE_SIZE` entities. The hub
+already tracks every allowed entity and appends each change, so a
+refresh only re-buckets points in memory. Entities that leave the
+allow-list are dropped from the cache, since nothing would keep their
+points current any more.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict, deque
+from collections.abc import Iterable
+from functools import partial
+import math
+import time
+from typing import TYPE_CHECKING, Any
+
+from homeassistant.const import COMPRESSED_STATE_LAST_UPDATED, COMPRESSED_STATE_STATE
+from homeassistant.core import Event, HomeAssistant, State, callback
+from homeassistant.util import dt as dt_util
+
+from .const import HISTORY_CACHE_SIZE
+from .filter_index import FilterSnapshot
+
+if TYPE_CHECKING:
+    from .hub import CouchControlHub
+
+# (timestamp, value; None while the state isn't a number)
+Point = tuple[float, float | None]
+
+
+class RecorderUnavailable(Exception):
+    """The recorder isn't running, so there is no history to read."""
+
+
+def _value(state: str) -> float | None:
+    """Return a state as a finite float, or None."""
+    try:
+        value = float(state)
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+class _Series:
+    """Raw points of one entity, covering the last `span` seconds."""
+
+    __slots__ = ("span", "points", "loading")
+
+    def __init__(self, span: float) -> None:
+        """Initialize empty; the recorder fills it."""
+        self.span = span
+        self.points: deque[Point] = deque()
+        # Set while the recorder query runs; live points collect meanwhile.
+        self.loading: asyncio.Future[None] | None = None
+
+    def append(self, timestamp: float, value: float | None, now: float) -> None:
+        """Add the newest point and drop what fell out of the span."""
+        if self.points and timestamp < self.points[-1][0]:
+            return
+        self.points.append((timestamp, value))
+        self.trim(now)
+
+    def trim(self, now: float) -> None:
+        """Drop points before the span, except the value at its start."""
+        cutoff = now - self.span
+        points = self.points
+        while len(points) > 1 and points[1][0] <= cutoff:
+            points.popleft()
+
+
+class HistoryCache:
+    """LRU of raw history points per entity, extended from live changes."""
+
+    def __init__(self, max_entities: int = HISTORY_CACHE_SIZE) -> None:
+        """Initialize an empty cache."""
+        self._series: OrderedDict[str, _Series] = OrderedDict()
+        self._max_entities = max_entities
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached entities."""
+        return len(self._series)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters for the metrics view."""
+        return {
+            "entities": len(self._series),
+            "points": sum(len(series.points) for series in self._series.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @callback
+    def async_on_state_changed(self, event: Event) -> None:
+        """Append a live change to its entity's series, if cached."""
+        entity_id = event.data["entity_id"]
+        if (series := self._series.get(entity_id)) is None:
+            return
+        new_state: State | None = event.data.get("new_state")
+        if new_state is None:
+            del self._series[entity_id]
+            return
+        old_state: State | None = event.data.get("old_state")
+        if old_state is not None and old_state.state == new_state.state:
+            # Attribute-only change; the series only follows the state.
+            return
+        series.append(
+            new_state.last_changed.timestamp(), _value(new_state.state), time.time()
+        )
+
+    @callback
+    def async_forget(self, entity_ids: Iterable[str]) -> None:
+        """Drop entities whose changes are no longer tracked."""
+        for entity_id in entity_ids:
+            self._series.pop(entity_id, None)
+
+    @callback
+    def async_clear(self) -> None:
+        """Drop everything; changes stop arriving while the hub is stopped."""
+        self._series.clear()
+
+    async def async_get_points(
+        self, hass: HomeAssistant, entity_ids: list[str], hours: int
+    ) -> dict[str, deque[Point]]:
+        """Return raw points covering the last `hours` for each entity.
+
+        Entities not cached (or cached for a shorter span) are fetched
+        from the recorder in one query; concurrent requests for the
+        same entities share it.
+        """
+        span = hours * 3600
+        series_by_entity: dict[str, _Series] = {}
+        missing: list[str] = []
+        waits: set[asyncio.Future[None]] = set()
+        for entity_id in entity_ids:
+            series = self._series.get(entity_id)
+            if series is not None and series.span >= span:
+                self.hits += 1
+                self._series.move_to_end(entity_id)
+                if series.loading is not None:
+                    waits.add(series.loading)
+            else:
+                self.misses += 1
+                series = self._series[entity_id] = _Series(span)
+                self._series.move_to_end(entity_id)
+                missing.append(entity_id)
+            series_by_entity[entity_id] = series
+        while len(self._series) > self._max_entities:
+            self._series.popitem(last=False)
+
+        if missing:
+            loading: asyncio.Future[None] = hass.loop.create_future()
+            for entity_id in missing:
+                series_by_entity[entity_id].loading = loading
+            try:
+                fetched = await _async_fetch(hass, missing, time.time() - span)
+            except BaseException:
+                for entity_id in missing:
+                    if self._series.get(entity_id) is series_by_entity[entity_id]:
+                        del self._series[entity_id]
+                raise
+            finally:
+                loading.set_result(None)
+            now = time.time()
+            for entity_id in missing:
+                self._merge(
+                    hass,
+                    entity_id,
+                    series_by_entity[entity_id],
+                    fetched.get(entity_id, []),
+                    now,
+                )
+        if waits:
+            await asyncio.gather(*waits)
+        return {
+            entity_id: series.points for entity_id, series in series_by_entity.items()
+        }
+
+    @staticmethod
+    def _merge(
+        hass: HomeAssistant,
+        entity_id: str,
+        series: _Series,
+        fetched: list[Point],
+        now: float,
+    ) -> None:
+        """Put recorder points in front of the live ones that arrived meanwhile."""
+        points: deque[Point] = deque(fetched)
+        newest = points[-1][0] if points else 0.0
+        points.extend(point for point in series.points if point[0] > newest)
+        # The recorder commits every second or so; a change it hadn't
+        # written yet and that came before the query is the live state.
+        if (state := hass.states.get(entity_id)) is not None and (
+            changed := state.last_changed.timestamp()
+        ) > (points[-1][0] if points else 0.0):
+            points.append((changed, _value(state.state)))
+        series.points = points
+        series.loading = None
+        series.trim(now)
+
+
+async def _async_fetch(
+    hass: HomeAssistant, entity_ids: list[str], start: float
+) -> dict[str, list[Point]]:
+    """Read state changes since `start` from the recorder."""
+    if "recorder" not in hass.config.components:
+        raise RecorderUnavailable("The recorder is not running")
+    # Imported here: the recorder is optional, and importing it pulls
+    # in SQLAlchemy for installs that never ask for history.
+    from homeassistant.components.recorder import (
+        get_instance,
+        history,
+    )
+    states = await get_instance(hass).async_add_executor_job(
+        partial(
+            history.get_significant_states,
+            hass,
+            dt_util.utc_from_timestamp(start),
+            entity_ids=entity_ids,
+            significant_changes_only=False,
+            minimal_response=True,
+            no_attributes=True,
+            compressed_state_format=True,
+        )
+    )
+    return {
+        entity_id: [_point(item) for item in items]
+        for entity_id, items in states.items()
+    }
+
+
+def _point(item: State | dict[str, Any]) -> Point:
+    """Turn one recorder row (compressed dict or State) into a point."""
+    if isinstance(item, State):
+        return item.last_updated.timestamp(), _value(item.state)
+    return item[COMPRESSED_STATE_LAST_UPDATED], _value(item[COMPRESSED_STATE_STATE])
+
+
+def downsample(
+    points: Iterable[Point], start: float, end: float, buckets: int
+) -> dict[str, list[float | None]]:
+    """Bucket points into `buckets` equal slices of [start, end).
+
+    A state holds until the next one, so every value counts in each
+    bucket it was in effect for and the mean is weighted by time.
+    Buckets without any numeric value are None.
+    """
+    width = (end - start) / buckets
+    mins: list[float | None] = [None] * buckets
+    maxs: list[float | None] = [None] * buckets
+    sums = [0.0] * buckets
+    covered = [0.0] * buckets
+    points = list(points)
+    for index, (timestamp, value) in enumerate(points):
+        seg_start = max(timestamp, start)
+        if seg_start >= end:
+            break
+        seg_end = min(
+            points[index + 1][0] if index + 1 < len(points) else end, end
+        )
+        if value is None or (seg_end <= seg_start and timestamp < start):
+            continue
+        first = int((seg_start - start) // width)
+        last = max(first, min(int((seg_end - start) // width), buckets - 1))
+        for bucket in range(first, last + 1):
+            bucket_start = start + bucket * width
+            overlap = min(seg_end, bucket_start + width) - max(seg_start, bucket_start)
+            if overlap <= 0 and bucket != first:
+                # Ends exactly on this bucket's start boundary.
+                continue
+            if mins[bucket] is None or value < mins[bucket]:
+                mins[bucket] = value
+            if maxs[bucket] is None or value > maxs[bucket]:
+                maxs[bucket] = value
+            if overlap > 0:
+                sums[bucket] += value * overlap
+                covered[bucket] += overlap
+    means = [
+        round(sums[bucket] / covered[bucket], 3) if covered[bucket] else mins[bucket]
+        for bucket in range(buckets)
+    ]
+    return {"min": mins, "max": maxs, "mean": means}
+
+
+async def async_get_history(
+    hass: HomeAssistant,
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    entity_ids: Iterable[str],
+    *,
+    hours: int,
+    buckets: int,
+) -> dict[str, Any]:
+    """Build the history response shared by the WebSocket and REST APIs.
+
+    Entities outside the allow-list are listed under `invalid` instead
+    of being looked up. Raises `RecorderUnavailable`.
+    """
+    requested = list(dict.fromkeys(entity_ids))
+    valid = [entity_id for entity_id in requested if entity_id in allowed]
+    invalid = [entity_id for entity_id in requested if entity_id not in allowed]
+    started = time.perf_counter()
+    points = await hub.history.async_get_points(hass, valid, hours)
+    end = time.time()
+    start = end - hours * 3600
+    series = {
+        entity_id: downsample(points[entity_id], start, end, buckets)
+        for entity_id in valid
+    }
+    hub.metrics.count("history_requests")
+    hub.metrics.observe("history_ms", (time.perf_counter() - started) * 1000)
+    return {
+        "start": round(start, 3),
+        "end": round(end, 3),
+        "bucket_seconds": hours * 3600 / buckets,
+        "series": series,
+        "invalid": invalid,
+    }
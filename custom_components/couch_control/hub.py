@@ -0,0 +1,573 @@
+"""Shared fan-out hub for Couch Control filtered subscriptions.
+
+One hub per HA instance tracks the allow-list with a single
+`async_track_state_change_event` and serializes each change at most
+once per wire format. Every `subscribe_filtered` connection registers
+with the hub instead of running its own tracker, so four Apple TVs
+and two iPads cost one filter pass and one JSON encode per change
+instead of six.
+
+Named profiles publish their own allow-lists through the same hub: it
+tracks the union of all of them once, and each subscriber only hears
+about the entities of the profile it subscribed to.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Mapping
+from datetime import datetime
+import logging
+import time
+from typing import Any, Protocol
+import uuid
+
+from homeassistant.core import CALLBACK_TYPE, Event, HomeAssistant, State, callback
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.event import async_track_state_change_event
+from homeassistant.helpers.json import JSON_DUMP
+
+from .attribute_filter import AttributeFilter
+from .cache import StateCache
+from .const import (
+    DATA_HUB,
+    DEFAULT_PROFILE,
+    DOMAIN,
+    ENTITY_EVENT_ADD,
+    ENTITY_EVENT_REMOVE,
+)
+from .filter_index import FilterSnapshot
+from .history import HistoryCache
+from .intern import InternTable
+from .metrics import Metrics
+from .replay import ReplayBuffer
+from .throttle import Throttle
+from .serialization import compact_event
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class StateChange:
+    """A single filtered state change, encoded lazily and only once.
+
+    Subscribers share the same instance; whichever of them first asks
+    for a given format pays for the encode, everyone else reuses it.
+    """
+
+    __slots__ = (
+        "entity_id",
+        "old_state",
+        "new_state",
+        "origin",
+        "time_fired",
+        "seq",
+        "_cache",
+        "_ids",
+        "_full_json",
+        "_compact_payload",
+        "_compact_json",
+        "_interned_json",
+        "_compact_done",
+    )
+
+    def __init__(
+        self,
+        event: Event,
+        cache: StateCache,
+        seq: int,
+        ids: InternTable,
+        old_state: State | None,
+    ) -> None:
+        """Capture the parts of the event subscribers need.
+
+        `old_state` is what subscribers last received, which differs
+        from the event's when throttling held intermediate states back.
+        """
+        self.entity_id: str = event.data["entity_id"]
+        self.old_state = old_state
+        self.new_state: State | None = event.data.get("new_state")
+        self.origin = event.origin
+        self.time_fired = event.time_fired
+        self.seq = seq
+        self._cache = cache
+        self._ids = ids
+        self._full_json: str | None = None
+        self._compact_payload: dict[str, Any] | None = None
+        self._compact_json: str | None = None
+        self._interned_json: str | None = None
+        self._compact_done = False
+
+    @property
+    def full_json(self) -> str:
+        """Full `state_changed` event payload, JSON encoded.
+
+        Assembled from cached state fragments: the `old_state` was
+        usually encoded as the previous change's `new_state`.
+        """
+        if self._full_json is None:
+            self._full_json = full_event_json(
+                self._cache,
+                self.entity_id,
+                self.old_state,
+                self.new_state,
+                origin=self.origin,
+                time_fired=self.time_fired,
+                seq=self.seq,
+            )
+        return self._full_json
+
+    @property
+    def compact_payload(self) -> dict[str, Any] | None:
+        """Compact diff payload; None if nothing visible changed."""
+        if not self._compact_done:
+            self._compact_payload = compact_event(
+                self.entity_id,
+                self.old_state,
+                self.new_state,
+                self._cache.attribute_filter,
+            )
+            self._compact_done = True
+        return self._compact_payload
+
+    @property
+    def compact_json(self) -> str | None:
+        """Compact diff payload, JSON encoded."""
+        if self._compact_json is None and (payload := self.compact_payload):
+            self._compact_json = JSON_DUMP({**payload, "seq": self.seq})
+        return self._compact_json
+
+    @property
+    def compact_interned_json(self) -> str | None:
+        """Compact diff payload keyed by entity index, JSON encoded."""
+        if self._interned_json is None and (payload := self.compact_payload):
+            self._interned_json = JSON_DUMP(
+                {**self._ids.intern_payload(payload), "seq": self.seq}
+            )
+        return self._interned_json
+
+
+def full_event_json(
+    cache: StateCache,
+    entity_id: str,
+    old_state: State | None,
+    new_state: State | None,
+    *,
+    origin: Any,
+    time_fired: datetime,
+    seq: int,
+) -> str:
+    """Encode a full `state_changed` event from cached state fragments.
+
+    Same shape as the events HA core's `subscribe_events` sends, with
+    both states in `serialization.state_to_dict` form.
+    """
+    old_json = cache.state_json(old_state) if old_state else "null"
+    new_json = cache.state_json(new_state) if new_state else "null"
+    return (
+        '{"event_type":"state_changed","data":{'
+        f'"entity_id":{JSON_DUMP(entity_id)},'
+        f'"old_state":{old_json},"new_state":{new_json}}},'
+        f'"origin":{JSON_DUMP(origin)},'
+        f'"time_fired":{JSON_DUMP(time_fired.isoformat())},"seq":{seq}}}'
+    )
+
+
+class FilterChange:
+    """Entities that joined or left the allow-list, encoded lazily once.
+
+    Added entities carry their current state so clients can render them
+    without re-downloading the snapshot; removed ones are just ids.
+    """
+
+    __slots__ = (
+        "added",
+        "removed",
+        "generation",
+        "seq",
+        "_states",
+        "_full_json",
+        "_compact_json",
+        "_interned_json",
+    )
+
+    def __init__(
+        self,
+        visible_state: Callable[[str], State | None],
+        added: list[str],
+        removed: list[str],
+        generation: int,
+        seq: int,
+    ) -> None:
+        """Capture the delta and the state subscribers hold for added entities.
+
+        `visible_state` is the hub's: an entity the throttle is holding
+        back for another profile must join at the state its next
+        trailing diff applies to, not the live one.
+        """
+        self.added = added
+        self.removed = removed
+        self.generation = generation
+        self.seq = seq
+        self._states = [
+            state for entity_id in added if (state := visible_state(entity_id))
+        ]
+        self._full_json: str | None = None
+        self._compact_json: str | None = None
+        self._interned_json: str | None = None
+
+    def full_json(self, cache: StateCache) -> str:
+        """`filter_changed` event payload for full-format subscriptions."""
+        if self._full_json is None:
+            added = ",".join(cache.state_json(state) for state in self._states)
+            self._full_json = (
+                '{"event_type":"filter_changed","data":{'
+                f'"added":[{added}],"removed":{JSON_DUMP(self.removed)},'
+                f'"generation":{self.generation}}},"seq":{self.seq}}}'
+            )
+        return self._full_json
+
+    def compact_json(self, cache: StateCache) -> str:
+        """`a` / `r` payload for compact subscriptions."""
+        if self._compact_json is None:
+            parts = [f'"generation":{self.generation}', f'"seq":{self.seq}']
+            if self._states:
+                added = ",".join(
+                    cache.compressed_item_json(state) for state in self._states
+                )
+                parts.append(f'"{ENTITY_EVENT_ADD}":{{{added}}}')
+            if self.removed:
+                parts.append(f'"{ENTITY_EVENT_REMOVE}":{JSON_DUMP(self.removed)}')
+            self._compact_json = "{" + ",".join(parts) + "}"
+        return self._compact_json
+
+    def compact_interned_json(self, cache: StateCache, ids: InternTable) -> str:
+        """`a` / `r` payload keyed by entity index, plus new `ids` entries."""
+        if self._interned_json is None:
+            parts = [f'"generation":{self.generation}', f'"seq":{self.seq}']
+            if self.added:
+                # Stateless additions too: their first state comes later
+                # as a plain change keyed by index.
+                parts.append(f'"ids":{JSON_DUMP(ids.table(self.added))}')
+            if self._states:
+                added = ",".join(
+                    f'"{ids[state.entity_id]}":{cache.compressed_json(state)}'
+                    for state in self._states
+                )
+                parts.append(f'"{ENTITY_EVENT_ADD}":{{{added}}}')
+            if self.removed:
+                removed = [ids[entity_id] for entity_id in self.removed]
+                parts.append(f'"{ENTITY_EVENT_REMOVE}":{JSON_DUMP(removed)}')
+            self._interned_json = "{" + ",".join(parts) + "}"
+        return self._interned_json
+
+
+class HubSubscriber(Protocol):
+    """What the hub expects from a registered subscriber."""
+
+    def async_on_change(self, change: StateChange) -> None:
+        """Handle one filtered state change."""
+
+    def async_on_filter_change(self, change: FilterChange) -> None:
+        """Handle entities joining or leaving the allow-list."""
+
+
+class CouchControlHub:
+    """Track the allow-list once and fan changes out to all subscribers."""
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        """Initialize the hub."""
+        self._hass = hass
+        self.state_cache = StateCache()
+        # Published allow-list per profile. Generations come from one
+        # counter, so they never repeat even when a profile is deleted
+        # and created again.
+        self.filters: dict[str, FilterSnapshot] = {
+            DEFAULT_PROFILE: FilterSnapshot((), 0)
+        }
+        self._generation = 0
+        self._attribute_filter = AttributeFilter()
+        # `epoch` changes with every HA start and `revision` with every
+        # change to an allowed entity's state or registry entry; together
+        # with the filter generation they version the listing payloads.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.revision = 0
+        # Sequence numbers and recent history for resuming clients.
+        self.replay = ReplayBuffer()
+        # Entity indexes for `intern: true` subscriptions.
+        self.ids = InternTable()
+        self.throttle = Throttle(hass, None, self._async_forward)
+        # Counters and latencies for the metrics view and sensors.
+        self.metrics = Metrics()
+        # Raw points behind `get_history`, kept current from the changes
+        # tracked here.
+        self.history = HistoryCache()
+        # One tracker per entity, so an allow-list edit only touches the
+        # entities that actually joined or left.
+        self._unsub_trackers: dict[str, CALLBACK_TYPE] = {}
+        self._tracking = False
+        # Per profile, keyed by a per-hub counter so register /
+        # unregister are O(1) and delivery order follows subscription
+        # order.
+        self._subscribers: dict[str, dict[int, HubSubscriber]] = {}
+        self._next_token = 0
+
+        hass.bus.async_listen(
+            er.EVENT_ENTITY_REGISTRY_UPDATED, self._async_registry_updated
+        )
+
+    @property
+    def filter(self) -> FilterSnapshot:
+        """Allow-list of the default profile."""
+        return self.filters[DEFAULT_PROFILE]
+
+    @property
+    def subscriber_count(self) -> int:
+        """Number of currently registered subscribers."""
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    @property
+    def version(self) -> str:
+        """Listing version of the default profile, see `version_of`."""
+        return self.version_of(self.filter)
+
+    def version_of(self, allowed: FilterSnapshot) -> str:
+        """Opaque token that changes whenever a listing would change.
+
+        O(1) to compute, unlike hashing the listing or scanning every
+        allowed state for the newest `last_updated`. The revision is
+        shared by all profiles, so a change in one profile also moves
+        the others' versions; that only costs a refetch.
+        """
+        return f"{self.epoch}.{allowed.generation}.{self.revision}"
+
+    @callback
+    def async_set_entities(
+        self, entity_ids: Iterable[str], profile: str = DEFAULT_PROFILE
+    ) -> FilterSnapshot:
+        """Publish a profile's new allow-list and move the tracker, incrementally.
+
+        Only entities that joined or left the union of all profiles
+        are (un)tracked, and every subscriber of the profile is told
+        about exactly its delta. Re-publishing the same list (e.g.
+        after an entry reload) keeps the current snapshot and
+        generation and only re-arms the trackers.
+        """
+        ordered = tuple(dict.fromkeys(entity_ids))
+        previous = self.filters.get(profile) or FilterSnapshot((), 0)
+        entities = frozenset(ordered)
+        added = [eid for eid in ordered if eid not in previous.entity_set]
+        removed = [eid for eid in previous.entities if eid not in entities]
+        if ordered != previous.entities or profile not in self.filters:
+            self._generation = max(self._generation, previous.generation) + 1
+            self.filters[profile] = FilterSnapshot(ordered, self._generation)
+        self.ids.async_assign(added)
+
+        # Still wanted by another profile: keep tracking / caching it.
+        untracked = [eid for eid in removed if not self._is_allowed(eid)]
+        if not self._tracking:
+            # First publish, or first one after `async_stop`: arm
+            # trackers for every profile's list. Changes made while
+            # nothing was tracking went uncounted, so move the revision on.
+            self._tracking = True
+            self.revision += 1
+            self.replay.async_invalidate()
+            for snapshot in self.filters.values():
+                for entity_id in snapshot.entities:
+                    self._async_track(entity_id)
+        else:
+            for entity_id in added:
+                self._async_track(entity_id)
+            for entity_id in untracked:
+                if (unsub := self._unsub_trackers.pop(entity_id, None)) is not None:
+                    unsub()
+
+        snapshot = self.filters[profile]
+        if not (added or removed):
+            return snapshot
+        self.metrics.count("allow_list_edits")
+        if untracked:
+            self.state_cache.async_retain(self._unsub_trackers)
+            self.throttle.async_forget(untracked)
+            self.history.async_forget(untracked)
+        seq = self.replay.async_record([*added, *removed], profile)
+        if not (subscribers := self._subscribers.get(profile)):
+            return snapshot
+
+        change = FilterChange(
+            self.visible_state, added, removed, snapshot.generation, seq
+        )
+        for subscriber in list(subscribers.values()):
+            try:
+                subscriber.async_on_filter_change(change)
+            except Exception:
+                _LOGGER.exception("Error sending allow-list change to subscriber")
+        return snapshot
+
+    @callback
+    def async_remove_profile(self, profile: str) -> None:
+        """Drop a named profile; its subscribers see every entity leave."""
+        if profile == DEFAULT_PROFILE or profile not in self.filters:
+            return
+        self.async_set_entities((), profile)
+        del self.filters[profile]
+
+    def _is_allowed(self, entity_id: str) -> bool:
+        """Whether any profile allows an entity."""
+        return any(entity_id in snapshot for snapshot in self.filters.values())
+
+    @property
+    def attribute_rules(self) -> dict[str, Any]:
+        """Validated attribute rules currently applied to payloads."""
+        return self._attribute_filter.rules
+
+    @callback
+    def async_set_attribute_rules(self, rules: Mapping[str, Any] | None) -> None:
+        """Apply new attribute rules to everything sent from now on.
+
+        Raises `vol.Invalid` for malformed rules. Payloads already sent
+        are not revised; the new revision makes REST / `get_entities`
+        clients refetch, and subscribers pick up the trimmed attributes
+        on their next snapshot.
+        """
+        attribute_filter = AttributeFilter(rules)
+        if attribute_filter.rules == self._attribute_filter.rules:
+            return
+        self._attribute_filter = attribute_filter
+        self.state_cache.async_set_attribute_filter(attribute_filter)
+        self.revision += 1
+        # Clients hold attributes encoded under the old rules.
+        self.replay.async_invalidate()
+
+    @property
+    def throttle_rules(self) -> dict[str, Any]:
+        """Validated throttle rules currently applied to state changes."""
+        return self.throttle.rules
+
+    @callback
+    def async_set_throttle_rules(self, rules: Mapping[str, Any] | None) -> None:
+        """Replace the throttle rules; raises `vol.Invalid` if malformed.
+
+        Anything the old rules were holding back is sent first.
+        """
+        throttle = Throttle(self._hass, rules, self._async_forward)
+        if throttle.rules == self.throttle.rules:
+            return
+        self.throttle.async_flush()
+        self.throttle = throttle
+
+    @callback
+    def visible_state(self, entity_id: str) -> State | None:
+        """State subscribers were last sent for an entity.
+
+        Snapshots use this instead of the live state, so a throttled
+        entity's trailing diff applies to what every client holds.
+        """
+        return self.throttle.forwarded_state(entity_id) or self._hass.states.get(
+            entity_id
+        )
+
+    @callback
+    def async_stop(self) -> None:
+        """Stop tracking; the allow-list and subscribers are kept for a re-setup."""
+        self.throttle.async_flush()
+        self.history.async_clear()
+        self._tracking = False
+        for unsub in self._unsub_trackers.values():
+            unsub()
+        self._unsub_trackers.clear()
+
+    @callback
+    def _async_track(self, entity_id: str) -> None:
+        """Start tracking one entity."""
+        if entity_id not in self._unsub_trackers:
+            self._unsub_trackers[entity_id] = async_track_state_change_event(
+                self._hass, [entity_id], self._async_on_state_changed
+            )
+
+    @callback
+    def async_subscribe(
+        self, subscriber: HubSubscriber, profile: str = DEFAULT_PROFILE
+    ) -> CALLBACK_TYPE:
+        """Register a subscriber to a profile and return its unregister callback."""
+        token = self._next_token
+        self._next_token += 1
+        subscribers = self._subscribers.setdefault(profile, {})
+        subscribers[token] = subscriber
+
+        @callback
+        def unsubscribe() -> None:
+            subscribers.pop(token, None)
+            if not subscribers and self._subscribers.get(profile) is subscribers:
+                del self._subscribers[profile]
+
+        return unsubscribe
+
+    @callback
+    def _async_registry_updated(self, event: Event) -> None:
+        """Count registry edits (name, icon, area...) of allowed entities."""
+        if (
+            event.data["entity_id"] in self._unsub_trackers
+            or event.data.get("old_entity_id") in self._unsub_trackers
+        ):
+            self.revision += 1
+
+    @callback
+    def _async_on_state_changed(self, event: Event) -> None:
+        """Count the change and pass it on, through the throttle if needed."""
+        self.revision += 1
+        self.metrics.count("events_inspected")
+        self.history.async_on_state_changed(event)
+        if self.throttle:
+            self.throttle.async_process(event)
+        else:
+            self._async_forward(event, event.data.get("old_state"))
+
+    @callback
+    def _async_forward(self, event: Event, old_state: State | None) -> None:
+        """Prepare the change once and hand it to every subscriber."""
+        seq = self.replay.async_record((event.data["entity_id"],))
+        self.metrics.count("events_forwarded")
+        if not self._subscribers:
+            return
+        start = time.perf_counter()
+        entity_id = event.data["entity_id"]
+        change = StateChange(event, self.state_cache, seq, self.ids, old_state)
+        for profile, subscribers in list(self._subscribers.items()):
+            if (allowed := self.filters.get(profile)) is None or entity_id not in allowed:
+                continue
+            # Copy: a subscriber may unsubscribe itself while being called.
+            for subscriber in list(subscribers.values()):
+                try:
+                    subscriber.async_on_change(change)
+                except Exception:
+                    _LOGGER.exception("Error forwarding %s to subscriber", entity_id)
+        # Encoding happens lazily inside the subscribers, so this covers
+        # serialization and queueing for every client.
+        self.metrics.observe("forward_ms", (time.perf_counter() - start) * 1000)
+
+
+@callback
+def async_get_hub(hass: HomeAssistant) -> CouchControlHub:
+    """Return the hub, creating it on first use.
+
+    The hub deliberately lives outside `hass.data[DOMAIN]`: an options
+    save reloads the entry (unload pops the domain, setup rebuilds it)
+    and connected clients must keep their subscriptions across that.
+    """
+    if (hub := hass.data.get(DATA_HUB)) is None:
+        hub = hass.data[DATA_HUB] = CouchControlHub(hass)
+    return hub
+
+
+@callback
+def async_set_allowed_entities(
+    hass: HomeAssistant, entities: list[str], profile: str = DEFAULT_PROFILE
+) -> None:
+    """Publish a profile's new resolved allow-list to handlers and the hub.
+
+    The hub owns the generation counter, so it keeps increasing across
+    entry reloads and a client's cached generation never collides with
+    a different allow-list.
+    """
+    snapshot = async_get_hub(hass).async_set_entities(entities, profile)
+    if profile == DEFAULT_PROFILE:
+        domain_data: dict[str, Any] = hass.data[DOMAIN]
+        domain_data["filter"] = snapshot
@@ -0,0 +1,303 @@
+"""Resized `entity_picture` images for TV clients.
+
+Album art and camera snapshots come at full resolution, and the tvOS
+app used to download and downscale them on-device for every
+now-playing update. `GET /api/couch_control/image/{entity_id}` returns
+the picture of an allowed entity fitted into the requested `width` /
+`height` and re-encoded (JPEG, or PNG when it has transparency).
+
+Results are cached by source URL and size, in memory and on disk, each
+bounded in bytes and evicting the least recently used image first.
+Media players change their `entity_picture` with the artwork and
+cameras rotate the token in theirs every few minutes, so the URL is
+also what expires an image: a repeated update of the same track costs
+a dict lookup, not a download and decode.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import io
+import logging
+import os
+from pathlib import Path
+
+from aiohttp import ClientError
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.network import NoURLAvailableError, get_url
+
+from .const import (
+    IMAGE_CACHE_DIR,
+    IMAGE_DISK_CACHE_BYTES,
+    IMAGE_FETCH_TIMEOUT,
+    IMAGE_JPEG_QUALITY,
+    IMAGE_MAX_SOURCE_BYTES,
+    IMAGE_MEMORY_CACHE_BYTES,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+_CONTENT_TYPES = {".jpg": "image/jpeg", ".png": "image/png"}
+
+
+class ImageUnavailable(Exception):
+    """The source image could not be fetched or decoded."""
+
+
+@dataclass(frozen=True)
+class CachedImage:
+    """One resized, encoded image."""
+
+    key: str
+    data: bytes
+    content_type: str
+
+
+def image_key(url: str, width: int | None, height: int | None) -> str:
+    """Cache key (and ETag) for a source URL at a size."""
+    return hashlib.sha256(f"{url}|{width}x{height}".encode()).hexdigest()[:32]
+
+
+class ImageCache:
+    """Memory and disk LRU of resized images, bounded in bytes."""
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        """Initialize; the disk index is read on first use."""
+        self._hass = hass
+        self._dir = Path(hass.config.path(IMAGE_CACHE_DIR))
+        self._memory: OrderedDict[str, CachedImage] = OrderedDict()
+        self._memory_bytes = 0
+        # key -> (file name, size); None until the directory was scanned.
+        self._disk: OrderedDict[str, tuple[str, int]] | None = None
+        self._disk_bytes = 0
+        self._disk_lock = asyncio.Lock()
+        # Requests for an image that is being made wait for that one.
+        self._inflight: dict[str, asyncio.Future[CachedImage]] = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters for the metrics view."""
+        return {
+            "memory_images": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_images": len(self._disk or ()),
+            "disk_bytes": self._disk_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    async def async_get(
+        self, url: str, width: int | None, height: int | None
+    ) -> CachedImage:
+        """Return the image at `url` fitted into `width` x `height`.
+
+        Raises `ImageUnavailable` if it can't be fetched or decoded.
+        """
+        key = image_key(url, width, height)
+        if (image := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return image
+        if (pending := self._inflight.get(key)) is not None:
+            return await asyncio.shield(pending)
+
+        future: asyncio.Future[CachedImage] = self._hass.loop.create_future()
+        self._inflight[key] = future
+        try:
+            image = await self._async_load(key, url, width, height)
+        except BaseException as err:
+            if isinstance(err, asyncio.CancelledError):
+                # The first requester went away; wake the others with a
+                # failure rather than leaving them on a future nobody sets.
+                err = ImageUnavailable("Fetching the source image was cancelled")
+            future.set_exception(err)
+            # Mark it retrieved; with nobody waiting, asyncio would log
+            # the exception as never retrieved.
+            future.exception()
+            raise
+        else:
+            future.set_result(image)
+        finally:
+            del self._inflight[key]
+        self._async_remember(image)
+        return image
+
+    async def _async_load(
+        self, key: str, url: str, width: int | None, height: int | None
+    ) -> CachedImage:
+        """Read the image from disk, or fetch, resize and store it."""
+        if (image := await self._async_read_disk(key)) is not None:
+            self.disk_hits += 1
+            return image
+        self.misses += 1
+        source = await _async_fetch(self._hass, url)
+        data, extension = await self._hass.async_add_executor_job(
+            _resize, source, width, height
+        )
+        image = CachedImage(key, data, _CONTENT_TYPES[extension])
+        await self._async_write_disk(key, extension, data)
+        return image
+
+    @callback
+    def _async_remember(self, image: CachedImage) -> None:
+        """Add to the memory LRU and evict down to its byte budget."""
+        if image.key in self._memory:
+            return
+        self._memory[image.key] = image
+        self._memory_bytes += len(image.data)
+        while self._memory_bytes > IMAGE_MEMORY_CACHE_BYTES and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.data)
+
+    async def _async_disk_index(self) -> OrderedDict[str, tuple[str, int]]:
+        """Scan the cache directory once, oldest file first."""
+        if self._disk is None:
+            entries = await self._hass.async_add_executor_job(self._scan)
+            self._disk = OrderedDict(entries)
+            self._disk_bytes = sum(size for _, size in self._disk.values())
+        return self._disk
+
+    def _scan(self) -> list[tuple[str, tuple[str, int]]]:
+        """List cached files as (key, (name, size)), by modification time.
+
+        An unusable cache directory reads as empty; writes then fail
+        and are logged, and images are served from memory only.
+        """
+        files = []
+        try:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            for entry in os.scandir(self._dir):
+                key, extension = os.path.splitext(entry.name)
+                if extension in _CONTENT_TYPES and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, key, entry.name, stat.st_size))
+        except OSError:
+            _LOGGER.warning(
+                "Could not read image cache directory %s", self._dir, exc_info=True
+            )
+            return []
+        files.sort()
+        return [(key, (name, size)) for _, key, name, size in files]
+
+    async def _async_read_disk(self, key: str) -> CachedImage | None:
+        """Return a cached file, marking it recently used."""
+        async with self._disk_lock:
+            index = await self._async_disk_index()
+            if (entry := index.get(key)) is None:
+                return None
+            index.move_to_end(key)
+        name = entry[0]
+        try:
+            data = await self._hass.async_add_executor_job(self._read, name)
+        except OSError:
+            _LOGGER.debug("Cached image %s is gone", name)
+            return None
+        return CachedImage(key, data, _CONTENT_TYPES[os.path.splitext(name)[1]])
+
+    def _read(self, name: str) -> bytes:
+        """Read a cached file and touch it, so LRU order survives restarts."""
+        path = self._dir / name
+        data = path.read_bytes()
+        os.utime(path)
+        return data
+
+    async def _async_write_disk(self, key: str, extension: str, data: bytes) -> None:
+        """Store a resized image and evict down to the disk budget."""
+        name = f"{key}{extension}"
+        async with self._disk_lock:
+            index = await self._async_disk_index()
+            if key in index:
+                return
+            index[key] = (name, len(data))
+            self._disk_bytes += len(data)
+            evicted = []
+            while self._disk_bytes > IMAGE_DISK_CACHE_BYTES and len(index) > 1:
+                _, (old_name, size) = index.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old_name)
+        try:
+            await self._hass.async_add_executor_job(self._write, name, data, evicted)
+        except OSError:
+            _LOGGER.warning("Could not write image cache file %s", name, exc_info=True)
+
+    def _write(self, name: str, data: bytes, evicted: list[str]) -> None:
+        """Write one file and delete the evicted ones."""
+        self._dir.mkdir(parents=True, exist_ok=True)
+        (self._dir / name).write_bytes(data)
+        for old_name in evicted:
+            (self._dir / old_name).unlink(missing_ok=True)
+
+
+async def _async_fetch(hass: HomeAssistant, url: str) -> bytes:
+    """Download a source image; relative URLs are HA's own proxies."""
+    if url.startswith("/"):
+        try:
+            url = get_url(hass, prefer_external=False, allow_cloud=False) + url
+        except NoURLAvailableError as err:
+            raise ImageUnavailable("No URL to reach Home Assistant") from err
+    try:
+        return await asyncio.wait_for(
+            _async_download(hass, url), timeout=IMAGE_FETCH_TIMEOUT
+        )
+    except (ClientError, asyncio.TimeoutError) as err:
+        raise ImageUnavailable(f"Could not fetch the source image: {err!r}") from err
+
+
+async def _async_download(hass: HomeAssistant, url: str) -> bytes:
+    """Read a response body, giving up past `IMAGE_MAX_SOURCE_BYTES`."""
+    async with async_get_clientsession(hass).get(url) as response:
+        response.raise_for_status()
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            data += chunk
+            if len(data) > IMAGE_MAX_SOURCE_BYTES:
+                raise ImageUnavailable("Source image is too large")
+    return bytes(data)
+
+
+def _resize(data: bytes, width: int | None, height: int | None) -> tuple[bytes, str]:
+    """Fit an image into the box and encode it; runs in the executor.
+
+    Never upscales. JPEG sources are decoded at a reduced scale right
+    away (`draft`), which is most of the win for large album art.
+    Returns the encoded bytes and the file extension.
+    """
+    # Imported here, in the executor: loading Pillow takes a while and
+    # most installs never resize anything.
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            box = (width or source.width, height or source.height)
+            source.draft("RGB", box)
+            image = ImageOps.exif_transpose(source)
+            image.thumbnail(box, Image.LANCZOS)
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or (
+                image.mode == "P" and "transparency" in image.info
+            ):
+                image.save(output, format="PNG", optimize=True)
+                return output.getvalue(), ".png"
+            image.convert("RGB").save(
+                output,
+                format="JPEG",
+                quality=IMAGE_JPEG_QUALITY,
+                optimize=True,
+                progressive=True,
+            )
+            return output.getvalue(), ".jpg"
+    except (
+        Image.DecompressionBombError,
+        UnidentifiedImageError,
+        OSError,
+        ValueError,
+    ) as err:
+        raise ImageUnavailable("Could not decode the source image") from err
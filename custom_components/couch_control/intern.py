@@ -0,0 +1,66 @@
+"""Entity-id interning for compact subscriptions.
+
+With `intern: true` a compact subscription refers to entities by a
+small integer instead of repeating ids like
+`sensor.living_room_multisensor_temperature` in every event. The
+result carries an `ids` table (index -> entity_id) for every allowed
+entity, including those without a state yet, and `filter_changed`
+payloads extend it for entities that join the allow-list, so every
+index a later change uses is already known to the client.
+
+Indexes are assigned by the hub and never reused while HA runs, so
+every interning subscription shares one encoding per change, and a
+client resuming in the same `epoch` can keep its table.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterable
+from typing import Any
+
+from homeassistant.core import callback
+
+from .const import ENTITY_EVENT_REMOVE
+
+
+class InternTable:
+    """entity_id <-> index mapping shared by all interning subscribers."""
+
+    def __init__(self) -> None:
+        """Initialize an empty table."""
+        self._indexes: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """Return the number of assigned indexes."""
+        return len(self._indexes)
+
+    def __getitem__(self, entity_id: str) -> int:
+        """Return the index of an entity, assigning one if needed."""
+        try:
+            return self._indexes[entity_id]
+        except KeyError:
+            index = self._indexes[entity_id] = len(self._indexes)
+            return index
+
+    @callback
+    def async_assign(self, entity_ids: Iterable[str]) -> None:
+        """Make sure every entity has an index."""
+        indexes = self._indexes
+        for entity_id in entity_ids:
+            if entity_id not in indexes:
+                indexes[entity_id] = len(indexes)
+
+    def table(self, entity_ids: Iterable[str]) -> dict[int, str]:
+        """Return the index -> entity_id table for `entity_ids`."""
+        return {self[entity_id]: entity_id for entity_id in entity_ids}
+
+    def intern_payload(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """Re-key a compact `a` / `c` / `r` payload by entity index."""
+        interned: dict[str, Any] = {}
+        for key, value in payload.items():
+            if key == ENTITY_EVENT_REMOVE:
+                interned[key] = [self[entity_id] for entity_id in value]
+            else:
+                interned[key] = {
+                    self[entity_id]: item for entity_id, item in value.items()
+                }
+        return interned
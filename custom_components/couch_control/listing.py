@@ -0,0 +1,216 @@
+"""Entity listing shared by the REST view and `couch_control/get_entities`.
+
+Both endpoints return the same records, support the same field /
+attribute projection and page through the allow-list with the same
+opaque cursor, so the logic lives here once.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+from collections.abc import Collection, Iterator
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.json import JSON_DUMP
+
+from .const import LISTING_CHUNK_SIZE
+from .filter_index import FilterSnapshot
+from .hub import CouchControlHub
+from .serialization import LISTING_FIELDS, projected_entity_listing
+
+
+class InvalidCursor(ValueError):
+    """The cursor is malformed or belongs to an older allow-list."""
+
+
+def encode_cursor(generation: int, offset: int) -> str:
+    """Encode a page position for the given allow-list generation."""
+    return base64.urlsafe_b64encode(f"{generation}:{offset}".encode()).decode()
+
+
+def decode_cursor(cursor: str, generation: int) -> int:
+    """Return the offset a cursor points at.
+
+    Cursors are tied to the allow-list generation they were issued
+    for; paging across an allow-list change would skip or repeat
+    entities, so the client is told to start over instead.
+    """
+    try:
+        cursor_generation, offset = (
+            int(part) for part in base64.urlsafe_b64decode(cursor).decode().split(":")
+        )
+    except (binascii.Error, UnicodeDecodeError, ValueError) as err:
+        raise InvalidCursor("Malformed cursor") from err
+    if cursor_generation != generation:
+        raise InvalidCursor("The entity list changed; restart from the first page")
+    if offset < 0:
+        raise InvalidCursor("Malformed cursor")
+    return offset
+
+
+def invalid_fields(fields: Collection[str]) -> list[str]:
+    """Return the requested field names that don't exist."""
+    return [field for field in fields if field not in LISTING_FIELDS]
+
+
+def listing_version(
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    *,
+    fields: Collection[str] | None = None,
+    attributes: Collection[str] | None = None,
+    limit: int | None = None,
+    cursor: str | None = None,
+) -> str:
+    """Version token (and ETag) of one page / projection of the listing.
+
+    The hub's version says whether the list changed; the query is
+    hashed in as well so a token echoed from page 1 or from a
+    `fields=entity_id` first paint never short-circuits a request for
+    a different page or projection.
+    """
+    version = hub.version_of(allowed)
+    if fields is None and attributes is None and limit is None and not cursor:
+        return version
+    query = JSON_DUMP(
+        [
+            None if fields is None else list(fields),
+            None if attributes is None else list(attributes),
+            limit,
+            cursor or None,
+        ]
+    )
+    return f"{version}.{hashlib.sha256(query.encode()).hexdigest()[:12]}"
+
+
+def _page_bounds(
+    allowed: FilterSnapshot, limit: int | None, cursor: str | None
+) -> tuple[int, int]:
+    """Return the [start, end) slice of the allow-list one page covers."""
+    total = len(allowed.entities)
+    start = decode_cursor(cursor, allowed.generation) if cursor else 0
+    return start, total if limit is None else min(start + limit, total)
+
+
+def listing_chunks(
+    hass: HomeAssistant,
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    *,
+    fields: Collection[str] | None = None,
+    attributes: Collection[str] | None = None,
+    limit: int | None = None,
+    cursor: str | None = None,
+    chunk_size: int = LISTING_CHUNK_SIZE,
+) -> Iterator[str]:
+    """Encode one page of the entity listing as consecutive JSON pieces.
+
+    The pieces concatenate to the same document `build_listing_json`
+    returns; each covers at most `chunk_size` records so a streaming
+    response can write them as they are produced instead of holding
+    the whole listing in memory. The cursor is checked (and
+    `InvalidCursor` raised) before any piece is produced.
+    """
+    start, end = _page_bounds(allowed, limit, cursor)
+    # Fixed up front so the trailer matches the ETag even if states
+    # change while a streamed response is being written.
+    version = listing_version(
+        hub,
+        allowed,
+        fields=fields,
+        attributes=attributes,
+        limit=limit,
+        cursor=cursor,
+    )
+    return _iter_listing_json(
+        hass, hub, allowed, start, end, fields, attributes, chunk_size, version
+    )
+
+
+def _iter_listing_json(
+    hass: HomeAssistant,
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    start: int,
+    end: int,
+    fields: Collection[str] | None,
+    attributes: Collection[str] | None,
+    chunk_size: int,
+    version: str,
+) -> Iterator[str]:
+    """Yield the listing document for `allowed.entities[start:end]`."""
+    entity_ids = allowed.entities
+    ent_reg = er.async_get(hass)
+    cache = hub.state_cache
+    prefix = '{"entities":['
+    for chunk_start in range(start, end, chunk_size):
+        page = entity_ids[chunk_start : min(chunk_start + chunk_size, end)]
+        # Without projection, records come straight from the
+        # encoded-state cache. Projected records are small and built
+        # fresh.
+        if fields is None and attributes is None:
+            records = [
+                cache.listing_json(
+                    entity_id, hass.states.get(entity_id), ent_reg.async_get(entity_id)
+                )
+                for entity_id in page
+            ]
+        else:
+            records = [
+                JSON_DUMP(
+                    projected_entity_listing(
+                        entity_id,
+                        hass.states.get(entity_id),
+                        ent_reg.async_get(entity_id),
+                        fields=fields,
+                        attributes=attributes,
+                        attribute_filter=cache.attribute_filter,
+                    )
+                )
+                for entity_id in page
+            ]
+        yield prefix + ",".join(records)
+        prefix = ","
+    if prefix != ",":
+        yield prefix
+
+    next_cursor = (
+        f',"next_cursor":"{encode_cursor(allowed.generation, end)}"'
+        if end < len(entity_ids)
+        else ""
+    )
+    yield (
+        f'],"count":{len(entity_ids)},'
+        f'"generation":{allowed.generation},"version":"{version}"{next_cursor}}}'
+    )
+
+
+def build_listing_json(
+    hass: HomeAssistant,
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    *,
+    fields: Collection[str] | None = None,
+    attributes: Collection[str] | None = None,
+    limit: int | None = None,
+    cursor: str | None = None,
+) -> str:
+    """Encode one page of the entity listing.
+
+    `next_cursor` is only present when there are more entities after
+    this page.
+    """
+    return "".join(
+        listing_chunks(
+            hass,
+            hub,
+            allowed,
+            fields=fields,
+            attributes=attributes,
+            limit=limit,
+            cursor=cursor,
+            chunk_size=max(len(allowed), 1),
+        )
+    )
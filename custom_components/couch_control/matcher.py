@@ -0,0 +1,157 @@
+"""Rule-based entity selection for Couch Control.
+
+Besides explicit ids, areas and devices, a selection can carry match
+rules, so a large install doesn't have to maintain hundreds of ids::
+
+    - domain: light
+    - entity_id: "sensor.*_temperature"
+    - domain: binary_sensor
+      device_class: [motion, occupancy]
+    - label: couch
+
+All keys of one rule must match; an entity is selected when any rule
+matches. `entity_id` takes shell-style globs, `device_class` is the
+effective one (the user's override, else the integration's) and
+`label` the entity's own labels. Like area and device picks, rules
+only see entities in the entity registry.
+
+`CompiledRules` puts each rule into a per-domain bucket (a rule
+without `domain` gets its domains from globs such as `sensor.*`, or
+lands in a bucket checked for every domain) and splits each glob into
+a literal prefix, checked with `str.startswith`, and a compiled
+pattern. Checking one entity only looks at the rules for its domain,
+so a registry change costs the same however many entities exist.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Mapping
+import fnmatch
+import re
+from typing import Any
+
+import voluptuous as vol
+
+CONF_MATCH_DOMAIN = "domain"
+CONF_MATCH_ENTITY_ID = "entity_id"
+CONF_MATCH_DEVICE_CLASS = "device_class"
+CONF_MATCH_LABEL = "label"
+
+_WILDCARDS = re.compile(r"[*?\[]")
+
+
+def _string_list(value: Any) -> list[str]:
+    """Accept one string or a list of them."""
+    if isinstance(value, str):
+        value = [value]
+    return vol.Schema([vol.All(str, vol.Strip, vol.Length(min=1))])(value)
+
+
+_RULE_SCHEMA = vol.All(
+    vol.Schema(
+        {
+            vol.Optional(CONF_MATCH_DOMAIN): _string_list,
+            vol.Optional(CONF_MATCH_ENTITY_ID): _string_list,
+            vol.Optional(CONF_MATCH_DEVICE_CLASS): _string_list,
+            vol.Optional(CONF_MATCH_LABEL): _string_list,
+        }
+    ),
+    vol.Length(min=1, msg="A match rule needs at least one key"),
+)
+
+MATCH_RULES_SCHEMA = vol.Schema([_RULE_SCHEMA])
+
+# (literal prefix, full match of the glob, or None if it has no wildcard)
+_Glob = tuple[str, Callable[[str], Any] | None]
+
+
+def _compile_glob(glob: str) -> _Glob:
+    """Split a glob into its literal prefix and a matcher for the rest."""
+    if (wildcard := _WILDCARDS.search(glob)) is None:
+        return glob, None
+    return glob[: wildcard.start()], re.compile(fnmatch.translate(glob)).match
+
+
+class _Rule:
+    """One compiled rule; its domain is checked by the bucket it is in."""
+
+    __slots__ = ("globs", "device_classes", "labels")
+
+    def __init__(self, rule: Mapping[str, list[str]]) -> None:
+        """Compile a validated rule."""
+        self.globs = [
+            _compile_glob(glob) for glob in rule.get(CONF_MATCH_ENTITY_ID, ())
+        ]
+        self.device_classes = frozenset(rule.get(CONF_MATCH_DEVICE_CLASS, ()))
+        self.labels = frozenset(rule.get(CONF_MATCH_LABEL, ()))
+
+    def matches(
+        self, entity_id: str, device_class: str | None, labels: frozenset[str]
+    ) -> bool:
+        """Whether every key of the rule matches."""
+        if self.globs and not any(
+            entity_id == prefix
+            if match is None
+            else entity_id.startswith(prefix) and match(entity_id) is not None
+            for prefix, match in self.globs
+        ):
+            return False
+        if self.device_classes and device_class not in self.device_classes:
+            return False
+        return not self.labels or not self.labels.isdisjoint(labels)
+
+
+class CompiledRules:
+    """A selection's match rules, bucketed for per-entity checks."""
+
+    def __init__(self, rules: Iterable[Mapping[str, Any]] | None = None) -> None:
+        """Validate and compile rules (see `MATCH_RULES_SCHEMA`)."""
+        self.rules: list[dict[str, list[str]]] = MATCH_RULES_SCHEMA(
+            list(rules or ())
+        )
+        self._by_domain: dict[str, list[_Rule]] = {}
+        self._any_domain: list[_Rule] = []
+        for rule in self.rules:
+            compiled = _Rule(rule)
+            if domains := self._rule_domains(rule):
+                for domain in domains:
+                    self._by_domain.setdefault(domain, []).append(compiled)
+            else:
+                self._any_domain.append(compiled)
+
+    @staticmethod
+    def _rule_domains(rule: Mapping[str, list[str]]) -> set[str]:
+        """Domains a rule can match; empty if it can match any."""
+        if domains := rule.get(CONF_MATCH_DOMAIN):
+            return set(domains)
+        globs = rule.get(CONF_MATCH_ENTITY_ID, ())
+        domains = set()
+        for glob in globs:
+            domain, dot, _ = glob.partition(".")
+            if not dot or _WILDCARDS.search(domain):
+                return set()
+            domains.add(domain)
+        return domains
+
+    def __bool__(self) -> bool:
+        """Return True if any rule is configured."""
+        return bool(self.rules)
+
+    @property
+    def domains(self) -> set[str] | None:
+        """Domains whose entities can match, or None for every domain."""
+        if self._any_domain:
+            return None
+        return set(self._by_domain)
+
+    def matches(
+        self, entity_id: str, device_class: str | None, labels: frozenset[str]
+    ) -> bool:
+        """Whether any rule selects the entity."""
+        domain = entity_id.partition(".")[0]
+        for rule in self._by_domain.get(domain, ()):
+            if rule.matches(entity_id, device_class, labels):
+                return True
+        for rule in self._any_domain:
+            if rule.matches(entity_id, device_class, labels):
+                return True
+        return False
@@ -0,0 +1,153 @@
+"""Runtime counters and latency histograms for Couch Control.
+
+The hub owns one `Metrics` for the lifetime of HA, so the numbers
+survive entry reloads just like subscriptions do. Hot paths only pay
+for a dict lookup and an integer add; the shape for the metrics view
+is built on request.
+
+Counters report their running `total` (alert on its rate) and the
+count over the last `ROLLING_WINDOW` seconds. Histograms bucket
+durations in milliseconds with cumulative `le` buckets, the way
+Prometheus does, plus rough percentiles read off the buckets.
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+import time
+from typing import Any
+
+# Seconds covered by a counter's `last_minute` figure.
+ROLLING_WINDOW = 60
+
+# Upper bounds (ms) of the latency buckets; everything slower lands in
+# the implicit `+Inf` bucket.
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class RollingCounter:
+    """Running total plus a per-second ring for the last minute."""
+
+    __slots__ = ("total", "_slots", "_second")
+
+    def __init__(self) -> None:
+        """Initialize at zero."""
+        self.total = 0
+        self._slots = [0] * ROLLING_WINDOW
+        self._second = int(time.monotonic())
+
+    def add(self, amount: int = 1) -> None:
+        """Count `amount` now."""
+        second = int(time.monotonic())
+        if second != self._second:
+            self._advance(second)
+        self._slots[second % ROLLING_WINDOW] += amount
+        self.total += amount
+
+    def _advance(self, second: int) -> None:
+        """Zero the slots of the seconds that passed without counts."""
+        elapsed = second - self._second
+        if elapsed >= ROLLING_WINDOW:
+            self._slots = [0] * ROLLING_WINDOW
+        else:
+            for passed in range(self._second + 1, second + 1):
+                self._slots[passed % ROLLING_WINDOW] = 0
+        self._second = second
+
+    @property
+    def last_minute(self) -> int:
+        """Count over the last `ROLLING_WINDOW` seconds."""
+        self._advance(int(time.monotonic()))
+        return sum(self._slots)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram in milliseconds."""
+
+    __slots__ = ("count", "sum", "max", "_buckets")
+
+    def __init__(self) -> None:
+        """Initialize empty."""
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float) -> None:
+        """Record one duration."""
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+        self._buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def _percentile(self, fraction: float) -> float | None:
+        """Upper bound of the bucket holding the given fraction of samples."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self._buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def as_dict(self) -> dict[str, Any]:
+        """Summary and cumulative buckets for the metrics view."""
+        cumulative: dict[str, int] = {}
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self._buckets):
+            seen += count
+            cumulative[str(bound)] = seen
+        cumulative["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum_ms": round(self.sum, 3),
+            "mean_ms": round(self.sum / self.count, 3) if self.count else None,
+            "max_ms": round(self.max, 3),
+            "p50_ms": self._percentile(0.5),
+            "p95_ms": self._percentile(0.95),
+            "p99_ms": self._percentile(0.99),
+            "le": cumulative,
+        }
+
+
+class Metrics:
+    """Named counters and histograms, created on first use."""
+
+    def __init__(self) -> None:
+        """Initialize empty."""
+        self.started = time.time()
+        self.counters: dict[str, RollingCounter] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Add to a counter."""
+        if (counter := self.counters.get(name)) is None:
+            counter = self.counters[name] = RollingCounter()
+        counter.add(amount)
+
+    def observe(self, name: str, ms: float) -> None:
+        """Record a duration in milliseconds."""
+        if (histogram := self.histograms.get(name)) is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(ms)
+
+    def total(self, name: str) -> int:
+        """Running total of a counter; 0 if it never counted."""
+        counter = self.counters.get(name)
+        return counter.total if counter is not None else 0
+
+    def as_dict(self) -> dict[str, Any]:
+        """Everything collected, in the metrics view's shape."""
+        return {
+            "uptime": round(time.time() - self.started),
+            "counters": {
+                name: {"total": counter.total, "last_minute": counter.last_minute}
+                for name, counter in sorted(self.counters.items())
+            },
+            "histograms": {
+                name: histogram.as_dict()
+                for name, histogram in sorted(self.histograms.items())
+            },
+        }
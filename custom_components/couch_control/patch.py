@@ -0,0 +1,94 @@
+"""Bulk allow-list edits shared by the service, WebSocket and REST APIs.
+
+`add_entity` / `remove_entity` cost a round trip, a re-resolve and a
+save each. A patch applies whole `add` and `remove` lists with one
+validation pass, one selection update (so subscribers get a single
+`filter_changed`) and one scheduled save, and reports what actually
+moved.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterable
+import logging
+from typing import Any
+
+import voluptuous as vol
+
+from homeassistant.core import HomeAssistant, callback
+
+from .const import DOMAIN
+from .filter_index import FilterIndex
+from .storage import async_schedule_save
+
+_LOGGER = logging.getLogger(__name__)
+
+PATCH_SCHEMA = {
+    vol.Optional("add", default=[]): [str],
+    vol.Optional("remove", default=[]): [str],
+}
+
+
+class PatchConflict(ValueError):
+    """The same entity is listed in both `add` and `remove`."""
+
+
+@callback
+def async_patch_entities(
+    hass: HomeAssistant, *, add: Iterable[str], remove: Iterable[str]
+) -> dict[str, Any]:
+    """Add and remove entities in one step and return the delta.
+
+    Adds are validated against the state machine; unknown ids are
+    reported in `invalid` and skipped. Removing an entity that an area
+    or device pick or a match rule includes flattens the picks to
+    explicit entities, as `remove_entity` does.
+    """
+    add = list(dict.fromkeys(add))
+    remove_set = set(remove)
+    if conflicts := sorted(remove_set.intersection(add)):
+        raise PatchConflict(
+            f"Entities in both add and remove: {', '.join(conflicts)}"
+        )
+
+    domain_data = hass.data[DOMAIN]
+    index: FilterIndex = domain_data["index"]
+    before = domain_data["filter"]
+
+    valid_add: list[str] = []
+    invalid: list[str] = []
+    for entity_id in add:
+        if hass.states.get(entity_id) is None:
+            invalid.append(entity_id)
+        elif entity_id not in before:
+            valid_add.append(entity_id)
+
+    flatten = any(index.selected_by_pick(entity_id) for entity_id in remove_set)
+    base = index.resolved if flatten else index.entities
+    entities = [eid for eid in base if eid not in remove_set] + valid_add
+
+    if flatten:
+        index.async_set_selection(
+            areas=[], devices=[], match_rules=[], entities=entities
+        )
+        _LOGGER.info(
+            "Removed entities were selected via an area, device or match "
+            "rule; those picks were replaced by their individual entities"
+        )
+    else:
+        index.async_set_selection(entities=entities)
+
+    after = domain_data["filter"]
+    added = [eid for eid in after if eid not in before]
+    removed = [eid for eid in before if eid not in after]
+    if added or removed or flatten:
+        async_schedule_save(hass)
+    _LOGGER.info(
+        "Patched Couch Control filter: %d added, %d removed", len(added), len(removed)
+    )
+    return {
+        "added": added,
+        "removed": removed,
+        "invalid": invalid,
+        "count": len(after),
+        "generation": after.generation,
+    }
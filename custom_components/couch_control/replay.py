@@ -0,0 +1,82 @@
+"""Sequence numbers and a replay buffer for resumable subscriptions.
+
+Every change the hub forwards (state changes of allowed entities and
+allow-list edits) gets the next sequence number. The ring buffer keeps
+the entity ids touched by the most recent `REPLAY_BUFFER_SIZE` of
+them, so a client that reconnects with its last-seen sequence only
+needs the current state of the entities that changed since, not the
+whole snapshot. When the gap is older than the buffer, the client
+falls back to a full snapshot.
+
+All profiles share one sequence. Allow-list edits are recorded with
+the profile they were made to, so a client resuming one profile is
+not told about entities that only joined or left another.
+"""
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Container, Iterable
+
+from homeassistant.core import callback
+
+from .const import REPLAY_BUFFER_SIZE
+
+
+class ReplayBuffer:
+    """Bounded log of (sequence, entity_id, profile) records."""
+
+    def __init__(self, max_records: int = REPLAY_BUFFER_SIZE) -> None:
+        """Initialize an empty buffer."""
+        self._max_records = max_records
+        # `profile` is None for state changes, which concern every
+        # profile allowing the entity.
+        self._records: deque[tuple[int, str, str | None]] = deque()
+        self.seq = 0
+        # Oldest sequence a client may resume from; everything after it
+        # is either in the buffer or known to be replayable.
+        self._floor = 0
+
+    @callback
+    def async_record(
+        self, entity_ids: Iterable[str], profile: str | None = None
+    ) -> int:
+        """Assign the next sequence number to a change of `entity_ids`.
+
+        Pass `profile` for an allow-list edit of that profile.
+        """
+        self.seq += 1
+        records = self._records
+        for entity_id in entity_ids:
+            if len(records) >= self._max_records:
+                self._floor = records.popleft()[0]
+            records.append((self.seq, entity_id, profile))
+        return self.seq
+
+    @callback
+    def async_invalidate(self) -> None:
+        """Forget history: changes happened that the buffer can't replay."""
+        self.seq += 1
+        self._records.clear()
+        self._floor = self.seq
+
+    def changed_since(
+        self, seq: int, profile: str, allowed: Container[str]
+    ) -> list[str] | None:
+        """Entities of `profile` touched after `seq`, oldest first.
+
+        State changes count for the entities `profile` allows now, edits
+        only for that profile; an entity that changed state but left
+        the profile since is covered by its edit record. Returns None if
+        `seq` is not replayable.
+        """
+        if not self._floor <= seq <= self.seq:
+            return None
+        changed: dict[str, None] = {}
+        for record_seq, entity_id, record_profile in reversed(self._records):
+            if record_seq <= seq:
+                break
+            if record_profile == profile or (
+                record_profile is None and entity_id in allowed
+            ):
+                changed[entity_id] = None
+        return list(reversed(changed))
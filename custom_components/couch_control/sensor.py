@@ -0,0 +1,136 @@
+"""Diagnostic sensors for Couch Control runtime metrics.
+
+A handful of the metrics view's numbers as entities, so they can be
+graphed and alerted on with the recorder and automations. All are
+diagnostic and disabled by default: most installs never look at them,
+and nothing is recorded until a user enables one.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable
+from datetime import timedelta
+from typing import Any
+
+from homeassistant.components.sensor import (
+    SensorDeviceClass,
+    SensorEntity,
+    SensorEntityDescription,
+    SensorStateClass,
+)
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import EntityCategory, UnitOfInformation, UnitOfTime
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.device_registry import DeviceEntryType
+from homeassistant.helpers.entity import DeviceInfo
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+from .const import DOMAIN
+from .hub import CouchControlHub, async_get_hub
+from .storage import async_get_store
+
+# Metrics change constantly; polling keeps the recorder from writing a
+# row per forwarded event.
+SCAN_INTERVAL = timedelta(seconds=30)
+
+
+def _forward_p95(hub: CouchControlHub) -> float | None:
+    """95th percentile fan-out latency, or None before the first event."""
+    if (histogram := hub.metrics.histograms.get("forward_ms")) is None:
+        return None
+    return histogram.as_dict()["p95_ms"]
+
+
+SENSORS: tuple[
+    tuple[SensorEntityDescription, Callable[[HomeAssistant, CouchControlHub], Any]],
+    ...,
+] = (
+    (
+        SensorEntityDescription(
+            key="subscribers",
+            name="Subscribers",
+            icon="mdi:lan-connect",
+            state_class=SensorStateClass.MEASUREMENT,
+        ),
+        lambda hass, hub: hub.subscriber_count,
+    ),
+    (
+        SensorEntityDescription(
+            key="events_forwarded",
+            name="Events forwarded",
+            icon="mdi:swap-horizontal",
+            state_class=SensorStateClass.TOTAL_INCREASING,
+        ),
+        lambda hass, hub: hub.metrics.total("events_forwarded"),
+    ),
+    (
+        SensorEntityDescription(
+            key="bytes_sent",
+            name="Data sent",
+            device_class=SensorDeviceClass.DATA_SIZE,
+            native_unit_of_measurement=UnitOfInformation.BYTES,
+            state_class=SensorStateClass.TOTAL_INCREASING,
+        ),
+        lambda hass, hub: hub.metrics.total("bytes_sent"),
+    ),
+    (
+        SensorEntityDescription(
+            key="forward_latency_p95",
+            name="Forward latency p95",
+            device_class=SensorDeviceClass.DURATION,
+            native_unit_of_measurement=UnitOfTime.MILLISECONDS,
+            state_class=SensorStateClass.MEASUREMENT,
+        ),
+        lambda hass, hub: _forward_p95(hub),
+    ),
+    (
+        SensorEntityDescription(
+            key="storage_writes",
+            name="Storage writes",
+            icon="mdi:content-save",
+            state_class=SensorStateClass.TOTAL_INCREASING,
+        ),
+        lambda hass, hub: async_get_store(hass).writes,
+    ),
+)
+
+
+async def async_setup_entry(
+    hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback
+) -> None:
+    """Set up the metrics sensors."""
+    hub = async_get_hub(hass)
+    async_add_entities(
+        CouchControlMetricSensor(entry, hub, description, value_fn)
+        for description, value_fn in SENSORS
+    )
+
+
+class CouchControlMetricSensor(SensorEntity):
+    """One runtime metric."""
+
+    _attr_has_entity_name = True
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+
+    def __init__(
+        self,
+        entry: ConfigEntry,
+        hub: CouchControlHub,
+        description: SensorEntityDescription,
+        value_fn: Callable[[HomeAssistant, CouchControlHub], Any],
+    ) -> None:
+        """Initialize the sensor."""
+        self.entity_description = description
+        self._hub = hub
+        self._value_fn = value_fn
+        self._attr_unique_id = f"{entry.entry_id}_{description.key}"
+        self._attr_device_info = DeviceInfo(
+            identifiers={(DOMAIN, entry.entry_id)},
+            name="Couch Control",
+            entry_type=DeviceEntryType.SERVICE,
+        )
+
+    @property
+    def native_value(self) -> Any:
+        """Read the metric."""
+        return self._value_fn(self.hass, self._hub)
@@ -0,0 +1,252 @@
+"""Serialization of HA states into the payloads sent to Couch Control clients.
+
+Two wire formats exist side by side: the full `state_changed` shape
+(mirrors what HA core's `subscribe_events` sends) and the compact diff
+shape (mirrors HA core's `subscribe_entities`). Keeping both here lets
+the WebSocket handlers, the subscription hub and the REST views share
+one implementation.
+"""
+from __future__ import annotations
+
+from collections.abc import Collection, Mapping
+from typing import Any
+
+from homeassistant.core import State
+from homeassistant.helpers.entity_registry import RegistryEntry
+
+from .attribute_filter import AttributeFilter
+from .const import (
+    COMPRESSED_STATE_ATTRIBUTES,
+    COMPRESSED_STATE_CONTEXT,
+    COMPRESSED_STATE_LAST_CHANGED,
+    COMPRESSED_STATE_LAST_UPDATED,
+    COMPRESSED_STATE_STATE,
+    ENTITY_EVENT_ADD,
+    ENTITY_EVENT_CHANGE,
+    ENTITY_EVENT_REMOVE,
+    STATE_DIFF_ADDITIONS,
+    STATE_DIFF_REMOVALS,
+)
+
+
+def event_message_json(msg_id: int, event_json: str) -> str:
+    """Wrap an already-encoded event payload in a WS event message.
+
+    Lets one encoded payload be shared by every subscriber; only the
+    message id differs between them.
+    """
+    return f'{{"id":{msg_id},"type":"event","event":{event_json}}}'
+
+
+def result_message_json(msg_id: int, result_json: str) -> str:
+    """Wrap an already-encoded result payload in a WS result message."""
+    return f'{{"id":{msg_id},"type":"result","success":true,"result":{result_json}}}'
+
+
+def _attributes(
+    state: State, attribute_filter: AttributeFilter | None
+) -> Mapping[str, Any]:
+    """Return the attributes of `state` that clients are allowed to see."""
+    return attribute_filter(state) if attribute_filter else state.attributes
+
+
+def state_to_dict(
+    state: State, attribute_filter: AttributeFilter | None = None
+) -> dict[str, Any]:
+    """Convert state to dictionary representation."""
+    return {
+        "entity_id": state.entity_id,
+        "state": state.state,
+        "attributes": dict(_attributes(state, attribute_filter)),
+        "last_changed": state.last_changed.isoformat(),
+        "last_updated": state.last_updated.isoformat(),
+    }
+
+
+# Every key a listing record can carry, in output order. `fields=`
+# projections are validated against this.
+LISTING_FIELDS = (
+    "entity_id",
+    "state",
+    "attributes",
+    "last_changed",
+    "last_updated",
+    "name",
+    "icon",
+    "device_class",
+    "unit_of_measurement",
+    "area_id",
+    "device_id",
+)
+_REGISTRY_FIELDS = frozenset(LISTING_FIELDS[5:])
+
+
+def entity_listing(
+    entity_id: str,
+    state: State | None,
+    entry: RegistryEntry | None,
+    attribute_filter: AttributeFilter | None = None,
+) -> dict[str, Any]:
+    """Build the detailed per-entity record returned by the listing APIs."""
+    entity_data: dict[str, Any] = {
+        "entity_id": entity_id,
+        "state": state.state if state else None,
+        "attributes": dict(_attributes(state, attribute_filter)) if state else {},
+        "last_changed": state.last_changed.isoformat() if state else None,
+        "last_updated": state.last_updated.isoformat() if state else None,
+    }
+    if entry:
+        entity_data.update({
+            "name": entry.name or entry.original_name,
+            "icon": entry.icon or entry.original_icon,
+            "device_class": entry.device_class,
+            "unit_of_measurement": entry.unit_of_measurement,
+            "area_id": entry.area_id,
+            "device_id": entry.device_id,
+        })
+    return entity_data
+
+
+def projected_entity_listing(
+    entity_id: str,
+    state: State | None,
+    entry: RegistryEntry | None,
+    *,
+    fields: Collection[str] | None,
+    attributes: Collection[str] | None,
+    attribute_filter: AttributeFilter | None = None,
+) -> dict[str, Any]:
+    """Build a listing record with only the requested fields / attributes.
+
+    Only what was asked for is computed, so a first-paint request for
+    id, name, state and icon never copies an attribute map. As in the
+    full record, registry fields are omitted for entities without a
+    registry entry. Configured attribute rules apply before the
+    requested `attributes` are picked.
+    """
+    wanted = LISTING_FIELDS if fields is None else fields
+    entity_data: dict[str, Any] = {}
+    for key in LISTING_FIELDS:
+        if key not in wanted:
+            continue
+        if key == "entity_id":
+            entity_data[key] = entity_id
+        elif key in _REGISTRY_FIELDS:
+            if entry is None:
+                continue
+            if key == "name":
+                entity_data[key] = entry.name or entry.original_name
+            elif key == "icon":
+                entity_data[key] = entry.icon or entry.original_icon
+            else:
+                entity_data[key] = getattr(entry, key)
+        elif state is None:
+            entity_data[key] = {} if key == "attributes" else None
+        elif key == "state":
+            entity_data[key] = state.state
+        elif key == "attributes":
+            state_attributes = _attributes(state, attribute_filter)
+            entity_data[key] = (
+                dict(state_attributes)
+                if attributes is None
+                else {
+                    name: state_attributes[name]
+                    for name in attributes
+                    if name in state_attributes
+                }
+            )
+        else:
+            entity_data[key] = getattr(state, key).isoformat()
+    return entity_data
+
+
+def state_to_compressed(
+    state: State, attribute_filter: AttributeFilter | None = None
+) -> dict[str, Any]:
+    """Convert state to the short-key form used by compact subscriptions.
+
+    `lu` is only sent when it differs from `lc` — for most entities the
+    two are identical and the client can fall back to `lc`.
+    """
+    compressed = {
+        COMPRESSED_STATE_STATE: state.state,
+        COMPRESSED_STATE_ATTRIBUTES: dict(_attributes(state, attribute_filter)),
+        COMPRESSED_STATE_CONTEXT: state.context.id,
+        COMPRESSED_STATE_LAST_CHANGED: state.last_changed.timestamp(),
+    }
+    if state.last_updated != state.last_changed:
+        compressed[COMPRESSED_STATE_LAST_UPDATED] = state.last_updated.timestamp()
+    return compressed
+
+
+def state_diff(
+    old_state: State,
+    new_state: State,
+    attribute_filter: AttributeFilter | None = None,
+) -> dict[str, Any]:
+    """Return only what changed between two states, in compact keys.
+
+    `+` holds changed / added values (attributes nested under `a`),
+    `-` holds removed attribute keys. An empty dict means nothing the
+    client can see has changed.
+    """
+    additions: dict[str, Any] = {}
+    diff: dict[str, Any] = {}
+
+    if old_state.state != new_state.state:
+        additions[COMPRESSED_STATE_STATE] = new_state.state
+    if old_state.last_changed != new_state.last_changed:
+        additions[COMPRESSED_STATE_LAST_CHANGED] = new_state.last_changed.timestamp()
+    elif old_state.last_updated != new_state.last_updated:
+        additions[COMPRESSED_STATE_LAST_UPDATED] = new_state.last_updated.timestamp()
+    if old_state.context.id != new_state.context.id:
+        additions[COMPRESSED_STATE_CONTEXT] = new_state.context.id
+
+    # Attribute maps are frequently the very same object when only the
+    # state flipped, so skip the per-key walk in that case.
+    if old_state.attributes is not new_state.attributes:
+        old_attributes = _attributes(old_state, attribute_filter)
+        new_attributes = _attributes(new_state, attribute_filter)
+        changed_attributes = {
+            key: value
+            for key, value in new_attributes.items()
+            if key not in old_attributes or old_attributes[key] != value
+        }
+        if changed_attributes:
+            additions[COMPRESSED_STATE_ATTRIBUTES] = changed_attributes
+        removed_attributes = [
+            key for key in old_attributes if key not in new_attributes
+        ]
+        if removed_attributes:
+            diff[STATE_DIFF_REMOVALS] = {
+                COMPRESSED_STATE_ATTRIBUTES: removed_attributes
+            }
+
+    if additions:
+        diff[STATE_DIFF_ADDITIONS] = additions
+    return diff
+
+
+def compact_event(
+    entity_id: str,
+    old_state: State | None,
+    new_state: State | None,
+    attribute_filter: AttributeFilter | None = None,
+) -> dict[str, Any] | None:
+    """Build the compact event payload for one state change.
+
+    Returns None when the change carries nothing the client can see
+    (e.g. a context-less re-write of identical values).
+    """
+    if new_state is None:
+        return {ENTITY_EVENT_REMOVE: [entity_id]}
+    if old_state is None:
+        return {
+            ENTITY_EVENT_ADD: {
+                entity_id: state_to_compressed(new_state, attribute_filter)
+            }
+        }
+    diff = state_diff(old_state, new_state, attribute_filter)
+    if not diff:
+        return None
+    return {ENTITY_EVENT_CHANGE: {entity_id: diff}}
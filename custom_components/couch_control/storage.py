@@ -1,23 +1,110 @@
-"""Storage handling for Couch Control."""
+"""Storage handling for Couch Control.
+
+The entry owns one `CouchControlStore`. Edits from services, the
+WebSocket API and REST only schedule a save; the Store writes the
+latest data once the edits go quiet for `SAVE_DELAY` seconds. An
+automation adding 50 entities costs one write of
+`.storage/couch_control` instead of 50. Pending data is flushed when
+the entry unloads, and HA's final-write stage covers shutdown.
+"""
 from __future__ import annotations
 
 import logging
 from typing import Any
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.storage import Store
 
-from .const import STORAGE_KEY, STORAGE_VERSION
+from .const import (
+    CONF_ATTRIBUTE_RULES,
+    CONF_THROTTLE_RULES,
+    DOMAIN,
+    SAVE_DELAY,
+    STORAGE_KEY,
+    STORAGE_VERSION,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class CouchControlStore:
+    """The single `Store` behind an entry, with coalesced delayed saves."""
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        """Initialize the store."""
+        self._store: Store[dict[str, Any]] = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._pending: dict[str, Any] | None = None
+        # `save_requests` counts edits asking for a save, `writes` the
+        # times the file was actually rewritten.
+        self.save_requests = 0
+        self.writes = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Write counters, to check that saves are being coalesced."""
+        return {
+            "save_requests": self.save_requests,
+            "writes": self.writes,
+            "pending": int(self._pending is not None),
+        }
+
+    async def async_load(self) -> dict[str, Any] | None:
+        """Load the stored data, including a save that is still pending."""
+        if self._pending is not None:
+            return self._pending
+        return await self._store.async_load()
+
+    @callback
+    def async_delay_save(self, data: dict[str, Any]) -> None:
+        """Save `data` after `SAVE_DELAY`; later calls replace it."""
+        self.save_requests += 1
+        self._pending = data
+        self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+    async def async_save(self, data: dict[str, Any]) -> None:
+        """Write `data` now, superseding any pending delayed save."""
+        self.save_requests += 1
+        self._pending = None
+        self.writes += 1
+        await self._store.async_save(data)
+
+    async def async_flush(self) -> None:
+        """Write a pending delayed save now."""
+        if self._pending is not None:
+            data = self._pending
+            self._pending = None
+            self.writes += 1
+            await self._store.async_save(data)
+
+    async def async_remove(self) -> None:
+        """Drop pending data and delete the file."""
+        self._pending = None
+        await self._store.async_remove()
+
+    @callback
+    def _data_to_save(self) -> dict[str, Any]:
+        """Hand the latest data to the Store's delayed write."""
+        data = self._pending or {}
+        self._pending = None
+        self.writes += 1
+        return data
+
+
+@callback
+def async_get_store(hass: HomeAssistant) -> CouchControlStore:
+    """Return the loaded entry's store.
+
+    The config flow runs before there is an entry; it gets a
+    throw-away instance, which is fine for its single save.
+    """
+    store = hass.data.get(DOMAIN, {}).get("store")
+    return store if store is not None else CouchControlStore(hass)
+
+
 async def async_load_entities(hass: HomeAssistant) -> dict[str, Any]:
     """Load entities from storage."""
-    store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
-    
     try:
-        data = await store.async_load()
+        data = await async_get_store(hass).async_load()
         if data is None:
             return {"entities": []}
         return data
@@ -27,10 +114,28 @@ async def async_load_entities(hass: HomeAssistant) -> dict[str, Any]:
 
 
 async def async_save_entities(hass: HomeAssistant, data: dict[str, Any]) -> None:
-    """Save entities to storage."""
-    store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
-    
+    """Save entities to storage right away."""
     try:
-        await store.async_save(data)
+        await async_get_store(hass).async_save(data)
     except Exception:
-        _LOGGER.exception("Error saving entities to storage")
\ No newline at end of file
+        _LOGGER.exception("Error saving entities to storage")
+
+
+@callback
+def async_schedule_save(hass: HomeAssistant) -> None:
+    """Schedule a coalesced save of the live selections and rules."""
+    async_get_store(hass).async_delay_save(async_current_data(hass))
+
+
+@callback
+def async_current_data(hass: HomeAssistant) -> dict[str, Any]:
+    """Return the live selections and rules in storage shape.
+
+    Every save goes through this so editing one part (say, the entity
+    picks) never drops another (the attribute rules) from the file.
+    """
+    domain_data = hass.data[DOMAIN]
+    data = domain_data["index"].as_storage_data()
+    data[CONF_ATTRIBUTE_RULES] = domain_data["hub"].attribute_rules
+    data[CONF_THROTTLE_RULES] = domain_data["hub"].throttle_rules
+    return data
@@ -0,0 +1,420 @@
+"""Per-connection state for `couch_control/subscribe_filtered`.
+
+A `FilteredSubscription` is what the hub fans changes out to. It owns
+everything that differs between clients — message id, wire format,
+coalescing window — while the hub owns everything that is the same
+for all of them (tracking, filtering, encoding).
+
+Changes travel in up to two lanes. Without `telemetry_ms` there is one
+lane and everything follows `coalesce_ms`. With it, entities the user
+acts on (lights, switches, media players, covers, ...) keep
+`coalesce_ms` — by default none, so a toggle goes out the moment HA
+reports it — while everything else is batched every `telemetry_ms`.
+
+Sending anything also sends whatever an earlier change left waiting in
+the other lane. That costs telemetry some batching while the user is
+busy, but keeps the resume rule intact: every change up to the newest
+`seq` the client has seen has been delivered.
+
+A client that stops reading (a TV on weak Wi-Fi) would otherwise fill
+HA's outgoing queue until core closes the connection, and the
+reconnect costs a full snapshot on top. Once the connection's queue
+passes `BACKPRESSURE_HIGH_WATER` the subscription holds everything in
+a latest-state-per-entity backlog instead, and sends it as one batch
+when the queue has drained.
+
+A chunked snapshot (`chunk_size`) is streamed through the same
+backlog: live changes wait in it, latest state per entity, until the
+last chunk and the completion marker are out, so no chunk can undo a
+newer change the client already applied.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from homeassistant.components import websocket_api
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.json import JSON_DUMP
+
+from .cache import StateCache
+from .const import (
+    BACKPRESSURE_HIGH_WATER,
+    BACKPRESSURE_LOW_WATER,
+    BACKPRESSURE_POLL_INTERVAL,
+    ENTITY_EVENT_REMOVE,
+    INTERACTIVE_DOMAINS,
+)
+from .hub import FilterChange, StateChange, full_event_json
+from .intern import InternTable
+from .metrics import Metrics
+from .serialization import compact_event, event_message_json
+
+
+def _queue_size_getter(
+    connection: websocket_api.ActiveConnection,
+) -> Callable[[], int] | None:
+    """Return a function reading how many messages wait to be written.
+
+    HA doesn't expose this. `send_message` is bound to the WebSocket
+    handler that owns the queue: a `_message_queue` deque since 2023.12,
+    an `asyncio.Queue` named `_to_write` before. None if neither is
+    there (tests, other transports); backpressure is then off.
+    """
+    handler = getattr(connection.send_message, "__self__", None)
+    if handler is None:
+        return None
+    if hasattr(handler, "_message_queue"):
+        return lambda: len(handler._message_queue or ())
+    if hasattr(getattr(handler, "_to_write", None), "qsize"):
+        return handler._to_write.qsize
+    return None
+
+
+class _Lane:
+    """One coalescing window and the changes waiting in it."""
+
+    __slots__ = ("window", "pending", "first_seq", "timer")
+
+    def __init__(self, window: float) -> None:
+        """Initialize an empty lane."""
+        self.window = window
+        # entity_id -> [first old_state, latest change, merged]. `merged`
+        # is False while only one change is pending, which lets the
+        # flush reuse the hub's pre-encoded payload.
+        self.pending: dict[str, list[Any]] = {}
+        # Sequence of the oldest change waiting here.
+        self.first_seq = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class FilteredSubscription:
+    """Deliver hub changes to one WebSocket subscription."""
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        connection: websocket_api.ActiveConnection,
+        msg_id: int,
+        cache: StateCache,
+        *,
+        compact: bool,
+        ids: InternTable | None,
+        coalesce_window: float,
+        max_batch: int,
+        metrics: Metrics,
+        telemetry_window: float | None = None,
+        interactive: Iterable[str] | None = None,
+    ) -> None:
+        """Initialize the subscription.
+
+        `interactive` lists domains and entity ids for the fast lane;
+        it defaults to `INTERACTIVE_DOMAINS` and only matters together
+        with `telemetry_window`.
+        """
+        self._hass = hass
+        self._connection = connection
+        self._msg_id = msg_id
+        self._cache = cache
+        self._compact = compact
+        # Set for `intern: true` (compact only): entities go by index.
+        self._ids = ids
+        self._max_batch = max_batch
+        self._metrics = metrics
+        self._interactive = _Lane(coalesce_window)
+        self._telemetry = (
+            _Lane(telemetry_window) if telemetry_window is not None else None
+        )
+        self._lanes = [self._interactive]
+        if self._telemetry is not None:
+            self._lanes.append(self._telemetry)
+        picks = INTERACTIVE_DOMAINS if interactive is None else interactive
+        self._interactive_domains = {pick for pick in picks if "." not in pick}
+        self._interactive_entities = {pick for pick in picks if "." in pick}
+        # Backpressure: while the client lags, changes collect in the
+        # backlog (latest-wins per entity) and allow-list edits wait in
+        # order behind it; both are None while the client keeps up.
+        self._queue_size = _queue_size_getter(connection)
+        self._backlog: dict[str, list[Any]] | None = None
+        self._held_filter_changes: list[FilterChange] = []
+        self._poll: asyncio.Handle | None = None
+        # Chunks of a snapshot still being streamed, else None.
+        self._snapshot: deque[str] | None = None
+
+    @callback
+    def async_send_snapshot(self, chunks: Iterable[str]) -> None:
+        """Stream snapshot event payloads, holding live changes meanwhile."""
+        self._snapshot = deque(chunks)
+        self._backlog = {}
+        self._async_send_snapshot_chunk()
+
+    @callback
+    def _async_send_snapshot_chunk(self) -> None:
+        """Send the next chunk, then let the writer put it on the wire."""
+        self._poll = None
+        assert self._snapshot is not None
+        if (
+            self._queue_size is not None
+            and self._queue_size() > BACKPRESSURE_LOW_WATER
+        ):
+            self._poll = self._hass.loop.call_later(
+                BACKPRESSURE_POLL_INTERVAL, self._async_send_snapshot_chunk
+            )
+            return
+        self._async_send(self._snapshot.popleft())
+        if self._snapshot:
+            # Queuing every chunk at once would let HA's writer glue
+            # them into one frame again.
+            self._poll = self._hass.loop.call_soon(self._async_send_snapshot_chunk)
+            return
+        self._snapshot = None
+        self._async_release_backlog()
+
+    def _lane(self, entity_id: str) -> _Lane:
+        """Return the lane an entity's changes travel in."""
+        if self._telemetry is None or (
+            entity_id in self._interactive_entities
+            or entity_id.partition(".")[0] in self._interactive_domains
+        ):
+            return self._interactive
+        return self._telemetry
+
+    @callback
+    def async_on_change(self, change: StateChange) -> None:
+        """Send a change right away, or queue it in its lane's window."""
+        if self._async_backed_up():
+            if self._async_merge(self._backlog, change):
+                self._metrics.count("changes_collapsed")
+            return
+
+        lane = self._lane(change.entity_id)
+        if lane.window:
+            self._async_queue(lane, change)
+            return
+
+        if self._ids is not None:
+            payload = change.compact_interned_json
+        elif self._compact:
+            payload = change.compact_json
+        else:
+            payload = change.full_json
+        if payload is not None:
+            self._async_send(payload)
+        self._async_catch_up(change.seq)
+
+    @callback
+    def _async_send(self, payload: str) -> None:
+        """Send one event payload to the client, counting it."""
+        message = event_message_json(self._msg_id, payload)
+        self._metrics.count("messages_sent")
+        # Characters, which is bytes for the ASCII JSON orjson emits
+        # unless states carry non-ASCII text.
+        self._metrics.count("bytes_sent", len(message))
+        self._connection.send_message(message)
+
+    @callback
+    def async_on_filter_change(self, change: FilterChange) -> None:
+        """Tell the client which entities joined or left the allow-list."""
+        # Anything still queued for a removed entity would arrive after
+        # its removal notice and resurrect it on the client.
+        for pending in self._pending_maps():
+            for entity_id in change.removed:
+                pending.pop(entity_id, None)
+        if self._async_backed_up():
+            self._held_filter_changes.append(change)
+            return
+        self._async_send_filter_change(change)
+        self._async_catch_up(change.seq)
+
+    @callback
+    def _async_send_filter_change(self, change: FilterChange) -> None:
+        """Send one allow-list edit."""
+
+        if self._ids is not None:
+            payload = change.compact_interned_json(self._cache, self._ids)
+        elif self._compact:
+            payload = change.compact_json(self._cache)
+        else:
+            payload = change.full_json(self._cache)
+        self._async_send(payload)
+
+    @callback
+    def async_cancel(self) -> None:
+        """Drop pending changes; the client is gone."""
+        for lane in self._lanes:
+            if lane.timer is not None:
+                lane.timer.cancel()
+                lane.timer = None
+            lane.pending.clear()
+        if self._poll is not None:
+            self._poll.cancel()
+            self._poll = None
+        self._backlog = None
+        self._snapshot = None
+        self._held_filter_changes.clear()
+
+    def _pending_maps(self) -> Iterable[dict[str, list[Any]]]:
+        """Every map of changes waiting to be sent."""
+        for lane in self._lanes:
+            yield lane.pending
+        if self._backlog is not None:
+            yield self._backlog
+
+    @staticmethod
+    def _async_merge(pending: dict[str, list[Any]], change: StateChange) -> bool:
+        """Merge a change into `pending` latest-wins; True if it collapsed."""
+        if (entry := pending.get(change.entity_id)) is not None:
+            entry[1] = change
+            entry[2] = True
+            return True
+        pending[change.entity_id] = [change.old_state, change, False]
+        return False
+
+    @callback
+    def _async_queue(self, lane: _Lane, change: StateChange) -> None:
+        """Merge a change into the window latest-wins, flushing if full."""
+        if not lane.pending:
+            lane.first_seq = change.seq
+        self._async_merge(lane.pending, change)
+
+        if len(lane.pending) >= self._max_batch:
+            self._async_flush_lane(lane)
+        elif lane.timer is None:
+            lane.timer = self._hass.loop.call_later(
+                lane.window, self._async_flush_lane, lane
+            )
+
+    @callback
+    def _async_backed_up(self) -> bool:
+        """Return True while the client lags; start holding back if it does."""
+        if self._backlog is not None:
+            return True
+        if (
+            self._queue_size is None
+            or self._queue_size() < BACKPRESSURE_HIGH_WATER
+        ):
+            return False
+
+        # Whatever the lanes hold is older than anything that comes
+        # next, so it moves into the backlog rather than racing it.
+        self._metrics.count("backpressure_engaged")
+        self._backlog = {}
+        for lane in self._lanes:
+            if lane.timer is not None:
+                lane.timer.cancel()
+                lane.timer = None
+            self._backlog.update(lane.pending)
+            lane.pending = {}
+        self._poll = self._hass.loop.call_later(
+            BACKPRESSURE_POLL_INTERVAL, self._async_check_drained
+        )
+        return True
+
+    @callback
+    def _async_check_drained(self) -> None:
+        """Send the backlog once the client has caught up, else wait more."""
+        assert self._queue_size is not None
+        if self._queue_size() > BACKPRESSURE_LOW_WATER:
+            self._poll = self._hass.loop.call_later(
+                BACKPRESSURE_POLL_INTERVAL, self._async_check_drained
+            )
+            return
+
+        self._poll = None
+        self._async_release_backlog()
+
+    @callback
+    def _async_release_backlog(self) -> None:
+        """Send held allow-list edits, then the backlog as one batch."""
+        backlog, self._backlog = self._backlog or {}, None
+        held, self._held_filter_changes = self._held_filter_changes, []
+        # Allow-list edits first: the backlog may hold changes of
+        # entities they add. It never holds entities they removed.
+        for change in held:
+            self._async_send_filter_change(change)
+        if backlog:
+            seq = max(change.seq for _, change, _ in backlog.values())
+            if (batch_json := self._batch_json(backlog, seq)) is not None:
+                self._async_send(batch_json)
+
+    @callback
+    def _async_catch_up(self, seq: int) -> None:
+        """Flush lanes holding changes older than the `seq` just sent."""
+        for lane in self._lanes:
+            if lane.pending and lane.first_seq < seq:
+                self._async_flush_lane(lane)
+
+    @callback
+    def async_flush(self) -> None:
+        """Send everything collected so far, fast lane first."""
+        for lane in self._lanes:
+            self._async_flush_lane(lane)
+
+    @callback
+    def _async_flush_lane(self, lane: _Lane) -> None:
+        """Send everything collected in one lane as one event message."""
+        if lane.timer is not None:
+            lane.timer.cancel()
+            lane.timer = None
+        if not lane.pending:
+            return
+        pending, lane.pending = lane.pending, {}
+
+        # The client resumes from the newest sequence it has seen, and
+        # every change up to it is in this batch (or sent right after
+        # by the catch-up below).
+        seq = max(change.seq for _, change, _ in pending.values())
+        if (batch_json := self._batch_json(pending, seq)) is not None:
+            self._async_send(batch_json)
+        self._async_catch_up(seq)
+
+    def _batch_json(self, pending: dict[str, list[Any]], seq: int) -> str | None:
+        """Encode pending changes as one batch payload."""
+        if self._compact:
+            batch: dict[str, Any] = {}
+            for old_state, change, merged in pending.values():
+                payload = (
+                    compact_event(
+                        change.entity_id,
+                        old_state,
+                        change.new_state,
+                        self._cache.attribute_filter,
+                    )
+                    if merged
+                    else change.compact_payload
+                )
+                if payload is None:
+                    continue
+                for key, value in payload.items():
+                    if key == ENTITY_EVENT_REMOVE:
+                        batch.setdefault(key, []).extend(value)
+                    else:
+                        batch.setdefault(key, {}).update(value)
+            if not batch:
+                return None
+            if self._ids is not None:
+                batch = self._ids.intern_payload(batch)
+            batch["seq"] = seq
+            return JSON_DUMP(batch)
+
+        events = [
+            full_event_json(
+                self._cache,
+                change.entity_id,
+                old_state,
+                change.new_state,
+                origin=change.origin,
+                time_fired=change.time_fired,
+                seq=change.seq,
+            )
+            if merged
+            else change.full_json
+            for old_state, change, merged in pending.values()
+        ]
+        return (
+            '{"event_type":"state_changed_batch","events":['
+            + ",".join(events)
+            + f'],"seq":{seq}}}'
+        )
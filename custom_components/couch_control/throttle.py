@@ -0,0 +1,253 @@
+"""Deadband and minimum-interval throttling for chatty sensors.
+
+Power and energy meters can report several times a second while a
+widget shows one decimal place. Rules configured in the options flow
+let the hub drop insignificant changes before anything is serialized,
+for every subscriber at once::
+
+    device_classes:
+      power:
+        deadband: 5            # watts
+        min_interval: 2        # seconds
+    entities:
+      sensor.grid_energy:
+        relative_deadband: 0.01
+
+A change is forwarded when its numeric state moved by at least the
+deadband (absolute, or relative to the last value sent) and
+`min_interval` has passed since the last forward. Attribute changes
+always count as significant, and changes to or from a non-numeric
+state (`unavailable`, ...) are sent right away. Whatever is held back
+is still delivered: the latest state goes out `min_interval` (or
+`THROTTLE_TRAILING_DELAY`) seconds later, diffed against what the
+clients actually received.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable, Iterable, Mapping
+import time
+from typing import Any
+
+import voluptuous as vol
+
+from homeassistant.const import ATTR_DEVICE_CLASS
+from homeassistant.core import Event, HomeAssistant, State, callback
+
+from .const import THROTTLE_TRAILING_DELAY
+
+CONF_DEADBAND = "deadband"
+CONF_RELATIVE_DEADBAND = "relative_deadband"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_DEVICE_CLASSES = "device_classes"
+CONF_RULE_ENTITIES = "entities"
+
+_RULE_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_DEADBAND): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_RELATIVE_DEADBAND): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=1)
+        ),
+        vol.Optional(CONF_MIN_INTERVAL): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+    }
+)
+
+THROTTLE_RULES_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_DEVICE_CLASSES, default={}): {str: _RULE_SCHEMA},
+        vol.Optional(CONF_RULE_ENTITIES, default={}): {str: _RULE_SCHEMA},
+    }
+)
+
+# (forward the event, with this old_state)
+ForwardCallback = Callable[[Event, "State | None"], None]
+
+
+def _as_number(state: State) -> float | None:
+    """Return the state as a float, or None if it isn't numeric."""
+    try:
+        return float(state.state)
+    except ValueError:
+        return None
+
+
+class _Track:
+    """What was last forwarded for one throttled entity."""
+
+    __slots__ = ("state", "sent_at", "pending", "timer", "deadline")
+
+    def __init__(self, state: State, sent_at: float) -> None:
+        """Initialize from the state that was just forwarded."""
+        self.state = state
+        self.sent_at = sent_at
+        self.pending: Event | None = None
+        self.timer: asyncio.TimerHandle | None = None
+        self.deadline = 0.0
+
+
+class Throttle:
+    """Apply throttle rules to state changes before they are fanned out."""
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        rules: Mapping[str, Any] | None,
+        forward: ForwardCallback,
+    ) -> None:
+        """Compile validated rules (see `THROTTLE_RULES_SCHEMA`)."""
+        self._hass = hass
+        self._forward = forward
+        self.rules: dict[str, Any] = THROTTLE_RULES_SCHEMA(dict(rules or {}))
+        self._device_classes: dict[str, dict[str, float]] = self.rules[
+            CONF_DEVICE_CLASSES
+        ]
+        self._entities: dict[str, dict[str, float]] = self.rules[CONF_RULE_ENTITIES]
+        self._tracks: dict[str, _Track] = {}
+        # Tuning counters: changes held back, per entity, and trailing
+        # updates that delivered a held-back state.
+        self.suppressed = 0
+        self.suppressed_by_entity: dict[str, int] = {}
+        self.trailing = 0
+
+    def __bool__(self) -> bool:
+        """Return True if any rule is configured."""
+        return bool(self._device_classes or self._entities)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Counters for the info / metrics endpoints."""
+        return {
+            "suppressed": self.suppressed,
+            "trailing": self.trailing,
+            "suppressed_by_entity": dict(self.suppressed_by_entity),
+        }
+
+    def forwarded_state(self, entity_id: str) -> State | None:
+        """Last state forwarded for a throttled entity, if it is tracked."""
+        if (track := self._tracks.get(entity_id)) is not None:
+            return track.state
+        return None
+
+    def _rule(self, entity_id: str, state: State) -> dict[str, float] | None:
+        """Return the rule for an entity; its own rule beats its device class."""
+        if (rule := self._entities.get(entity_id)) is not None:
+            return rule
+        if device_class := state.attributes.get(ATTR_DEVICE_CLASS):
+            return self._device_classes.get(device_class)
+        return None
+
+    @callback
+    def async_process(self, event: Event) -> None:
+        """Forward `event` now, later, or fold it into a trailing update."""
+        entity_id: str = event.data["entity_id"]
+        new_state: State | None = event.data.get("new_state")
+        track = self._tracks.get(entity_id)
+        rule = self._rule(entity_id, new_state) if new_state is not None else None
+
+        if rule is None or track is None:
+            # Unthrottled, removed, or the first change we see: pass
+            # it through and start tracking from here.
+            old_state = (
+                track.state if track is not None else event.data.get("old_state")
+            )
+            self._async_forget(entity_id)
+            if rule is not None and new_state is not None:
+                self._tracks[entity_id] = _Track(new_state, time.monotonic())
+            self._forward(event, old_state)
+            return
+
+        assert new_state is not None
+        now = time.monotonic()
+        min_interval = rule.get(CONF_MIN_INTERVAL, 0)
+        new_value = _as_number(new_state)
+        last_value = _as_number(track.state)
+        if new_value is None or last_value is None:
+            # Going unavailable / coming back is news, never held back.
+            self._async_send(track, event, now)
+            return
+        if self._significant(rule, track.state, new_state, new_value, last_value):
+            if now - track.sent_at >= min_interval:
+                self._async_send(track, event, now)
+                return
+            delay = track.sent_at + min_interval - now
+        else:
+            delay = min_interval or THROTTLE_TRAILING_DELAY
+
+        self.suppressed += 1
+        self.suppressed_by_entity[entity_id] = (
+            self.suppressed_by_entity.get(entity_id, 0) + 1
+        )
+        track.pending = event
+        # A significant change waiting out `min_interval` may need to go
+        # earlier than a deadband trailing update already scheduled.
+        if track.timer is None or now + delay < track.deadline:
+            if track.timer is not None:
+                track.timer.cancel()
+            track.deadline = now + delay
+            track.timer = self._hass.loop.call_later(
+                delay, self._async_send_trailing, entity_id
+            )
+
+    @staticmethod
+    def _significant(
+        rule: dict[str, float],
+        last_state: State,
+        new_state: State,
+        new_value: float,
+        last_value: float,
+    ) -> bool:
+        """Whether `new_state` differs enough from what clients have."""
+        if new_state.attributes != last_state.attributes:
+            return True
+        delta = abs(new_value - last_value)
+        if (deadband := rule.get(CONF_DEADBAND)) is not None and delta < deadband:
+            return False
+        if (
+            relative := rule.get(CONF_RELATIVE_DEADBAND)
+        ) is not None and delta < relative * abs(last_value):
+            return False
+        return delta > 0 or new_state.state != last_state.state
+
+    @callback
+    def _async_send(self, track: _Track, event: Event, now: float) -> None:
+        """Forward `event` as a diff against the last forwarded state."""
+        if track.timer is not None:
+            track.timer.cancel()
+            track.timer = None
+        track.pending = None
+        old_state = track.state
+        track.state = event.data["new_state"]
+        track.sent_at = now
+        self._forward(event, old_state)
+
+    @callback
+    def _async_send_trailing(self, entity_id: str) -> None:
+        """Deliver the latest held-back state."""
+        if (track := self._tracks.get(entity_id)) is None:
+            return
+        track.timer = None
+        if (event := track.pending) is not None:
+            self.trailing += 1
+            self._async_send(track, event, time.monotonic())
+
+    @callback
+    def async_forget(self, entity_ids: Iterable[str]) -> None:
+        """Stop tracking entities that left the allow-list."""
+        for entity_id in entity_ids:
+            self._async_forget(entity_id)
+
+    @callback
+    def _async_forget(self, entity_id: str) -> None:
+        """Drop one entity's track and its trailing timer."""
+        if (track := self._tracks.pop(entity_id, None)) is not None and track.timer:
+            track.timer.cancel()
+
+    @callback
+    def async_flush(self) -> None:
+        """Send every held-back state now and stop tracking."""
+        for entity_id, track in list(self._tracks.items()):
+            if track.pending is not None:
+                self._async_send(track, track.pending, time.monotonic())
+            self._async_forget(entity_id)
@@ -1,25 +1,48 @@
 """WebSocket API for Couch Control filtered subscriptions."""
 from __future__ import annotations
 
-import asyncio
+from collections.abc import Iterable
 import logging
+import time
 from typing import Any, Callable
 
 import voluptuous as vol
 
 from homeassistant.components import websocket_api
 from homeassistant.const import EVENT_STATE_CHANGED
-from homeassistant.core import Event, HomeAssistant, State, callback
-from homeassistant.helpers import entity_registry as er
-from homeassistant.helpers.event import async_track_state_change_event
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.json import JSON_DUMP
 
 from .const import (
+    DEFAULT_HISTORY_BUCKETS,
+    DEFAULT_HISTORY_HOURS,
+    DEFAULT_MAX_BATCH,
+    DEFAULT_PROFILE,
     DOMAIN,
+    ENTITY_EVENT_ADD,
+    ENTITY_EVENT_REMOVE,
+    MAX_COALESCE_MS,
+    MAX_HISTORY_BUCKETS,
+    MAX_HISTORY_ENTITIES,
+    MAX_HISTORY_HOURS,
+    MAX_PAGE_SIZE,
+    MAX_SNAPSHOT_CHUNK,
+    MAX_TELEMETRY_MS,
     WS_TYPE_GET_ENTITIES,
+    WS_TYPE_GET_HISTORY,
+    WS_TYPE_PATCH_ENTITIES,
     WS_TYPE_SUBSCRIBE_FILTERED,
     WS_TYPE_UPDATE_ENTITIES,
 )
-from .storage import async_save_entities
+from .filter_index import FilterSnapshot
+from .history import RecorderUnavailable, async_get_history
+from .hub import CouchControlHub, async_get_hub
+from .intern import InternTable
+from .listing import InvalidCursor, build_listing_json, listing_version
+from .patch import PATCH_SCHEMA, PatchConflict, async_patch_entities
+from .serialization import LISTING_FIELDS, result_message_json
+from .storage import async_schedule_save
+from .subscription import FilteredSubscription
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -29,128 +52,379 @@ async def async_setup_websocket_api(hass: HomeAssistant) -> None:
     websocket_api.async_register_command(hass, handle_subscribe_filtered)
     websocket_api.async_register_command(hass, handle_get_entities)
     websocket_api.async_register_command(hass, handle_update_entities)
+    websocket_api.async_register_command(hass, handle_patch_entities)
+    websocket_api.async_register_command(hass, handle_get_history)
 
 
 @websocket_api.websocket_command(
     {
         vol.Required("type"): WS_TYPE_SUBSCRIBE_FILTERED,
+        vol.Optional("compact", default=False): bool,
+        vol.Optional("coalesce_ms", default=0): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=MAX_COALESCE_MS)
+        ),
+        vol.Optional("max_batch", default=DEFAULT_MAX_BATCH): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional("telemetry_ms"): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=MAX_TELEMETRY_MS)
+        ),
+        vol.Optional("interactive"): [str],
+        vol.Optional("intern", default=False): bool,
+        vol.Optional("profile", default=DEFAULT_PROFILE): str,
+        vol.Optional("chunk_size"): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_SNAPSHOT_CHUNK)
+        ),
+        vol.Optional("priority"): [str],
+        vol.Optional("resume"): {
+            vol.Required("epoch"): str,
+            vol.Required("seq"): vol.All(vol.Coerce(int), vol.Range(min=0)),
+        },
     }
 )
 @callback
 def handle_subscribe_filtered(
     hass: HomeAssistant, connection: websocket_api.ActiveConnection, msg: dict[str, Any]
 ) -> None:
-    """Handle filtered entity subscription."""
+    """Handle filtered entity subscription.
+
+    With `compact: true` the subscription speaks the same diff format
+    as HA core's `subscribe_entities`: the result carries the snapshot
+    once as `{"a": {entity_id: compressed_state}}` and every later
+    event only carries what changed (`{"c": {entity_id: diff}}`), or
+    `{"r": [entity_id]}` when an entity goes away.
+
+    With `coalesce_ms` > 0, changes are held for that long, merged
+    latest-wins per entity and flushed as a single event message.
+    `max_batch` flushes early once that many distinct entities are
+    waiting, so a busy house can't stretch the window indefinitely.
+
+    `telemetry_ms` splits the stream in two lanes: changes of
+    `interactive` domains / entity ids (default `INTERACTIVE_DOMAINS`)
+    keep `coalesce_ms`, everything else is batched every `telemetry_ms`,
+    so a light toggle never waits behind a burst of sensor updates.
+
+    A client that falls behind on reading gets the latest state per
+    entity once it catches up, instead of every intermediate change
+    (see `FilteredSubscription`).
+
+    The subscription follows allow-list edits without a reconnect:
+    added entities arrive with their current state and removed ones as
+    ids, either as a `filter_changed` event (`{"added": [states],
+    "removed": [ids]}`) or, in compact mode, as `a` / `r` entries.
+
+    Every event carries a `seq` and the result the current `epoch` and
+    `seq`. Reconnecting with `resume: {"epoch", "seq"}` answers with
+    `resumed: true` and only the entities that changed since (current
+    state, or listed under `removed` / `r` if they left), as long as
+    the gap is still in the replay buffer; otherwise the full snapshot
+    is sent with `resumed: false`.
+
+    With `intern: true` (compact only) entities are referred to by a
+    small integer: the result carries an `ids` table (index ->
+    entity_id) for the entities it mentions, later `a` payloads extend
+    it, and `a` / `c` / `r` are keyed by index.
+
+    `profile` subscribes to a named profile's allow-list instead of
+    the default one.
+
+    `priority` lists entity ids to put first in the snapshot (say, the
+    dashboard on screen). With `chunk_size` the result carries no
+    states and `chunked: true`; the states follow as events of at most
+    that many entities (`{"event_type": "snapshot", "states": [...]}`
+    or `a` entries) and a `snapshot_complete` marker with the `count`
+    and the `seq` to resume from. Live changes start after the marker.
+    """
+    compact = msg["compact"]
+    if msg["intern"] and not compact:
+        connection.send_error(
+            msg["id"], "invalid_format", "intern requires compact: true"
+        )
+        return
+
     # WS commands can't be unregistered in HA, so they linger until
     # the next restart even after the user removes the integration.
     # Bail out cleanly if the domain is gone instead of crashing on
     # the missing key.
     if DOMAIN not in hass.data:
-        connection.send_result(msg["id"], {"states": []})
+        connection.send_result(
+            msg["id"], {ENTITY_EVENT_ADD: {}} if compact else {"states": []}
+        )
         return
 
-    @callback
-    def forward_events(event: Event) -> None:
-        """Forward filtered state change events to the client."""
-        # Domain may have been popped between subscribe and now —
-        # treat as an empty allow-list and stop forwarding.
-        if DOMAIN not in hass.data:
-            return
-        # Get the list of allowed entities
-        allowed_entities = hass.data[DOMAIN].get("entities", [])
-        
-        # Check if this entity is allowed
-        entity_id = event.data.get("entity_id")
-        if entity_id not in allowed_entities:
-            return
-        
-        # Get old and new state
-        old_state = event.data.get("old_state")
-        new_state = event.data.get("new_state")
-        
-        # Format the event for the client
-        event_message = {
-            "id": msg["id"],
-            "type": "event",
-            "event": {
-                "event_type": "state_changed",
-                "data": {
-                    "entity_id": entity_id,
-                    "old_state": _state_to_dict(old_state) if old_state else None,
-                    "new_state": _state_to_dict(new_state) if new_state else None,
-                },
-                "origin": event.origin,
-                "time_fired": event.time_fired.isoformat(),
-            },
-        }
-        
-        connection.send_message(websocket_api.messages.event_message(msg["id"], event_message["event"]))
-    
-    # Send initial states for allowed entities
-    allowed_entities = hass.data[DOMAIN].get("entities", [])
-    states = []
-    
-    for entity_id in allowed_entities:
-        state = hass.states.get(entity_id)
-        if state:
-            states.append(_state_to_dict(state))
-    
-    connection.send_result(msg["id"], {"states": states})
-    
-    # Track state changes for allowed entities only
-    unsub = async_track_state_change_event(
-        hass, allowed_entities, forward_events
+    hub = async_get_hub(hass)
+    if (allowed := hub.filters.get(msg["profile"])) is None:
+        connection.send_error(
+            msg["id"], "unknown_profile", f"No profile named {msg['profile']}"
+        )
+        return
+    allowed_entities = allowed.entities
+    cache = hub.state_cache
+
+    # A reconnecting client only needs what changed while it was away,
+    # if the replay buffer still reaches back that far.
+    changed = None
+    if (resume := msg.get("resume")) is not None and resume["epoch"] == hub.epoch:
+        changed = hub.replay.changed_since(
+            resume["seq"], msg["profile"], allowed
+        )
+    entity_ids = allowed_entities if changed is None else changed
+    if priority := msg.get("priority"):
+        entity_ids = _prioritized(entity_ids, priority)
+
+    ids = hub.ids if msg["intern"] else None
+    start = time.perf_counter()
+    result_json, chunks = _snapshot_json(
+        hass,
+        hub,
+        allowed,
+        entity_ids,
+        compact=compact,
+        ids=ids,
+        resumed=changed is not None,
+        chunk_size=msg.get("chunk_size"),
     )
-    
+    message = result_message_json(msg["id"], result_json)
+    hub.metrics.observe("snapshot_ms", (time.perf_counter() - start) * 1000)
+    hub.metrics.count("snapshots")
+    hub.metrics.count(
+        "snapshot_bytes", len(message) + sum(len(chunk) for chunk in chunks)
+    )
+    connection.send_message(message)
+
+    # Live changes come from the shared hub, which tracks the
+    # allow-list once for every connected client.
+    subscription = FilteredSubscription(
+        hass,
+        connection,
+        msg["id"],
+        cache,
+        compact=compact,
+        ids=ids,
+        coalesce_window=msg["coalesce_ms"] / 1000,
+        max_batch=msg["max_batch"],
+        metrics=hub.metrics,
+        telemetry_window=(
+            msg["telemetry_ms"] / 1000 if "telemetry_ms" in msg else None
+        ),
+        interactive=msg.get("interactive"),
+    )
+    if chunks:
+        subscription.async_send_snapshot(chunks)
+    unsub_hub = hub.async_subscribe(subscription, msg["profile"])
+
+    @callback
+    def unsub() -> None:
+        """Leave the hub and drop anything still waiting in the window."""
+        unsub_hub()
+        subscription.async_cancel()
+
     # Handle unsubscribe
     connection.subscriptions[msg["id"]] = unsub
     
     _LOGGER.info(
-        "Client subscribed to filtered updates for %d entities", len(allowed_entities)
+        "Client subscribed to filtered updates for %d entities of profile %s "
+        "(compact=%s, coalesce_ms=%d, telemetry_ms=%s, chunk_size=%s, "
+        "resumed=%s)",
+        len(allowed_entities),
+        msg["profile"],
+        compact,
+        msg["coalesce_ms"],
+        msg.get("telemetry_ms"),
+        msg.get("chunk_size"),
+        changed is not None,
+    )
+
+
+def _prioritized(entity_ids: Iterable[str], priority: list[str]) -> list[str]:
+    """Put the `priority` entities first, in that order, then the rest."""
+    entity_ids = list(entity_ids)
+    present = set(entity_ids)
+    first = [
+        entity_id for entity_id in dict.fromkeys(priority) if entity_id in present
+    ]
+    first_set = set(first)
+    return first + [
+        entity_id for entity_id in entity_ids if entity_id not in first_set
+    ]
+
+
+def _snapshot_json(
+    hass: HomeAssistant,
+    hub: CouchControlHub,
+    allowed: FilterSnapshot,
+    entity_ids: Iterable[str],
+    *,
+    compact: bool,
+    ids: InternTable | None,
+    resumed: bool,
+    chunk_size: int | None = None,
+) -> tuple[str, list[str]]:
+    """Encode the `subscribe_filtered` result for `entity_ids`.
+
+    Glued together from cached per-entity fragments instead of
+    re-encoding every state. Entities that are no longer allowed (or
+    have no state) are only listed as removed when resuming.
+
+    Returns the result and, with `chunk_size`, the event payloads that
+    carry the states instead (the last one being `snapshot_complete`).
+    """
+    cache = hub.state_cache
+    fragments: list[tuple[str, str]] = []
+    removed = []
+    for entity_id in entity_ids:
+        state = hub.visible_state(entity_id) if entity_id in allowed else None
+        if state is None:
+            removed.append(entity_id)
+        elif ids is not None:
+            fragments.append(
+                (entity_id, f'"{ids[entity_id]}":{cache.compressed_json(state)}')
+            )
+        elif compact:
+            fragments.append((entity_id, cache.compressed_item_json(state)))
+        else:
+            fragments.append((entity_id, cache.state_json(state)))
+
+    seq = hub.replay.seq
+    chunks = []
+    if chunk_size is not None:
+        for offset in range(0, len(fragments), chunk_size):
+            parts = _states_parts(
+                fragments[offset : offset + chunk_size], compact=compact, ids=ids
+            )
+            if not compact:
+                parts.insert(0, '"event_type":"snapshot"')
+            chunks.append("{" + ",".join(parts) + "}")
+        complete = (
+            '"snapshot_complete":true'
+            if compact
+            else '"event_type":"snapshot_complete"'
+        )
+        chunks.append(f'{{{complete},"count":{len(fragments)},"seq":{seq}}}')
+        fragments = []
+
+    # Allowed entities without a state still get an index: their first
+    # state later arrives keyed by it.
+    parts = _states_parts(fragments, compact=compact, ids=ids, unlisted=removed)
+    if resumed and (compact or ids is not None):
+        if removed:
+            interned = removed if ids is None else [ids[eid] for eid in removed]
+            parts.append(f'"{ENTITY_EVENT_REMOVE}":{JSON_DUMP(interned)}')
+    elif resumed:
+        parts.append(f'"removed":{JSON_DUMP(removed)}')
+    # A client cut off mid-stream must not resume from the result:
+    # the `seq` comes with `snapshot_complete` instead.
+    parts.append(
+        f'"generation":{allowed.generation},"epoch":"{hub.epoch}",'
+        + ('"chunked":true' if chunks else f'"seq":{seq}')
+        + f',"resumed":{JSON_DUMP(resumed)}'
     )
+    return "{" + ",".join(parts) + "}", chunks
+
+
+def _states_parts(
+    fragments: list[tuple[str, str]],
+    *,
+    compact: bool,
+    ids: InternTable | None,
+    unlisted: Iterable[str] = (),
+) -> list[str]:
+    """Wrap encoded states in the format's keys (`states`, `a`, `ids`).
+
+    `unlisted` entities have no state in `fragments` but still go in
+    the `ids` table.
+    """
+    encoded = ",".join(fragment for _, fragment in fragments)
+    if ids is not None:
+        mentioned = [entity_id for entity_id, _ in fragments] + list(unlisted)
+        return [
+            f'"ids":{JSON_DUMP(ids.table(mentioned))}',
+            f'"{ENTITY_EVENT_ADD}":{{{encoded}}}',
+        ]
+    if compact:
+        return [f'"{ENTITY_EVENT_ADD}":{{{encoded}}}']
+    return [f'"states":[{encoded}]']
 
 
 @websocket_api.websocket_command(
     {
         vol.Required("type"): WS_TYPE_GET_ENTITIES,
+        vol.Optional("version"): str,
+        vol.Optional("fields"): [vol.In(LISTING_FIELDS)],
+        vol.Optional("attributes"): [str],
+        vol.Optional("limit"): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_PAGE_SIZE)
+        ),
+        vol.Optional("cursor"): str,
+        vol.Optional("profile", default=DEFAULT_PROFILE): str,
     }
 )
 @callback
 def handle_get_entities(
     hass: HomeAssistant, connection: websocket_api.ActiveConnection, msg: dict[str, Any]
 ) -> None:
-    """Handle request to get list of filtered entities."""
+    """Handle request to get list of filtered entities.
+
+    Every result carries a `version` token. Sending it back as
+    `version` with the same query returns `{"not_modified": true}`
+    instead of the list when nothing changed since — the WS twin of
+    the REST view's ETag.
+
+    `fields`, `attributes`, `limit` and `cursor` work like the REST
+    query parameters: project each record down and page through the
+    list, following `next_cursor` until it is absent. `profile` lists
+    a named profile instead of the default one.
+    """
     if DOMAIN not in hass.data:
         connection.send_result(msg["id"], {"entities": []})
         return
-    entities = hass.data[DOMAIN].get("entities", [])
-    
-    # Get entity registry
-    ent_reg = er.async_get(hass)
-    
-    # Build detailed entity information
-    entity_info = []
-    for entity_id in entities:
-        state = hass.states.get(entity_id)
-        entry = ent_reg.async_get(entity_id)
-        
-        info = {
-            "entity_id": entity_id,
-            "state": state.state if state else None,
-            "attributes": dict(state.attributes) if state else {},
-        }
-        
-        if entry:
-            info.update({
-                "name": entry.name or entry.original_name,
-                "icon": entry.icon or entry.original_icon,
-                "device_class": entry.device_class,
-                "unit_of_measurement": entry.unit_of_measurement,
-            })
-        
-        entity_info.append(info)
+    hub = async_get_hub(hass)
+    if (allowed := hub.filters.get(msg["profile"])) is None:
+        connection.send_error(
+            msg["id"], "unknown_profile", f"No profile named {msg['profile']}"
+        )
+        return
+    hub.metrics.count("ws_listings")
+    version = listing_version(
+        hub,
+        allowed,
+        fields=msg.get("fields"),
+        attributes=msg.get("attributes"),
+        limit=msg.get("limit"),
+        cursor=msg.get("cursor"),
+    )
+    if msg.get("version") == version:
+        hub.metrics.count("ws_listings_not_modified")
+        connection.send_result(
+            msg["id"],
+            {
+                "not_modified": True,
+                "version": version,
+                "generation": allowed.generation,
+            },
+        )
+        return
     
-    connection.send_result(msg["id"], {"entities": entity_info})
+    # Build detailed entity information from cached fragments
+    start = time.perf_counter()
+    try:
+        result_json = build_listing_json(
+            hass,
+            hub,
+            allowed,
+            fields=msg.get("fields"),
+            attributes=msg.get("attributes"),
+            limit=msg.get("limit"),
+            cursor=msg.get("cursor"),
+        )
+    except InvalidCursor as err:
+        connection.send_error(msg["id"], "invalid_cursor", str(err))
+        return
+
+    message = result_message_json(msg["id"], result_json)
+    hub.metrics.observe("listing_ms", (time.perf_counter() - start) * 1000)
+    hub.metrics.count("bytes_sent", len(message))
+    connection.send_message(message)
 
 
 @websocket_api.websocket_command(
@@ -181,30 +455,104 @@ def handle_update_entities(
         else:
             _LOGGER.warning("Entity %s does not exist", entity_id)
     
-    # Update stored entities
-    hass.data[DOMAIN]["entities"] = valid_entities
-    hass.async_create_task(
-        async_save_entities(hass, {"entities": valid_entities})
+    # Update stored entities; like `set_entities`, this replaces any
+    # area / device picks and match rules with the explicit list.
+    index = hass.data[DOMAIN]["index"]
+    index.async_set_selection(
+        areas=[], devices=[], match_rules=[], entities=valid_entities
     )
+    async_schedule_save(hass)
     
     connection.send_result(
         msg["id"], 
         {
             "success": True, 
             "entities": valid_entities,
-            "filtered_count": len(entities) - len(valid_entities)
+            "filtered_count": len(entities) - len(valid_entities),
+            "generation": hass.data[DOMAIN]["filter"].generation,
         }
     )
     
     _LOGGER.info("Updated filtered entities list with %d entities", len(valid_entities))
 
 
-def _state_to_dict(state: State) -> dict[str, Any]:
-    """Convert state to dictionary representation."""
-    return {
-        "entity_id": state.entity_id,
-        "state": state.state,
-        "attributes": dict(state.attributes),
-        "last_changed": state.last_changed.isoformat(),
-        "last_updated": state.last_updated.isoformat(),
-    }
\ No newline at end of file
+@websocket_api.websocket_command(
+    {
+        vol.Required("type"): WS_TYPE_PATCH_ENTITIES,
+        **PATCH_SCHEMA,
+    }
+)
+@callback
+def handle_patch_entities(
+    hass: HomeAssistant, connection: websocket_api.ActiveConnection, msg: dict[str, Any]
+) -> None:
+    """Add and remove many entities at once and report the delta."""
+    if DOMAIN not in hass.data:
+        connection.send_error(
+            msg["id"],
+            "not_configured",
+            "Couch Control is not configured",
+        )
+        return
+
+    try:
+        delta = async_patch_entities(hass, add=msg["add"], remove=msg["remove"])
+    except PatchConflict as err:
+        connection.send_error(msg["id"], "invalid_format", str(err))
+        return
+    connection.send_result(msg["id"], {"success": True, **delta})
+
+
+@websocket_api.websocket_command(
+    {
+        vol.Required("type"): WS_TYPE_GET_HISTORY,
+        vol.Required("entity_ids"): vol.All(
+            [str], vol.Length(min=1, max=MAX_HISTORY_ENTITIES)
+        ),
+        vol.Optional("hours", default=DEFAULT_HISTORY_HOURS): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_HISTORY_HOURS)
+        ),
+        vol.Optional("buckets", default=DEFAULT_HISTORY_BUCKETS): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_HISTORY_BUCKETS)
+        ),
+        vol.Optional("profile", default=DEFAULT_PROFILE): str,
+    }
+)
+@websocket_api.async_response
+async def handle_get_history(
+    hass: HomeAssistant, connection: websocket_api.ActiveConnection, msg: dict[str, Any]
+) -> None:
+    """Return downsampled history for sparklines.
+
+    One series per allowed entity over the last `hours`, split into
+    `buckets` equal slices with `min`, `max` and time-weighted `mean`
+    (None where the state wasn't numeric). Entities outside the
+    allow-list come back under `invalid`.
+    """
+    if DOMAIN not in hass.data:
+        connection.send_error(
+            msg["id"],
+            "not_configured",
+            "Couch Control is not configured",
+        )
+        return
+
+    hub = async_get_hub(hass)
+    if (allowed := hub.filters.get(msg["profile"])) is None:
+        connection.send_error(
+            msg["id"], "unknown_profile", f"No profile named {msg['profile']}"
+        )
+        return
+    try:
+        result = await async_get_history(
+            hass,
+            hub,
+            allowed,
+            msg["entity_ids"],
+            hours=msg["hours"],
+            buckets=msg["buckets"],
+        )
+    except RecorderUnavailable as err:
+        connection.send_error(msg["id"], "recorder_unavailable", str(err))
+        return
+    connection.send_result(msg["id"], result)
@@ -0,0 +1,462 @@
+"""Offline performance benchmarks for Couch Control.
+
+Runs the integration against an in-process Home Assistant core (no
+config directory contents, no HTTP server, no network) whose entity,
+device and area registries are filled with synthetic data, then
+measures the hot paths:
+
+  resolve    building the area / device / entity filter index
+  forward    state changes fanned out per subscriber count and format
+  snapshot   `subscribe_filtered` result size and build time
+  rest       `GET /api/couch_control/entities`, paged and 304
+
+Every measurement is printed as one JSON object per line so runs can
+be diffed or fed to a dashboard. Needs the `homeassistant` package
+(the version you test against), nothing else:
+
+    python test/benchmark.py --output bench_output.txt
+    python test/benchmark.py --sizes 1000 --subscribers 1,10
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import inspect
+import json
+from pathlib import Path
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, TextIO
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from homeassistant.config_entries import ConfigEntries, ConfigEntry  # noqa: E402
+from homeassistant.const import __version__ as HA_VERSION  # noqa: E402
+from homeassistant.core import HomeAssistant  # noqa: E402
+from homeassistant.helpers import (  # noqa: E402
+    area_registry as ar,
+    device_registry as dr,
+    entity_registry as er,
+)
+from multidict import CIMultiDict, MultiDict  # noqa: E402
+
+from custom_components.couch_control import websocket_api  # noqa: E402
+from custom_components.couch_control.api import (  # noqa: E402
+    CouchControlEntitiesView,
+)
+from custom_components.couch_control.const import DOMAIN  # noqa: E402
+from custom_components.couch_control.filter_index import FilterIndex  # noqa: E402
+from custom_components.couch_control.hub import (  # noqa: E402
+    async_get_hub,
+    async_set_allowed_entities,
+)
+
+DEFAULT_SIZES = (1000, 10000, 50000)
+DEFAULT_SUBSCRIBERS = (1, 10, 50)
+# Share of the synthetic entities per domain.
+DOMAIN_MIX = (
+    ("sensor", 0.55),
+    ("binary_sensor", 0.15),
+    ("light", 0.12),
+    ("switch", 0.10),
+    ("media_player", 0.04),
+    ("cover", 0.04),
+)
+ENTITIES_PER_DEVICE = 5
+DEVICES_PER_AREA = 20
+# Changes fired per forward run; enough to get stable rates.
+FORWARD_CHANGES = 2000
+SEED = 1234
+
+
+class BenchConnection:
+    """Stands in for `ActiveConnection`: counts what would be sent."""
+
+    def __init__(self) -> None:
+        """Initialize the counters."""
+        self.subscriptions: dict[int, Any] = {}
+        self.messages = 0
+        self.bytes = 0
+        self.last: str | dict[str, Any] | None = None
+
+    def send_message(self, message: str | dict[str, Any]) -> None:
+        """Count a message instead of writing it."""
+        self.messages += 1
+        if isinstance(message, str):
+            self.bytes += len(message)
+        self.last = message
+
+    def send_result(self, msg_id: int, result: Any = None) -> None:
+        """Count a result."""
+        self.send_message({"id": msg_id, "type": "result", "result": result})
+
+    def send_error(self, msg_id: int, code: str, message: str) -> None:
+        """Errors mean the benchmark itself is broken."""
+        raise RuntimeError(f"{code}: {message}")
+
+
+class BenchRequest:
+    """The parts of `aiohttp.web.Request` the REST view reads."""
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        query: dict[str, str] | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        """Initialize the request."""
+        self.app = {"hass": hass}
+        self.query = MultiDict(query or {})
+        self.headers = CIMultiDict(headers or {})
+
+
+class Reporter:
+    """Write one JSON line per measurement to stdout and a file."""
+
+    def __init__(self, output: TextIO | None) -> None:
+        """Initialize with an optional extra output file."""
+        self._output = output
+
+    def __call__(self, bench: str, **values: Any) -> None:
+        """Emit a measurement."""
+        line = json.dumps({"bench": bench, **values}, sort_keys=True)
+        print(line, flush=True)
+        if self._output is not None:
+            self._output.write(line + "\n")
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    """p50 / p95 / p99 / max of `samples`, rounded to microseconds."""
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "p50_ms": round(pick(0.50), 3),
+        "p95_ms": round(pick(0.95), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def _state(rng: random.Random, domain: str, index: int) -> tuple[str, dict[str, Any]]:
+    """A plausible state and attributes for a synthetic entity."""
+    if domain == "sensor":
+        device_class = ("temperature", "humidity", "power", "energy")[index % 4]
+        unit = {"temperature": "°C", "humidity": "%", "power": "W", "energy": "kWh"}
+        return f"{rng.uniform(0, 3000):.1f}", {
+            "device_class": device_class,
+            "unit_of_measurement": unit[device_class],
+            "state_class": "measurement",
+            "friendly_name": f"Sensor {index}",
+        }
+    if domain == "binary_sensor":
+        return rng.choice(("on", "off")), {
+            "device_class": "motion",
+            "friendly_name": f"Motion {index}",
+        }
+    if domain == "light":
+        return rng.choice(("on", "off")), {
+            "brightness": rng.randrange(256),
+            "color_mode": "color_temp",
+            "color_temp_kelvin": rng.randrange(2000, 6500),
+            "supported_color_modes": ["color_temp", "hs"],
+            "friendly_name": f"Light {index}",
+        }
+    if domain == "media_player":
+        return rng.choice(("playing", "paused", "idle")), {
+            "volume_level": round(rng.random(), 2),
+            "media_title": f"Track {rng.randrange(10000)}",
+            "source_list": [f"Input {n}" for n in range(12)],
+            "friendly_name": f"Player {index}",
+        }
+    if domain == "cover":
+        return rng.choice(("open", "closed")), {
+            "current_position": rng.randrange(101),
+            "friendly_name": f"Cover {index}",
+        }
+    return rng.choice(("on", "off")), {"friendly_name": f"Switch {index}"}
+
+
+async def _async_make_hass(size: int, rng: random.Random) -> tuple[HomeAssistant, list[str], list[str]]:
+    """An HA core with `size` synthetic entities in registries and the state machine.
+
+    Returns hass, every entity id, and the area ids.
+    """
+    hass = HomeAssistant(tempfile.mkdtemp(prefix="couch_control_bench_"))
+    # Devices must belong to a config entry. Registering one directly
+    # avoids setting up a real integration for it.
+    hass.config_entries = ConfigEntries(hass, {})
+    kwargs: dict[str, Any] = {}
+    if "minor_version" in inspect.signature(ConfigEntry).parameters:
+        kwargs["minor_version"] = 1  # required since 2024.1
+    entry = ConfigEntry(
+        version=1, domain="bench", title="Bench", data={}, source="user", **kwargs
+    )
+    hass.config_entries._entries[entry.entry_id] = entry
+    await ar.async_load(hass)
+    await dr.async_load(hass)
+    await er.async_load(hass)
+    area_reg = ar.async_get(hass)
+    dev_reg = dr.async_get(hass)
+    ent_reg = er.async_get(hass)
+
+    devices_needed = -(-size // ENTITIES_PER_DEVICE)
+    areas = [
+        area_reg.async_create(f"Area {n}").id
+        for n in range(-(-devices_needed // DEVICES_PER_AREA))
+    ]
+    devices = []
+    for n in range(devices_needed):
+        device = dev_reg.async_get_or_create(
+            config_entry_id=entry.entry_id,
+            identifiers={("bench", str(n))},
+            name=f"Device {n}",
+        )
+        dev_reg.async_update_device(device.id, area_id=areas[n // DEVICES_PER_AREA])
+        devices.append(device.id)
+
+    entity_ids = []
+    index = 0
+    for domain, share in DOMAIN_MIX:
+        for _ in range(int(size * share)):
+            entry = ent_reg.async_get_or_create(
+                domain,
+                "bench",
+                f"{domain}_{index}",
+                device_id=devices[index // ENTITIES_PER_DEVICE],
+                suggested_object_id=f"bench_{index}",
+            )
+            state, attributes = _state(rng, domain, index)
+            hass.states.async_set(entry.entity_id, state, attributes)
+            entity_ids.append(entry.entity_id)
+            index += 1
+    await hass.async_block_till_done()
+    return hass, entity_ids, areas
+
+
+def _bench_resolve(
+    report: Reporter, hass: HomeAssistant, size: int, entity_ids: list[str], areas: list[str]
+) -> None:
+    """Index build over the registries for typical pick shapes."""
+    picks = {
+        "areas": {"areas": areas[: max(1, len(areas) // 2)], "devices": [], "entities": []},
+        "entities": {"areas": [], "devices": [], "entities": entity_ids[: size // 2]},
+        "mixed": {
+            "areas": areas[: max(1, len(areas) // 4)],
+            "devices": [],
+            "entities": entity_ids[-(size // 4):],
+        },
+    }
+    for shape, selection in picks.items():
+        samples = []
+        resolved = 0
+        for _ in range(5):
+            start = time.perf_counter()
+            index = FilterIndex(hass, **selection)
+            index.async_start()
+            samples.append((time.perf_counter() - start) * 1000)
+            resolved = len(index.resolved)
+            index.async_stop()
+        report(
+            "resolve",
+            entities=size,
+            picks=shape,
+            resolved=resolved,
+            mean_ms=round(statistics.fmean(samples), 3),
+            **_percentiles(samples),
+        )
+
+
+async def _async_bench_forward(
+    report: Reporter,
+    hass: HomeAssistant,
+    size: int,
+    entity_ids: list[str],
+    subscriber_counts: tuple[int, ...],
+    rng: random.Random,
+) -> None:
+    """Throughput and per-change latency of the shared fan-out."""
+    targets = [rng.choice(entity_ids) for _ in range(FORWARD_CHANGES)]
+    for subscribers in subscriber_counts:
+        for fmt in ("full", "compact"):
+            connections = [BenchConnection() for _ in range(subscribers)]
+            for msg_id, connection in enumerate(connections, 1):
+                _subscribe(hass, connection, msg_id, compact=fmt == "compact")
+                # Only count live traffic, not the snapshot.
+                connection.messages = connection.bytes = 0
+            samples = []
+            start = time.perf_counter()
+            for n, entity_id in enumerate(targets):
+                state = hass.states.get(entity_id)
+                attributes = dict(state.attributes)
+                if "brightness" in attributes:
+                    attributes["brightness"] = n % 256
+                sent = time.perf_counter()
+                # Setting a state runs the tracker callback (and so the
+                # whole fan-out) before returning once the loop turns.
+                hass.states.async_set(
+                    entity_id, f"{subscribers}{fmt}{n}", attributes
+                )
+                await hass.async_block_till_done()
+                samples.append((time.perf_counter() - sent) * 1000)
+            elapsed = time.perf_counter() - start
+            report(
+                "forward",
+                entities=size,
+                subscribers=subscribers,
+                format=fmt,
+                changes=len(targets),
+                changes_per_s=round(len(targets) / elapsed, 1),
+                messages=sum(c.messages for c in connections),
+                bytes_per_change=round(
+                    sum(c.bytes for c in connections) / len(targets) / subscribers, 1
+                ),
+                **_percentiles(samples),
+            )
+            for connection in connections:
+                for unsub in connection.subscriptions.values():
+                    unsub()
+
+
+def _subscribe(
+    hass: HomeAssistant, connection: BenchConnection, msg_id: int, *, compact: bool
+) -> None:
+    """Run `couch_control/subscribe_filtered` on a bench connection."""
+    handler = websocket_api.handle_subscribe_filtered
+    msg = handler._ws_schema(  # type: ignore[attr-defined]
+        {"id": msg_id, "type": "couch_control/subscribe_filtered", "compact": compact}
+    )
+    handler(hass, connection, msg)
+
+
+def _bench_snapshot(report: Reporter, hass: HomeAssistant, size: int) -> None:
+    """`subscribe_filtered` result size and build time, cold and warm cache."""
+    hub = async_get_hub(hass)
+    for fmt in ("full", "compact"):
+        for cache in ("cold", "warm"):
+            if cache == "cold":
+                hub.state_cache.async_clear()
+            connection = BenchConnection()
+            start = time.perf_counter()
+            _subscribe(hass, connection, 1, compact=fmt == "compact")
+            elapsed = (time.perf_counter() - start) * 1000
+            for unsub in connection.subscriptions.values():
+                unsub()
+            report(
+                "snapshot",
+                entities=size,
+                format=fmt,
+                cache=cache,
+                ms=round(elapsed, 3),
+                bytes=connection.bytes,
+            )
+
+
+async def _async_bench_rest(report: Reporter, hass: HomeAssistant, size: int) -> None:
+    """REST listing: a full paged walk and a conditional 304."""
+    view = CouchControlEntitiesView()
+    samples = []
+    pages = 0
+    body_bytes = 0
+    cursor = None
+    while True:
+        query = {"limit": "1000"}
+        if cursor is not None:
+            query["cursor"] = cursor
+        start = time.perf_counter()
+        response = await view.get(BenchRequest(hass, query))
+        samples.append((time.perf_counter() - start) * 1000)
+        pages += 1
+        body_bytes += len(response.body)
+        if (cursor := json.loads(response.text).get("next_cursor")) is None:
+            break
+    report(
+        "rest",
+        entities=size,
+        request="paged",
+        pages=pages,
+        bytes=body_bytes,
+        total_ms=round(sum(samples), 3),
+        **_percentiles(samples),
+    )
+
+    # The ETag covers the query, so revalidate the last page with the
+    # query that produced it.
+    etag = response.headers["ETag"]
+    samples = []
+    for _ in range(100):
+        start = time.perf_counter()
+        response = await view.get(
+            BenchRequest(hass, query, headers={"If-None-Match": etag})
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+    assert response.status == 304
+    report("rest", entities=size, request="not_modified", **_percentiles(samples))
+
+
+async def async_run(
+    sizes: tuple[int, ...], subscriber_counts: tuple[int, ...], report: Reporter
+) -> None:
+    """Run every benchmark for every registry size."""
+    for size in sizes:
+        rng = random.Random(SEED)
+        hass, entity_ids, areas = await _async_make_hass(size, rng)
+        hass.data[DOMAIN] = {}
+        async_set_allowed_entities(hass, entity_ids)
+        _bench_resolve(report, hass, size, entity_ids, areas)
+        _bench_snapshot(report, hass, size)
+        await _async_bench_rest(report, hass, size)
+        await _async_bench_forward(
+            report, hass, size, entity_ids, subscriber_counts, rng
+        )
+        report("metrics", entities=size, **async_get_hub(hass).metrics.as_dict())
+        await hass.async_stop(force=True)
+
+
+def _int_list(value: str) -> tuple[int, ...]:
+    """Parse `1000,10000` into a tuple of ints."""
+    return tuple(int(part) for part in value.split(",") if part)
+
+
+def main() -> None:
+    """Parse arguments and run."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=_int_list,
+        default=DEFAULT_SIZES,
+        help="registry sizes, comma separated (default: 1000,10000,50000)",
+    )
+    parser.add_argument(
+        "--subscribers",
+        type=_int_list,
+        default=DEFAULT_SUBSCRIBERS,
+        help="subscriber counts for the forward benchmark (default: 1,10,50)",
+    )
+    parser.add_argument(
+        "--output", help="also append the JSON lines to this file"
+    )
+    args = parser.parse_args()
+
+    output = open(args.output, "a", encoding="utf-8") if args.output else None
+    try:
+        report = Reporter(output)
+        report(
+            "run",
+            started=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            python=sys.version.split()[0],
+            homeassistant=HA_VERSION,
+        )
+        asyncio.run(async_run(args.sizes, args.subscribers, report))
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Smoke test: the offline benchmark runs end to end at a tiny size.
+
+Skipped without the `homeassistant` package, like `test_intern.py`.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("homeassistant")
+
+BENCHMARK = Path(__file__).resolve().parent / "benchmark.py"
+PHASES = {"run", "resolve", "snapshot", "rest", "forward", "metrics"}
+
+
+def test_benchmark_reports_every_phase(tmp_path: Path) -> None:
+    """Every phase prints JSON lines, including the paged and 304 REST runs."""
+    output = tmp_path / "bench_output.txt"
+    subprocess.run(
+        [
+            sys.executable,
+            str(BENCHMARK),
+            "--sizes",
+            "100",
+            "--subscribers",
+            "1",
+            "--output",
+            str(output),
+        ],
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert {line["bench"] for line in lines} == PHASES
+    assert {line["request"] for line in lines if line["bench"] == "rest"} == {
+        "paged",
+        "not_modified",
+    }
@@ -0,0 +1,128 @@
+"""Interned `subscribe_filtered` subscriptions never send unknown indexes.
+
+Runs against an in-process Home Assistant core like `benchmark.py`;
+skipped without the `homeassistant` package:
+
+    python -m pytest test/test_intern.py
+"""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable
+import json
+from pathlib import Path
+import sys
+import tempfile
+from typing import Any
+
+import pytest
+
+pytest.importorskip("homeassistant")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from homeassistant.core import HomeAssistant  # noqa: E402
+
+from custom_components.couch_control import websocket_api  # noqa: E402
+from custom_components.couch_control.const import DOMAIN  # noqa: E402
+from custom_components.couch_control.hub import (  # noqa: E402
+    async_set_allowed_entities,
+)
+
+
+class RecordingConnection:
+    """Stands in for `ActiveConnection`: keeps every message sent."""
+
+    def __init__(self) -> None:
+        """Initialize with nothing sent."""
+        self.subscriptions: dict[int, Any] = {}
+        self.messages: list[dict[str, Any]] = []
+
+    def send_message(self, message: str | dict[str, Any]) -> None:
+        """Record a message, decoded."""
+        self.messages.append(
+            json.loads(message) if isinstance(message, str) else message
+        )
+
+    def send_result(self, msg_id: int, result: Any = None) -> None:
+        """Record a result."""
+        self.send_message({"id": msg_id, "type": "result", "result": result})
+
+    def send_error(self, msg_id: int, code: str, message: str) -> None:
+        """Errors mean the test setup is broken."""
+        raise RuntimeError(f"{code}: {message}")
+
+
+def _run(test: Callable[[HomeAssistant], Awaitable[None]]) -> None:
+    """Run `test` against a fresh HA core with the integration's hub."""
+
+    async def _async_run() -> None:
+        hass = HomeAssistant(tempfile.mkdtemp(prefix="couch_control_test_"))
+        hass.data[DOMAIN] = {}
+        try:
+            await test(hass)
+        finally:
+            await hass.async_stop(force=True)
+
+    asyncio.run(_async_run())
+
+
+def _subscribe_interned(hass: HomeAssistant) -> RecordingConnection:
+    """Open an interned compact subscription on a new connection."""
+    connection = RecordingConnection()
+    handler = websocket_api.handle_subscribe_filtered
+    msg = handler._ws_schema(  # type: ignore[attr-defined]
+        {
+            "id": 1,
+            "type": "couch_control/subscribe_filtered",
+            "compact": True,
+            "intern": True,
+        }
+    )
+    handler(hass, connection, msg)
+    return connection
+
+
+def _known_ids(connection: RecordingConnection) -> dict[str, str]:
+    """Every `ids` entry the client has received so far."""
+    known: dict[str, str] = {}
+    for message in connection.messages:
+        payload = message.get("result") or message.get("event") or {}
+        known.update(payload.get("ids", {}))
+    return known
+
+
+def test_state_of_stateless_allowed_entity_is_resolvable() -> None:
+    """An allowed entity that gets its first state later is in the table."""
+
+    async def _test(hass: HomeAssistant) -> None:
+        hass.states.async_set("light.a", "on")
+        async_set_allowed_entities(hass, ["light.a", "sensor.late"])
+        connection = _subscribe_interned(hass)
+        assert _known_ids(connection) == {"0": "light.a", "1": "sensor.late"}
+
+        hass.states.async_set("sensor.late", "21.5")
+        await hass.async_block_till_done()
+        event = connection.messages[-1]["event"]
+        assert list(event["a"]) == ["1"]
+        assert _known_ids(connection)["1"] == "sensor.late"
+
+    _run(_test)
+
+
+def test_stateless_entity_joining_allow_list_is_resolvable() -> None:
+    """`filter_changed` adds an index even for an entity without a state."""
+
+    async def _test(hass: HomeAssistant) -> None:
+        hass.states.async_set("light.a", "on")
+        async_set_allowed_entities(hass, ["light.a"])
+        connection = _subscribe_interned(hass)
+
+        async_set_allowed_entities(hass, ["light.a", "sensor.late"])
+        hass.states.async_set("sensor.late", "21.5")
+        await hass.async_block_till_done()
+        known = _known_ids(connection)
+        for message in connection.messages[1:]:
+            for index in message["event"].get("a", {}):
+                assert index in known
+
+    _run(_test)